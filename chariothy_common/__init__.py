@@ -1,7 +1,16 @@
 from .app_tool import AppTool
 from .exception import AppToolError
 from .get_ch import GetCh
+from .smtp_pool import SMTPPool
+from .mail_spool import MailSpool
+from .log_handlers import QueueLogging, BoundedQueueHandler, MySMTPHandler, DigestSMTPHandler, RotatingCompressedFileHandler
+from .log_handlers import TextFormatter, JsonFormatter, Lazy
+from .timing import timings, measure, find_regressions, TimingRegistry, TimingStats
+from .metrics import Instrumentation
+from .async_smtp import send_email_async, AsyncSMTP
 
 from .utils import is_linux, is_win, is_macos, is_darwin, cls, deprecated, get_home_dir, get_win_dir
-from .utils import deep_merge_in, deep_merge, send_email, alignment, get
-from .utils import benchmark, random_sleep, load_json, dump_json, now, today
\ No newline at end of file
+from .utils import deep_merge_in, deep_merge, send_email, send_emails, alignment, get, put, flatten, diff_keys
+from .utils import coerce, coerce_config, SMTP_SCHEMA
+from .utils import benchmark, random_sleep, load_json, dump_json, update_json, iter_json, dump_jsonl, now, today
+from .utils import JsonCache, json_cache
\ No newline at end of file
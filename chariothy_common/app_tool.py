@@ -2,51 +2,396 @@ import os, sys, logging
 from os import path
 from email.utils import formataddr
 from collections.abc import Iterable
-from logging import handlers
 import functools
+import threading
 import time
 import re
+from types import MappingProxyType
+import weakref
 from typing import Union
 
-from .utils import deep_merge, send_email, get
+from .utils import deep_merge, send_email, send_emails, get, put, flatten, diff_keys, coerce, coerce_config, SMTP_SCHEMA
 from .exception import AppToolError
-
-
-class MySMTPHandler(handlers.SMTPHandler):
-    def getSubject(self, record):
-        #all_formatter = logging.Formatter(fmt='%(name)s - %(levelno)s - %(levelname)s - %(pathname)s - %(filename)s - %(module)s - %(lineno)d - %(funcName)s - %(created)f - %(asctime)s - %(msecs)d  %(relativeCreated)d - %(thread)d -  %(threadName)s -  %(process)d - %(message)s ')        
-        #print('Ex. >>> ',all_formatter.formatMessage(record))
-
-        #help(record)
-        #help(formatter)
-        
-        formatter = logging.Formatter(fmt=self.subject)
-        return formatter.formatMessage(record)
+from .smtp_pool import SMTPPool
+from .mail_spool import MailSpool
+from .log_handlers import QueueLogging, MySMTPHandler, DigestSMTPHandler, RotatingCompressedFileHandler, TextFormatter, JsonFormatter
+from .async_smtp import send_email_async, loop_semaphore
+from .timing import timings
+from .metrics import Instrumentation
+
+
+_formatters = {}          # {log.format: formatter shared by handlers}
+_owned_loggers = {}      # {logger name: ({dest: (settings, handler)}, (queue settings, QueueLogging) or None)}
+_owned_loggers_lock = threading.Lock()
+_instrumentations = {}     # {app name: Instrumentation shared by AppTools, so its file and port are exported once}
+_instrumentations_lock = threading.Lock()
+
+
+def _log_formatter(log_format: str) -> logging.Formatter:
+    formatter = _formatters.get(log_format)
+    if formatter is None:
+        if log_format == 'json':
+            formatter = JsonFormatter()
+        elif log_format == 'text':
+            formatter = TextFormatter("%(asctime)s - %(levelname)s - %(message)s")
+        else:
+            raise AppToolError(f'Invalid log format {log_format!r}, should be text or json.')
+        formatter = _formatters.setdefault(log_format, formatter)
+    return formatter
+
+
+def _reconcile_handlers(logger: logging.Logger, wanted: list, queue_settings: tuple):
+    """Attach handlers in wanted [(dest, settings, factory)] to logger, directly or by QueueLogging if queue_settings,
+    reuse handlers init_logger() created before if their settings are unchanged, and close the others.
+    Handlers not created by init_logger() are untouched.
+
+    Returns:
+        QueueLogging -- None if handlers are attached directly
+    """
+    owned, queued = _owned_loggers.get(logger.name, ({}, None))
+    if (queued[0] if queued else None) == queue_settings and \
+        [(dest, settings) for dest, settings, _ in wanted] == [(dest, settings) for dest, (settings, _) in owned.items()]:
+        return queued[1] if queued else None
+
+    new_owned = {}
+    for dest, settings, factory in wanted:
+        old = owned.get(dest)
+        new_owned[dest] = old if old and old[0] == settings else (settings, factory())
+    new_handlers = [handler for _, handler in new_owned.values()]
+
+    if queued:
+        # Records in queue are handled by old handlers before they are closed
+        queued[1].stop()
+    for _, handler in owned.values():
+        logger.removeHandler(handler)
+        if handler not in new_handlers:
+            handler.close()
+
+    if queue_settings:
+        queued = (queue_settings, QueueLogging(logger, new_handlers, queue_size=queue_settings[0], overflow=queue_settings[1]).start())
+    else:
+        queued = None
+        for handler in new_handlers:
+            logger.addHandler(handler)
+    _owned_loggers[logger.name] = (new_owned, queued)
+    return queued[1] if queued else None
+
+
+_LOG_KWARGS = frozenset(('exc_info', 'stack_info', 'stacklevel', 'extra'))
+_LOG_METHODS = (('debug', logging.DEBUG), ('info', logging.INFO), ('warn', logging.WARNING), ('error', logging.ERROR), 
+                ('err', logging.ERROR), ('ex', logging.ERROR), ('fatal', logging.CRITICAL))
+
+
+def _make_log_nop(app, name: str):
+    """Log method of a disabled level, which does nothing until levels are changed since it's bound,
+    Ex. by logging.disable() or setLevel() of logger or its parents by others, then log methods of app are bound again.
+    """
+    logger = app._logger
+    # Level cache of logger, which is cleared by logging whenever a level or logging.disable() is changed
+    cache = logger._cache
+    def log_nop(msg, *args, **kwargs):
+        if not cache and not logger.disabled:
+            app._bind_log_methods()
+            getattr(app, name)(msg, *args, **kwargs)
+    return log_nop
+
+
+def _make_log_method(logger: logging.Logger, level: int, exc_info: bool=False):
+    """Log method of an enabled level, which checks level by Logger.isEnabledFor() (cached by logging) 
+    then calls Logger._log(), so logging.disable() and levels changed by others are respected.
+    Keyword arguments other than those of Logger.log() are put into extra as fields.
+    """
+    log = logger._log
+    is_enabled = logger.isEnabledFor
+    def log_method(msg, *args, **kwargs):
+        if not is_enabled(level):
+            return
+        if kwargs and not kwargs.keys() <= _LOG_KWARGS:
+            fields = {key: kwargs.pop(key) for key in list(kwargs) if key not in _LOG_KWARGS}
+            kwargs['extra'] = dict(kwargs.get('extra') or {}, fields=fields)
+        if exc_info:
+            kwargs.setdefault('exc_info', True)
+        log(level, msg, args, **kwargs)
+    return log_method
+
+
+_MISSING = object()
+_ENV_VAR = object()
+_config_codes = {}
+
+
+@functools.lru_cache(maxsize=1024)
+def _env_key_parts(key) -> tuple:
+    """Ex. _env_key_parts('demo.key') == ('DEMO', 'KEY')
+    """
+    return tuple(re.sub(r'\W+', '_', str(key)).upper().split('_'))
+
+
+def _overlay_env(config, env_trie: dict, used_env_keys: set, convert=None, parent_key: str=''):
+    """Replace items of config with env found in env_trie, copy config only if any item is replaced.
+    Env value is converted by convert(key, value, env_key, env_value) if given.
+    """
+    replaced = None
+    is_dict = type(config) is dict
+    items = config.items() if is_dict else enumerate(config)
+    for key, value in items:
+        node = env_trie
+        for part in (_env_key_parts(key) if is_dict else (str(key),)):
+            node = node.get(part)
+            if node is None:
+                break
+        if node is None:
+            continue
+
+        if is_dict:
+            full_key = str(key).replace('.', '#')
+            full_key = parent_key + '.' + full_key if parent_key else full_key
+        else:
+            full_key = f'{parent_key}[{key}]'
+        if _ENV_VAR in node:
+            env_key, new_value = node[_ENV_VAR]
+            used_env_keys.add(env_key)
+            if convert:
+                new_value = convert(full_key, value, env_key, new_value)
+        elif type(value) in (list, dict, tuple):
+            new_value = _overlay_env(value, node, used_env_keys, convert, full_key)
+        else:
+            continue
+
+        if new_value is not value:
+            if replaced is None:
+                replaced = config.copy() if type(config) is dict else list(config)
+            replaced[key] = new_value
+    return config if replaced is None else replaced
+
+
+def exec_config(file_path: str, search_dirs: tuple=None, config_names: tuple=(), _modules: dict=None) -> dict:
+    """Execute config module by file path, without touching sys.path or sys.modules.
+    Compiled code is cached per file and re-compiled only if mtime or size of file is changed.
+    Sibling config modules in config_names can be imported by it while it's executed (Ex. from config import CONFIG), 
+    they are found in search_dirs and executed the same way, other imports are as usual.
+
+    Arguments:
+        file_path {str} -- File path of config module.
+
+    Keyword Arguments:
+        search_dirs {tuple} -- Dirs to find sibling config modules in (default: {dir of file_path})
+        config_names {tuple} -- Names of sibling config modules, Ex. ('config', 'config_local') (default: {()})
+
+    Returns:
+        [dict] -- Global variables of executed module.
+    """
+    import builtins
+    from types import ModuleType
+    with open(file_path, 'rb') as fp:
+        stat = os.fstat(fp.fileno())
+        signature = (stat.st_mtime_ns, stat.st_size)
+        cached = _config_codes.get(file_path)
+        if cached and cached[0] == signature:
+            code = cached[1]
+        else:
+            code = compile(fp.read(), file_path, 'exec', dont_inherit=True)
+            _config_codes[file_path] = (signature, code)
+
+    if search_dirs is None:
+        search_dirs = (path.dirname(file_path),)
+    # {module name: module} of siblings imported while executing, each is executed once
+    modules = _modules if _modules is not None else {}
+
+    # Functions defined in config module keep the hook, which passes through once module is executed
+    executing = True
+
+    def import_sibling(name, globals=None, locals=None, fromlist=(), level=0):
+        if executing and level == 0 and name in config_names:
+            module = modules.get(name)
+            if module is None:
+                for dir_path in search_dirs:
+                    sibling_path = path.join(dir_path, name + '.py')
+                    if path.isfile(sibling_path):
+                        module = ModuleType(name)
+                        modules[name] = module
+                        module.__dict__.update(exec_config(sibling_path, search_dirs, config_names, modules))
+                        break
+            if module is not None:
+                return module
+        return builtins.__import__(name, globals, locals, fromlist, level)
+
+    module_name = path.splitext(path.basename(file_path))[0]
+    namespace = {
+        '__name__': module_name,
+        '__file__': file_path,
+        '__builtins__': dict(vars(builtins), __import__=import_sibling),
+    }
+    try:
+        exec(code, namespace)
+    finally:
+        executing = False
+    return namespace
+
+
+def _is_schema_class(target) -> bool:
+    return isinstance(target, type) and '__annotations__' in vars(target)
+
+
+def _schema_to_dict(schema, parent_key: str='') -> dict:
+    """Flatten schema of dict or class with type hints into {key: target}.
+    """
+    if type(schema) is dict:
+        items = schema.items()
+    else:
+        items = list(vars(schema).get('__annotations__', {}).items())
+        items += [(name, value) for name, value in vars(schema).items() if isinstance(value, type) and not name.startswith('_')]
+
+    result = {}
+    for key, target in items:
+        full_key = parent_key + '.' + key if parent_key else key
+        if type(target) is dict or _is_schema_class(target) or (type(schema) is not dict and target is vars(schema).get(key)):
+            result.update(_schema_to_dict(target, full_key))
+        else:
+            result[full_key] = target
+    return result
 
 
 class AppTool(object):
-    def __init__(self, app_name: str, app_path: str, local_config_dir: str='', config_name: str='config', ignore_env:bool=False):
+    def __init__(self, app_name: str, app_path: str, local_config_dir: str='', config_name: str='config', ignore_env:bool=False, 
+        frozen: bool=False, schema=None, coerce_env: bool=False):
+        """
+        Args:
+            frozen (bool, optional): If True, config is flattened into a read-only snapshot after loaded,
+                then get() and [] of keys connected by '#' are a single hash lookup. Defaults to False.
+            schema (dict|class, optional): Types of config items which env values are coerced to, 
+                {key: target of utils.coerce()} or a class with type hints, nested dicts or classes are for sub keys.
+                Ex. {'smtp.port': int, 'log': {'dest': list}}
+                    class Schema:
+                        class smtp:
+                            port: int
+                Defaults to None.
+            coerce_env (bool, optional): If True, env values of items not in schema are coerced to type of values they replace. 
+                Defaults to False.
+        """
         self._app_name = app_name
         self._app_path = app_path
         self._config = {}
+        self._snapshot = None
+        self._frozen = frozen
         self._logger = None
+        self._queue_logging = None
+        self._reload_lock = threading.RLock()
+        self._subscribers = []
+        self._watcher = None
+        self._unused_env_vars = []
+        self._overrides = {}
+        self._schema = _schema_to_dict(schema) if schema is not None else {}
+        self._coerce_env = coerce_env
+        self._env_converters = {}
+        self._smtp_pool = None
+        self._mail_spool = None
+        self._metrics = None
+        self._async_semaphores = weakref.WeakKeyDictionary()
 
         self.load_config(local_config_dir, config_name)
         self.init_logger()
+        if self._unused_env_vars:
+            self._logger.warning(f'Env vars match no config key: {", ".join(self._unused_env_vars)}')
+        # Deliver mail left in spool by last run
+        self.mail_spool
 
 
     @property
     def config(self):
+        """Merged config, nested items are shared with config layers, 
+        so replace top-level items or use override() instead of changing nested items in place.
+        """
         return self._config
 
 
+    @property
+    def snapshot(self):
+        """Read-only flattened config if frozen, else None.
+        """
+        return self._snapshot
+
+
     @property
     def logger(self):
         return self._logger
 
 
+    @property
+    def queue_logging(self):
+        """QueueLogging which runs log handlers if config log.async is true, else None.
+        """
+        return self._queue_logging
+
+
+    @property
+    def smtp_pool(self):
+        """SMTP sessions reused by send_email(), idle ones are closed after config smtp.idle_timeout seconds (default 60).
+        """
+        if self._smtp_pool is None:
+            smtp = self._config.get('smtp') or {}
+            self._smtp_pool = SMTPPool(idle_timeout=coerce(smtp.get('idle_timeout', 60), float))
+        return self._smtp_pool
+
+
+    @property
+    def mail_spool(self):
+        """MailSpool in config mail.spool_dir (relative to app path) with its worker started, None if not configured.
+        """
+        if self._mail_spool is None:
+            spool_dir = (self._config.get('mail') or {}).get('spool_dir')
+            if spool_dir:
+                self._mail_spool = MailSpool(path.join(self._app_path, spool_dir), self._config.get('smtp'), 
+                                             smtp_pool=self.smtp_pool, logger=self._logger).start()
+        return self._mail_spool
+
+
+    @property
+    def metrics(self):
+        """Instrumentation of functions decorated by log() if config log.instrument is true, else None.
+        It's shared by AppTools of the same app_name.
+        1 of every log.instrument_sample (default 1) calls is timed, metrics are written into log.metrics_file 
+        (relative to app path) every log.metrics_interval (default 15) seconds, 
+        and served at http://{log.metrics_host}:{log.metrics_port}/metrics if log.metrics_port is set.
+        """
+        if self._metrics is None:
+            logConfig = self._config.get('log') or {}
+            if coerce(logConfig.get('instrument', False), bool):
+                with _instrumentations_lock:
+                    metrics = _instrumentations.get(self._app_name)
+                    if metrics is None:
+                        metrics = Instrumentation(self._app_name, coerce(logConfig.get('instrument_sample', 1), int))
+                        self._export_metrics(metrics, logConfig)
+                        _instrumentations[self._app_name] = metrics
+                self._metrics = metrics
+        return self._metrics
+
+
+    def _export_metrics(self, metrics: Instrumentation, logConfig: dict):
+        if logConfig.get('metrics_file'):
+            metrics.export_to_file(path.join(self._app_path, logConfig['metrics_file']), 
+                                   coerce(logConfig.get('metrics_interval', 15), float))
+        if logConfig.get('metrics_port'):
+            port = coerce(logConfig['metrics_port'], int)
+            host = logConfig.get('metrics_host', '127.0.0.1')
+            try:
+                metrics.serve(port, host)
+            except OSError as ex:
+                # Ex. port is used by another process, functions are still instrumented
+                self._logger.error(f'Failed to serve metrics at {host}:{port}: {ex!r}')
+
+
+    @property
+    def unused_env_vars(self):
+        """Env vars prefixed with APP_NAME_ but matching no config key, usually typos.
+        """
+        return self._unused_env_vars
+
+
     def _use_env_var(self, config: dict, parent_key: str) -> dict:
         """Replace config variable with env
+        os.environ is scanned once for keys prefixed with parent_key, then only config branches having env are visited.
+        Containers having replaced items are copied (tuple becomes list), others are shared with config.
 
         Args:
             config (dict): config dict
@@ -55,26 +400,46 @@ class AppTool(object):
         Returns:
             dict: result
         """
-        if type(config) is tuple:
-            config = list(config)
-
-        if type(config) is dict:
-            for key in config.keys():
-                full_key = (parent_key + '_' + re.sub(r'\W+', '_', key)).upper()
-                if full_key in os.environ.keys():
-                    config[key] = os.environ.get(full_key)
-                elif type(config[key]) in (list, dict, tuple):
-                    config[key] = self._use_env_var(config[key], full_key)
-        elif type(config) is list:
-            for index, _ in enumerate(config):
-                full_key = (parent_key + '_' + str(index)).upper()
-                if full_key in os.environ.keys():
-                    config[index] = os.environ.get(full_key)
-                elif type(config[index]) in (list, dict, tuple):
-                    config[index] = self._use_env_var(config[index], full_key)
+        prefix = parent_key.upper() + '_'
+        env_trie = {}
+        env_keys = []
+        for env_key, env_value in os.environ.items():
+            if env_key.startswith(prefix):
+                env_keys.append(env_key)
+                node = env_trie
+                for part in env_key[len(prefix):].split('_'):
+                    node = node.setdefault(part, {})
+                node[_ENV_VAR] = (env_key, env_value)
+
+        used_env_keys = set()
+        if env_trie:
+            convert = self._convert_env if self._schema or self._coerce_env else None
+            config = _overlay_env(config, env_trie, used_env_keys, convert)
+
+        env_key = re.sub(r'\W+', '_', self._app_name.upper()) + '_ENV'
+        self._unused_env_vars = sorted(key for key in env_keys if key not in used_env_keys and key != env_key)
         return config
 
 
+    def _convert_env(self, key: str, value, env_key: str, env_value: str):
+        """Coerce env value by schema, or to type of value it replaces if coerce_env.
+        Converter is resolved once per key and type of replaced value.
+        """
+        cache_key = (key, type(value))
+        target = self._env_converters.get(cache_key, _MISSING)
+        if target is _MISSING:
+            target = self._schema.get(key)
+            if target is None and self._coerce_env and value is not None:
+                target = type(value)
+            self._env_converters[cache_key] = target
+        if target is None:
+            return env_value
+        try:
+            return coerce(env_value, target)
+        except AppToolError as ex:
+            raise AppToolError(f'Invalid env {env_key} for config "{key}": {ex}')
+
+
     def load_config(self, local_config_dir: str = '', config_name: str='config', read_env:bool=True) -> dict:
         """Load config locally then replace some with env value if NOT ignore_env
         NOTE! 
@@ -82,6 +447,8 @@ class AppTool(object):
             - ANY char which is NOT A-Za-z0-9_ , that's say \\w in re, will be replaced by '_'
             Ex. a.b             -> APP_A
                 a.b[0][1].e'    -> APP_A_B_0_1_E
+            - config modules are looked up by file in app path then local config dir, 
+              they are executed without being imported, so sys.path and sys.modules are untouched.
 
         Keyword Arguments:
             local_config_dir {str} -- Dir name of local config files. (default: {''})
@@ -91,36 +458,205 @@ class AppTool(object):
         """
         assert(type(local_config_dir) == str)
 
-        sys.path.append(self._app_path)
-        try:
-            self._config = __import__(config_name).CONFIG
-        except Exception:
-            self._config = {}
-
         config_local_path = path.join(self._app_path, local_config_dir)
-        sys.path.append(config_local_path)
-        try:
-            config_local = __import__(config_name + '_local').CONFIG
-            self._config = deep_merge(self._config, config_local)
-        except Exception:
-            pass
-        
+
+        module_names = [config_name, config_name + '_local']
         env_key = re.sub(r'\W+', '_', self._app_name.upper())
         env = os.environ.get(env_key + '_ENV')
         if env:
+            module_names.append(config_name + f'_{env}')
+
+        with self._reload_lock:
+            self._config_dirs = (self._app_path, config_local_path)
+            self._config_modules = module_names
+            self._read_env = read_env
+            self._layers = [self._import_config(name) for name in module_names]
+            self._layer_stats = [self._stat_config(name) for name in module_names]
+            self._merged_layers = [None] * len(module_names)
+            self._merge_config(0)
+        return self._config
+
+
+    def _find_config(self, module_name: str) -> str:
+        """Find file path of config module in app path then local config path, None if not found.
+        """
+        for dir_path in self._config_dirs:
+            file_path = path.join(dir_path, module_name + '.py')
+            if path.isfile(file_path):
+                return file_path
+        return None
+
+
+    def _import_config(self, module_name: str) -> dict:
+        """Execute config module by file path and return its CONFIG, {} if file does not exist.
+
+        Raises:
+            AppToolError: If config module fails or has no CONFIG.
+        """
+        file_path = self._find_config(module_name)
+        if file_path is None:
+            return {}
+        try:
+            return exec_config(file_path, self._config_dirs, self._config_modules)['CONFIG']
+        except Exception as ex:
+            raise AppToolError(f'Failed to load config from {file_path}: {ex!r}') from ex
+
+
+    def _stat_config(self, module_name: str) -> tuple:
+        """Get (file path, mtime, size) of config module for change detection, None if file does not exist.
+        """
+        file_path = self._find_config(module_name)
+        try:
+            stat = os.stat(file_path)
+            return (file_path, stat.st_mtime_ns, stat.st_size)
+        except (OSError, TypeError):
+            return None
+
+
+    def _merge_config(self, start: int):
+        """Re-merge config layers from layer at start, then swap config (and snapshot) atomically.
+        Merged result of each layer is kept, so only the changed layer and layers above it are re-merged.
+        Config shares untouched items with merged results, only its top level is always a new dictionary,
+        so replacing a top-level item of config in place does not change merged results re-merged from.
+        """
+        for index in range(start, len(self._layers)):
+            if index == 0:
+                self._merged_layers[index] = self._layers[index]
+            else:
+                self._merged_layers[index] = deep_merge(self._merged_layers[index - 1], self._layers[index])
+
+        config = self._merged_layers[-1]
+        if self._read_env:
+            config = self._use_env_var(config, self._app_name)
+        if self._overrides:
+            config = deep_merge(config, self._overrides)
+        if config is self._merged_layers[-1]:
+            config = dict(config)
+        if self._frozen:
+            self._snapshot = MappingProxyType(flatten(config, '#'))
+        self._config = config
+
+
+    def reload_config(self, force: bool=False) -> set:
+        """Reload config modules which are changed (by mtime and size of file), 
+        then re-merge from the lowest changed layer and notify subscribers if any config item is changed.
+        Readers on other threads see either the old or the new config, never a half-merged one.
+
+        Keyword Arguments:
+            force {bool} -- Reload all config modules even if files are not changed. (default: {False})
+
+        Returns:
+            [set] -- Keys of changed config items, connected by dot (dot in key is replaced by '#').
+        """
+        with self._reload_lock:
+            # Layers are swapped only if all changed ones are imported, so a broken file is tried again by next reload
+            changed_layers = {}
+            for index, module_name in enumerate(self._config_modules):
+                stat = self._stat_config(module_name)
+                if force or stat != self._layer_stats[index]:
+                    changed_layers[index] = (self._import_config(module_name), stat)
+            if not changed_layers:
+                return set()
+            for index, (layer, stat) in changed_layers.items():
+                self._layers[index] = layer
+                self._layer_stats[index] = stat
+
+            old_config = self._config
+            self._merge_config(min(changed_layers))
+            changed_keys = diff_keys(old_config, self._config)
+
+        self._notify(changed_keys)
+        return changed_keys
+
+
+    def override(self, key: str, value) -> set:
+        """Override config item at runtime, the override is kept after config is reloaded.
+        Only containers along the key path are copied, readers see either the old or the new config.
+
+        Arguments:
+            key {str} -- Key connected by dot, dot in key is replaced by '#'.
+            value {any} -- New value
+
+        Returns:
+            [set] -- Keys of changed config items.
+        """
+        with self._reload_lock:
+            old_config = self._config
+            self._overrides = put(self._overrides, key, value, '#')
+            self._merge_config(len(self._layers))
+            changed_keys = diff_keys(old_config, self._config)
+
+        self._notify(changed_keys)
+        return changed_keys
+
+
+    def _notify(self, changed_keys: set):
+        if not changed_keys:
+            return
+        for callback in list(self._subscribers):
             try:
-                config_test = __import__(config_name + f'_{env}').CONFIG
-                self._config = deep_merge(self._config, config_test)
+                callback(changed_keys)
             except Exception:
-                pass
-        
-        if read_env:
-            self._use_env_var(self._config, self._app_name)
-        return self._config
+                if self._logger:
+                    self._logger.exception(f'Failed to notify config change to {callback}')
+
+
+    def subscribe(self, callback):
+        """Register callback(changed_keys: set) to be called after config is reloaded and changed.
+        """
+        self._subscribers.append(callback)
+        return callback
+
+
+    def unsubscribe(self, callback):
+        self._subscribers.remove(callback)
+
+
+    def watch_config(self, interval: float=1.0) -> threading.Thread:
+        """Start a daemon thread which polls config files and reloads config when changed.
+
+        Keyword Arguments:
+            interval {float} -- Seconds between polls. (default: {1.0})
+        """
+        if self._watcher and self._watcher.is_alive():
+            return self._watcher
+
+        stopped = threading.Event()
+        def watch():
+            while not stopped.wait(interval):
+                try:
+                    self.reload_config()
+                except Exception:
+                    if self._logger:
+                        self._logger.exception('Failed to reload config')
+
+        self._watcher = threading.Thread(target=watch, name=f'{self._app_name}-config-watcher', daemon=True)
+        self._watcher.stopped = stopped
+        self._watcher.start()
+        return self._watcher
+
+
+    def stop_watching(self):
+        if self._watcher:
+            self._watcher.stopped.set()
+            self._watcher.join()
+            self._watcher = None
 
 
     def init_logger(self) -> logging.Logger:
         """Initialize logger
+        If config log.async is true, handlers are run by a listener thread, logging calls only put records into a queue
+        of log.queue_size (default 10000), log.overflow decides what to do when it's full: 
+        block (default), drop_oldest or drop_debug.
+        Log file is rotated by log.max_bytes (default 0, no limit) and every log.rotate_interval (default 1) 
+        log.rotate_when (S, M, H or D (default)), rotated files are compressed by log.compress (gzip, zstd or None (default))
+        and pruned by log.backup_count (default 7) and log.max_total_bytes (default 0, no limit) in background.
+        File and stdout are formatted by log.format: text (default) or json (a JSON object a line), 
+        error mails are always text.
+        It can be called again (Ex. after config reloaded), handlers of unchanged settings are kept, 
+        handlers of removed or changed log.dest are closed. Handlers are shared by AppTools of the same app_name.
+        Error mails are sent as a digest of records in log.mail_window seconds (default 60, 0 for a mail per record),
+        at most log.mail_per_minute (default 6) mails a minute.
         
         Returns:
             [logger] -- Initialized logger.
@@ -139,17 +675,30 @@ class AppTool(object):
         logger.setLevel(logLevel)
 
         logDest = logConfig.get('dest', [])
+        logFormat = logConfig.get('format', 'text')
+        formatter = _log_formatter(logFormat)
+        # [(dest, settings, factory)], handler of dest is created by factory() only if its settings are changed
+        wanted = []
 
         if 'file' in logDest:
-            rf_handler = handlers.TimedRotatingFileHandler(path.join(logs_path, f'{self._app_name}.log'), when='D', interval=1, backupCount=7)
-            rf_handler.suffix = "%Y-%m-%d_%H-%M-%S.log"
-            rf_handler.level = logging.INFO
-            rf_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
-            logger.addHandler(rf_handler)
+            file_path = path.abspath(path.join(logs_path, f'{self._app_name}.log'))
+            rotation = dict(
+                max_bytes = coerce(logConfig.get('max_bytes', 0), int),
+                when = logConfig.get('rotate_when', 'D') or None,
+                interval = coerce(logConfig.get('rotate_interval', 1), int),
+                backup_count = coerce(logConfig.get('backup_count', 7), int),
+                compress = logConfig.get('compress') or None,
+                max_total_bytes = coerce(logConfig.get('max_total_bytes', 0), int))
+            def rf_factory():
+                rf_handler = RotatingCompressedFileHandler(file_path, **rotation)
+                rf_handler.level = logging.INFO
+                rf_handler.setFormatter(formatter)
+                return rf_handler
+            wanted.append(('file', (file_path, tuple(sorted(rotation.items())), logFormat), rf_factory))
 
         if smtp and 'mail' in logDest:
+            smtp = coerce_config(smtp, SMTP_SCHEMA, 'smtp')
             from_addr = mail.get('from', formataddr((smtp['user'], smtp['user'])))
-            #TODO: Use schema to validate smtp
             assert type(from_addr) in (str, tuple, list)
             if type(from_addr) in (tuple, list):
                 assert len(from_addr) == 2
@@ -183,32 +732,53 @@ class AppTool(object):
             # else: 
             # Ex. to_addrs == 'Henry TIAN <chariothy@gmail.com>,Henry TIAN <6314849@qq.com>'
 
-            mail_handler = MySMTPHandler(
-                    mailhost = (smtp['host'], smtp['port']),
-                    fromaddr = from_addr,
-                    toaddrs = to_addrs,
-                    subject = '%(name)s - %(levelname)s - %(message)s',
-                    credentials = (smtp['user'], smtp['pwd']))
-            mail_handler.setLevel(logging.ERROR)
-            logger.addHandler(mail_handler)
+            mail_window = coerce(logConfig.get('mail_window', 60), float)
+            mail_per_minute = coerce(logConfig.get('mail_per_minute', 6), int)
+            def mail_factory():
+                if mail_window > 0:
+                    mail_handler = DigestSMTPHandler(smtp, from_addr, to_addrs, 
+                            subject = '%(name)s - %(levelname)s - %(message)s',
+                            window = mail_window,
+                            max_per_minute = mail_per_minute,
+                            smtp_pool = self.smtp_pool)
+                else:
+                    mail_handler = MySMTPHandler(
+                            mailhost = (smtp['host'], smtp['port']),
+                            fromaddr = from_addr,
+                            toaddrs = to_addrs,
+                            subject = '%(name)s - %(levelname)s - %(message)s',
+                            credentials = (smtp['user'], smtp['pwd']))
+                mail_handler.setLevel(logging.ERROR)
+                return mail_handler
+            wanted.append(('mail', (tuple(sorted(smtp.items())), from_addr, to_addrs, mail_window, mail_per_minute), mail_factory))
 
         if 'stdout' in logDest:
-            st_handler = logging.StreamHandler()
-            st_handler.level = logging.DEBUG
-            st_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
-            logger.addHandler(st_handler)
+            def st_factory():
+                st_handler = logging.StreamHandler()
+                st_handler.level = logging.DEBUG
+                st_handler.setFormatter(formatter)
+                return st_handler
+            wanted.append(('stdout', (logFormat,), st_factory))
+
+        queue_settings = None
+        if coerce(logConfig.get('async', False), bool):
+            queue_settings = (coerce(logConfig.get('queue_size', 10000), int), logConfig.get('overflow', 'block'))
+
+        with _owned_loggers_lock:
+            self._queue_logging = _reconcile_handlers(logger, wanted, queue_settings)
         self._logger = logger
+        self._bind_log_methods()
         return logger
 
 
     def send_email(self, subject: str, text_body: str='', to_addrs=None, html_body: str=None, 
         image_paths: Union[dict, tuple]=None, file_paths: Union[dict, tuple]=None, 
         debug: bool=False, send_to_file: bool=False, email_file_dir=None) -> dict:
-        """A shortcut of global send_email
+        """A shortcut of global send_email, SMTP session is reused by smtp_pool,
+        email is put into mail_spool instead if config mail.spool_dir is set.
         """
         smtp = self._config.get('smtp')
         mail = self._config.get('mail')
-        #TODO: Use schema to validate smtp_config
         assert(smtp and mail)
         mail_to = to_addrs if to_addrs else mail['to']
         return send_email(mail['from'], mail_to, subject, 
@@ -219,41 +789,138 @@ class AppTool(object):
             file_paths=file_paths,
             debug=debug,
             send_to_file=send_to_file,
-            email_file_dir=email_file_dir
+            email_file_dir=email_file_dir,
+            smtp_pool=self.smtp_pool,
+            spool=self.mail_spool
         )
 
 
+    async def send_email_async(self, subject: str, text_body: str='', to_addrs=None, html_body: str=None, 
+        image_paths: Union[dict, tuple]=None, file_paths: Union[dict, tuple]=None, 
+        debug: bool=False, send_to_file: bool=False, email_file_dir=None, timeout: float=60) -> dict:
+        """A shortcut of global send_email_async, 
+        sends in progress are bounded by config smtp.concurrency (default 10) for each event loop.
+        """
+        smtp = self._config.get('smtp')
+        mail = self._config.get('mail')
+        assert(smtp and mail)
+        mail_to = to_addrs if to_addrs else mail['to']
+        semaphore = loop_semaphore(self._async_semaphores, coerce(smtp.get('concurrency', 10), int))
+        return await send_email_async(mail['from'], mail_to, subject, 
+            text_body=text_body, 
+            smtp_config=smtp, 
+            html_body=html_body,
+            image_paths=image_paths,
+            file_paths=file_paths,
+            debug=debug,
+            send_to_file=send_to_file,
+            email_file_dir=email_file_dir,
+            timeout=timeout,
+            semaphore=semaphore
+        )
+
+
+    def send_emails(self, messages, subject: str='', text_body: str='', html_body: str=None, 
+        image_paths: Union[dict, tuple]=None, file_paths: Union[dict, tuple]=None, 
+        sessions: int=2, messages_per_session: int=100, 
+        debug: bool=False, send_to_file: bool=False, email_file_dir=None) -> list:
+        """A shortcut of global send_emails, SMTP sessions are reused by smtp_pool
+        """
+        smtp = self._config.get('smtp')
+        mail = self._config.get('mail')
+        assert(smtp and mail)
+        return send_emails(mail['from'], messages, subject, 
+            text_body=text_body, 
+            smtp_config=smtp, 
+            html_body=html_body,
+            image_paths=image_paths,
+            file_paths=file_paths,
+            sessions=sessions,
+            messages_per_session=messages_per_session,
+            debug=debug,
+            send_to_file=send_to_file,
+            email_file_dir=email_file_dir,
+            smtp_pool=self.smtp_pool
+        )
+
+
+    def _log(self, level: int, msg, args: tuple, kwargs: dict):
+        """Keyword arguments other than those of Logger.log() are fields of record,
+        which are appended to text or put into JSON only if level is enabled.
+        Ex. APP.info('Synced', count=3, elapsed=0.5)
+        """
+        if self._logger.isEnabledFor(level):
+            _make_log_method(self._logger, level)(msg, *args, **kwargs)
+
+
+    def _bind_log_methods(self):
+        """Bind debug(), info() etc. on instance: a no-op if level is disabled, else a checked call of Logger._log().
+        Called by init_logger() and set_level(), and by a no-op once levels are changed by others.
+        """
+        logger = self._logger
+        # Level cache is new in Python 3.7, all levels are checked on each call before
+        has_cache = hasattr(logger, '_cache')
+        for name, level in _LOG_METHODS:
+            if logger.isEnabledFor(level) or not has_cache:
+                setattr(self, name, _make_log_method(logger, level, exc_info=name == 'ex'))
+            else:
+                setattr(self, name, _make_log_nop(self, name))
+
+
+    def set_level(self, level):
+        """Set level of logger, and rebind debug(), info() etc.
+
+        Arguments:
+            level {int|str} -- Ex. logging.INFO or 'INFO'
+        """
+        self._logger.setLevel(level)
+        self._bind_log_methods()
+
+
+    def report_timings(self, level: int=logging.INFO, registry=None):
+        """Log statistics of functions decorated by @benchmark, a line per function.
+
+        Keyword Arguments:
+            level {int} -- Log level (default: {logging.INFO})
+            registry {TimingRegistry} -- Registry to report (default: {timing.timings})
+        """
+        (registry if registry is not None else timings).report(self._logger, level)
+
+
+    # Level methods below are shadowed by ones bound on instance by _bind_log_methods()
     def debug(self, msg, *args, **kwargs):
-        self._logger.debug(msg, *args, **kwargs)
+        self._log(logging.DEBUG, msg, args, kwargs)
 
 
     def info(self, msg, *args, **kwargs):
-        self._logger.info(msg, *args, **kwargs)
+        self._log(logging.INFO, msg, args, kwargs)
 
 
     def warn(self, msg, *args, **kwargs):
-        self._logger.warn(msg, *args, **kwargs)
+        self._log(logging.WARNING, msg, args, kwargs)
 
 
     def error(self, msg, *args, **kwargs):
-        self._logger.error(msg, *args, **kwargs)
+        self._log(logging.ERROR, msg, args, kwargs)
 
 
     def err(self, msg, *args, **kwargs):
-        self._logger.error(msg, *args, **kwargs)
+        self._log(logging.ERROR, msg, args, kwargs)
 
 
     def ex(self, msg, *args, **kwargs):
-        self._logger.exception(msg, *args, **kwargs)
+        kwargs.setdefault('exc_info', True)
+        self._log(logging.ERROR, msg, args, kwargs)
 
 
     def fatal(self, msg, *args, **kwargs):
-        self._logger.fatal(msg, *args, **kwargs)
+        self._log(logging.CRITICAL, msg, args, kwargs)
 
 
     def log(self, throw=False, message=''):
         """Decorator
         !!! Should be decorated first to avoid being shielded by other decorators, such as @click.
+        Calls, errors and time of decorated function are recorded by metrics if config log.instrument is true.
         
         Keyword Arguments:
             throw {bool} -- Re-raise exception (default: {False})
@@ -276,21 +943,33 @@ class AppTool(object):
                 pass
         """
         def decorator(func):
+            metrics = self.metrics
+            target = metrics.instrument(func) if metrics is not None else func
             @functools.wraps(func)
             def wrapper(*args, **kw):
                 try:
-                    return func(*args, **kw)
+                    return target(*args, **kw)
                 except Exception as ex:
                     self._logger.exception(message if message else str(ex))
                     if throw:
                         raise ex
+            if metrics is not None:
+                wrapper.metrics = target.metrics
             return wrapper
         return decorator
 
 
     def get(self, key:str, default=None, check:bool=False, replacement_for_dot_in_key:str='#'):
+        if self._snapshot is not None and replacement_for_dot_in_key == '#':
+            value = self._snapshot.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
         return get(self._config, key, default, check, replacement_for_dot_in_key)
 
 
     def __getitem__(self, key):
-        return self.get(key, replacement_for_dot_in_key='#', check=True)
\ No newline at end of file
+        if self._snapshot is not None:
+            value = self._snapshot.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+        return get(self._config, key, check=True, replacement_for_dot_in_key='#')
\ No newline at end of file
@@ -0,0 +1,276 @@
+import asyncio
+import base64
+import logging
+import re
+import weakref
+from smtplib import (SMTPServerDisconnected, SMTPResponseException, SMTPAuthenticationError,
+                     SMTPSenderRefused, SMTPRecipientsRefused, SMTPDataError, SMTPNotSupportedError)
+from typing import Union
+
+from . import email_assets
+from .utils import coerce_config, SMTP_SCHEMA
+from .utils import _format_addrs, _load_images, _load_attachments, _build_message, _write_email_file, _prepare_email_file_dir
+
+
+ASYNC_SMTP_CONCURRENCY = 10
+_REG_PERIOD = re.compile(br'(?m)^\.')
+_semaphores = weakref.WeakKeyDictionary()    # {loop: default semaphore}
+# Python 3.6 has no get_running_loop(), where get_event_loop() returns running loop in coroutine too
+_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+_logger = logging.getLogger(__name__)
+
+
+def loop_semaphore(semaphores: weakref.WeakKeyDictionary, size: int) -> asyncio.Semaphore:
+    """Semaphore of size for running event loop, kept in semaphores.
+    """
+    loop = _running_loop()
+    semaphore = semaphores.get(loop)
+    if semaphore is None:
+        semaphore = semaphores[loop] = asyncio.Semaphore(size)
+    return semaphore
+
+
+class AsyncSMTP(object):
+    """Minimal non-blocking SMTP client on asyncio streams, enough for send_email_async().
+    SMTP conversation is logged at DEBUG level by logger if debug.
+    Ex.
+        smtp = AsyncSMTP(debug=True)
+        await smtp.connect(smtp_config)
+        result = await smtp.send_message(msg)
+        await smtp.quit()
+    """
+    def __init__(self, debug: bool=False, logger: logging.Logger=None):
+        self.debug = debug
+        self.logger = logger if logger is not None else _logger
+        self.esmtp_features = {}
+        self._reader = None
+        self._writer = None
+
+
+    async def connect(self, smtp_config: dict):
+        """Connect to SMTP server (ssl / tls / plain like send_email()) then login.
+        """
+        ssl = smtp_config.get('type') == 'ssl'
+        self._reader, self._writer = await asyncio.open_connection(smtp_config['host'], smtp_config['port'], ssl=ssl or None)
+        await self._expect(220)
+        await self.ehlo()
+        if smtp_config.get('type') == 'tls':
+            if not hasattr(self._writer, 'start_tls'):
+                raise SMTPNotSupportedError('STARTTLS on asyncio streams needs Python >= 3.11.')
+            await self.command('STARTTLS', 220)
+            import ssl as ssl_module
+            await self._writer.start_tls(ssl_module.create_default_context(), server_hostname=smtp_config['host'])
+            await self.ehlo()
+        await self.login(smtp_config['user'], smtp_config['pwd'])
+
+
+    async def ehlo(self):
+        code, reply = await self.command('EHLO localhost')
+        if code != 250:
+            raise SMTPResponseException(code, reply)
+        self.esmtp_features = {}
+        for line in reply.decode('ascii', 'replace').split('\n')[1:]:
+            feature, _, params = line.partition(' ')
+            self.esmtp_features[feature.lower()] = params
+
+
+    async def login(self, user: str, pwd: str):
+        auth = self.esmtp_features.get('auth', '').upper().split()
+        if 'PLAIN' in auth:
+            token = base64.b64encode(f'\0{user}\0{pwd}'.encode('utf-8')).decode('ascii')
+            code, reply = await self.command(f'AUTH PLAIN {token}')
+        elif 'LOGIN' in auth:
+            await self.command('AUTH LOGIN ' + base64.b64encode(user.encode('utf-8')).decode('ascii'), 334)
+            code, reply = await self.command(base64.b64encode(pwd.encode('utf-8')).decode('ascii'))
+        else:
+            raise SMTPNotSupportedError('No suitable authentication method found.')
+        if code not in (235, 503):
+            raise SMTPAuthenticationError(code, reply)
+
+
+    async def send_message(self, msg) -> dict:
+        """Send EmailMessage to receivers in To, Cc and Bcc like SMTP.send_message().
+
+        Returns:
+            dict -- {} if success, else {receiver: (code, message)} of refused receivers.
+        """
+        return await self.sendmail(*message_envelope(msg))
+
+
+    async def sendmail(self, from_addr: str, receivers: list, data) -> dict:
+        """Send data (encoded message with CRLF line ends) like SMTP.sendmail(),
+        data can also be an iterator of dot-stuffed chunks, which are read in executor.
+
+        Returns:
+            dict -- {} if success, else {receiver: (code, message)} of refused receivers.
+        """
+        code, reply = await self.command(f'MAIL FROM:<{from_addr}>')
+        if code != 250:
+            await self._rset()
+            raise SMTPSenderRefused(code, reply, from_addr)
+        refused = {}
+        for receiver in receivers:
+            code, reply = await self.command(f'RCPT TO:<{receiver}>')
+            if code not in (250, 251):
+                refused[receiver] = (code, reply)
+        if len(refused) == len(receivers):
+            await self._rset()
+            raise SMTPRecipientsRefused(refused)
+
+        await self.command('DATA', 354)
+        if isinstance(data, bytes):
+            data = _REG_PERIOD.sub(b'..', data)
+            if not data.endswith(b'\r\n'):
+                data += b'\r\n'
+            self._write(data)
+        else:
+            loop = _running_loop()
+            chunks = iter(data)
+            while True:
+                chunk = await loop.run_in_executor(None, next, chunks, None)
+                if chunk is None:
+                    break
+                self._write(chunk)
+                await self._writer.drain()
+        self._write(b'.\r\n')
+        code, reply = await self._read_reply()
+        if code != 250:
+            await self._rset()
+            raise SMTPDataError(code, reply)
+        return refused
+
+
+    async def quit(self):
+        try:
+            await self.command('QUIT')
+        finally:
+            self.close()
+
+
+    def close(self):
+        """Close connection at once, safe to be called in any state.
+        """
+        writer, self._writer, self._reader = self._writer, None, None
+        if writer is not None:
+            writer.close()
+
+
+    async def command(self, line: str, expected: int=None) -> tuple:
+        self._write(line.encode('utf-8') + b'\r\n')
+        if expected is None:
+            return await self._read_reply()
+        return await self._expect(expected)
+
+
+    def _write(self, data: bytes):
+        if self._writer is None:
+            raise SMTPServerDisconnected('please run connect() first')
+        if self.debug:
+            self.logger.debug('send: %r', data[:512])
+        self._writer.write(data)
+
+
+    async def _read_reply(self) -> tuple:
+        if self._reader is None:
+            raise SMTPServerDisconnected('please run connect() first')
+        await self._writer.drain()
+        lines = []
+        while True:
+            line = await self._reader.readline()
+            if not line:
+                self.close()
+                raise SMTPServerDisconnected('Connection unexpectedly closed')
+            if self.debug:
+                self.logger.debug('reply: %r', line)
+            lines.append(line[4:].strip())
+            if line[3:4] != b'-':
+                break
+        try:
+            code = int(line[:3])
+        except ValueError:
+            code = -1
+        return code, b'\n'.join(lines)
+
+
+    async def _expect(self, expected: int) -> tuple:
+        code, reply = await self._read_reply()
+        if code != expected:
+            raise SMTPResponseException(code, reply)
+        return code, reply
+
+
+    async def _rset(self):
+        try:
+            await self.command('RSET')
+        except SMTPServerDisconnected:
+            pass
+
+
+def message_envelope(msg) -> tuple:
+    """(from address, receivers in To, Cc and Bcc, encoded message without Bcc) of EmailMessage for sendmail().
+    Encoded message is an iterator of dot-stuffed chunks if it has StreamedPart.
+    """
+    from email.policy import SMTP
+    from_addr, receivers, msg = email_assets.message_envelope(msg)
+    if email_assets.has_streamed_part(msg):
+        return from_addr, receivers, email_assets.iter_message_bytes(msg, dot_stuffing=True)
+    return from_addr, receivers, msg.as_bytes(policy=SMTP)
+
+
+async def send_email_async(from_addr, to_addrs, subject: str, text_body: str='', smtp_config: dict={},
+    html_body: str=None,
+    image_paths: Union[dict, tuple]=None, file_paths: Union[dict, tuple]=None,
+    debug: bool=False, send_to_file: bool=False, email_file_dir=None,
+    timeout: float=60, semaphore: asyncio.Semaphore=None
+    ) -> dict:
+    """Async counterpart of send_email(), SMTP I/O does not block the event loop.
+    At most ASYNC_SMTP_CONCURRENCY sends of an event loop are in progress at the same time,
+    unless a semaphore is given. The connection is closed if the send is cancelled or times out.
+
+    Arguments:
+        Same as send_email()
+
+    Keyword Arguments:
+        timeout {float} -- Seconds for the whole SMTP conversation, not including waiting for semaphore,
+            asyncio.TimeoutError is raised if exceeded (default: {60})
+        semaphore {asyncio.Semaphore} -- Bounds sends in progress (default: {None})
+
+    Returns:
+        dict -- Email sending errors. {} if success, else {receiver: message}.
+    """
+    assert(type(subject) is str)
+    assert(type(text_body) is str or type(html_body) is str)
+    assert(type(smtp_config) is dict)
+
+    loop = _running_loop()
+    from_addr, to_addrs = _format_addrs(from_addr, to_addrs)
+    if semaphore is None:
+        semaphore = loop_semaphore(_semaphores, ASYNC_SMTP_CONCURRENCY)
+    async with semaphore:
+        # Message is built with semaphore held, so a burst of sends does not build all messages in one go.
+        # It's built and encoded in executor, which is CPU bound or reads files.
+        def build():
+            msg = _build_message(from_addr, to_addrs, subject, text_body, html_body,
+                                 _load_images(image_paths) if html_body else None, _load_attachments(file_paths))
+            if send_to_file or debug:
+                _write_email_file(msg, _prepare_email_file_dir(email_file_dir) if send_to_file else email_file_dir)
+            return None if send_to_file else message_envelope(msg)
+        envelope = await loop.run_in_executor(None, build)
+        result = {}
+
+        if not send_to_file:
+            smtp_config = coerce_config(smtp_config, SMTP_SCHEMA, 'smtp_config')
+            smtp = AsyncSMTP(debug)
+            try:
+                result = await asyncio.wait_for(_send(smtp, smtp_config, envelope), timeout)
+            finally:
+                # Cancelled, timed out or failed
+                smtp.close()
+    return result
+
+
+async def _send(smtp: AsyncSMTP, smtp_config: dict, envelope: tuple) -> dict:
+    await smtp.connect(smtp_config)
+    result = await smtp.sendmail(*envelope)
+    await smtp.quit()
+    return result
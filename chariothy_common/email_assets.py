@@ -0,0 +1,218 @@
+import base64
+import copy
+import os
+import re
+import threading
+from collections import OrderedDict
+from email.message import MIMEPart
+from email.utils import getaddresses
+from smtplib import SMTP, SMTPSenderRefused, SMTPRecipientsRefused, SMTPDataError, SMTPServerDisconnected
+
+
+STREAM_CHUNK_SIZE = 57 * 1024       # Multiple of 57 bytes, which is a base64 line of 76 chars
+_REG_PERIOD = re.compile(br'(?m)^\.')
+
+
+class StreamedPart(MIMEPart):
+    """Attachment whose file is base64 encoded in chunks while the message is written or sent,
+    its payload is only a placeholder.
+    """
+    def __init__(self, path: str, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.path = path
+        self.placeholder = f'chariothy_common-stream-{id(self):x}'
+
+
+    def iter_base64(self, chunk_size: int=STREAM_CHUNK_SIZE):
+        with open(self.path, 'rb') as fp:
+            while True:
+                chunk = fp.read(chunk_size)
+                if not chunk:
+                    break
+                yield base64.encodebytes(chunk).replace(b'\n', b'\r\n')
+
+
+class AssetCache(object):
+    """MIME parts of small files, keyed by (path, mtime, size) and evicted by LRU when over max_bytes.
+    Files larger than max_item_bytes are not cached but streamed (StreamedPart).
+    """
+    def __init__(self, max_bytes: int=32 * 1024 * 1024, max_item_bytes: int=1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self._parts = OrderedDict()     # {(kind, path, mtime_ns, size): (part, bytes)}, least recently used first
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+
+    @property
+    def bytes(self) -> int:
+        return self._bytes
+
+
+    def __len__(self):
+        return len(self._parts)
+
+
+    def get(self, path: str, make_part, kind: str=''):
+        """MIME part of file at path, make_part(path, content: bytes or None if streamed) is called if not cached.
+        Parts of the same file are cached separately by kind, Ex. 'image' and 'attachment'.
+        """
+        stat = os.stat(path)
+        if stat.st_size > self.max_item_bytes:
+            return make_part(path, None)
+
+        key = (kind, os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._parts.get(key)
+            if cached is not None:
+                self._parts.move_to_end(key)
+                return cached[0]
+
+        with open(path, 'rb') as fp:
+            content = fp.read()
+        part = make_part(path, content)
+        size = len(part.get_payload())
+        with self._lock:
+            if key not in self._parts:
+                self._parts[key] = (part, size)
+                self._bytes += size
+                while self._bytes > self.max_bytes and self._parts:
+                    _, (_, evicted_size) = self._parts.popitem(last=False)
+                    self._bytes -= evicted_size
+        return part
+
+
+    def clear(self):
+        with self._lock:
+            self._parts.clear()
+            self._bytes = 0
+
+
+asset_cache = AssetCache()
+
+
+def _guess_type(path: str) -> tuple:
+    from mimetypes import guess_type
+    ctype, encoding = guess_type(path)
+    if ctype is None or encoding is not None:
+        # No guess could be made, or the file is encoded (compressed), so
+        # use a generic bag-of-bits type.
+        ctype = 'application/octet-stream'
+    return ctype.split('/', 1)
+
+
+def _make_part(path: str, content: bytes, **kwargs) -> MIMEPart:
+    maintype, subtype = _guess_type(path)
+    if content is None:
+        part = StreamedPart(path)
+        part.set_content(b'', maintype=maintype, subtype=subtype, **kwargs)
+        part.set_payload(part.placeholder)
+    else:
+        part = MIMEPart()
+        part.set_content(content, maintype=maintype, subtype=subtype, **kwargs)
+    return part
+
+
+def image_part(path: str, cache: AssetCache=None) -> MIMEPart:
+    """Inline image part with a Content-ID, which is kept while the file is cached.
+    """
+    from email.utils import make_msgid
+    return (asset_cache if cache is None else cache).get(path, lambda path, content: _make_part(
+        path, content, disposition='inline', cid=make_msgid('chariothy_common')), 'image')
+
+
+def attachment_part(path: str, cache: AssetCache=None) -> MIMEPart:
+    return (asset_cache if cache is None else cache).get(path, lambda path, content: _make_part(
+        path, content, filename=os.path.basename(path)), 'attachment')
+
+
+def iter_message_bytes(msg, dot_stuffing: bool=False):
+    """Encode message in chunks by SMTP policy, files of StreamedPart are read and encoded chunk by chunk.
+    If dot_stuffing, leading dots of lines are doubled for SMTP DATA.
+    """
+    from email.policy import SMTP as SMTP_POLICY
+    streamed = [part for part in msg.walk() if isinstance(part, StreamedPart)]
+    data = msg.as_bytes(policy=SMTP_POLICY)
+    if dot_stuffing:
+        data = _REG_PERIOD.sub(b'..', data)
+    for part in streamed:
+        placeholder = part.placeholder.encode('ascii') + b'\r\n'
+        head, _, data = data.partition(placeholder)
+        yield head
+        yield from part.iter_base64()
+    yield data
+
+
+def has_streamed_part(msg) -> bool:
+    return any(isinstance(part, StreamedPart) for part in msg.walk())
+
+
+def message_envelope(msg) -> tuple:
+    """(from address, receivers in To, Cc and Bcc, message without Bcc) like SMTP.send_message().
+    """
+    from_addr = getaddresses(msg.get_all('Sender') or msg.get_all('From'))[0][1]
+    receivers = [addr for _, addr in getaddresses(msg.get_all('To', []) + msg.get_all('Cc', []) + msg.get_all('Bcc', []))]
+    if 'Bcc' in msg:
+        msg = copy.copy(msg)
+        del msg['Bcc']
+    return from_addr, receivers, msg
+
+
+def write_message(msg, fp):
+    for chunk in iter_message_bytes(msg):
+        fp.write(chunk)
+
+
+def send_message(server: SMTP, msg) -> dict:
+    """SMTP.send_message(), but message with StreamedPart is sent chunk by chunk.
+    """
+    if not has_streamed_part(msg):
+        return server.send_message(msg)
+
+    from_addr, receivers, msg = message_envelope(msg)
+    return send_chunks(server, from_addr, receivers, iter_message_bytes(msg, dot_stuffing=True))
+
+
+def send_chunks(server: SMTP, from_addr: str, receivers: list, chunks) -> dict:
+    """SMTP.sendmail() of a message given in chunks, which are dot-stuffed and have CRLF line ends.
+
+    Returns:
+        dict -- {receiver: (code, reply)} of refused receivers, like SMTP.sendmail()
+    """
+    server.ehlo_or_helo_if_needed()
+    code, reply = server.mail(from_addr)
+    if code != 250:
+        _rset(server, code)
+        raise SMTPSenderRefused(code, reply, from_addr)
+    refused = {}
+    for receiver in receivers:
+        code, reply = server.rcpt(receiver)
+        if code not in (250, 251):
+            refused[receiver] = (code, reply)
+        if code == 421:
+            server.close()
+            raise SMTPRecipientsRefused(refused)
+    if len(refused) == len(receivers):
+        _rset(server, code)
+        raise SMTPRecipientsRefused(refused)
+
+    code, reply = server.docmd('data')
+    if code != 354:
+        raise SMTPDataError(code, reply)
+    for chunk in chunks:
+        server.send(chunk)
+    server.send(b'.\r\n')
+    code, reply = server.getreply()
+    if code != 250:
+        raise SMTPDataError(code, reply)
+    return refused
+
+
+def _rset(server: SMTP, code: int):
+    if code == 421:
+        server.close()
+        return
+    try:
+        server.rset()
+    except SMTPServerDisconnected:
+        pass
@@ -0,0 +1,670 @@
+import atexit
+import copy
+import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from logging import handlers
+
+from .exception import AppToolError
+
+
+OVERFLOW_POLICIES = ('block', 'drop_oldest', 'drop_debug')
+_exception_formatter = logging.Formatter()
+
+
+class MySMTPHandler(handlers.SMTPHandler):
+    def getSubject(self, record):
+        #all_formatter = logging.Formatter(fmt='%(name)s - %(levelno)s - %(levelname)s - %(pathname)s - %(filename)s - %(module)s - %(lineno)d - %(funcName)s - %(created)f - %(asctime)s - %(msecs)d  %(relativeCreated)d - %(thread)d -  %(threadName)s -  %(process)d - %(message)s ')        
+        #print('Ex. >>> ',all_formatter.formatMessage(record))
+
+        #help(record)
+        #help(formatter)
+        
+        formatter = logging.Formatter(fmt=self.subject)
+        return formatter.formatMessage(record)
+
+
+class DigestSMTPHandler(MySMTPHandler):
+    """Mail handler which sends a digest of records per window instead of an email per record.
+    Records of the same (logger, level, message template, exception type) are counted instead of repeated,
+    at most max_per_minute emails are sent, digest is delayed when over the cap and keeps coalescing records.
+    Emails are sent by a timer thread over pooled SMTP session, so emit() never waits for SMTP.
+    Buffered records are always sent by close(), which is called by logging.shutdown() at exit.
+    Ex.
+        handler = DigestSMTPHandler(smtp_config, 'from@localhost', 'to@localhost', '%(name)s - %(levelname)s - %(message)s')
+    """
+    def __init__(self, smtp_config: dict, fromaddr: str, toaddrs, subject: str, 
+        window: float=60, max_per_minute: int=6, max_entries: int=100, smtp_pool=None):
+        """
+        Arguments:
+            smtp_config {dict} -- SMTP config, same as send_email()
+            fromaddr {str} -- From address
+            toaddrs {str|list} -- To addresses
+            subject {str} -- Format of subject, by the first record in digest
+
+        Keyword Arguments:
+            window {float} -- Seconds records are coalesced before a digest is sent (default: {60})
+            max_per_minute {int} -- Max digests sent in any 60 seconds (default: {6})
+            max_entries {int} -- Max distinct records in a digest, more are only counted (default: {100})
+            smtp_pool {SMTPPool} -- SMTP sessions to reuse (default: {a new SMTPPool})
+        """
+        from .smtp_pool import SMTPPool
+        from .utils import coerce_config, SMTP_SCHEMA
+        smtp_config = coerce_config(smtp_config, SMTP_SCHEMA, 'smtp_config')
+        super().__init__((smtp_config['host'], smtp_config['port']), fromaddr, toaddrs, subject, 
+                         credentials=(smtp_config['user'], smtp_config['pwd']),
+                         secure=() if smtp_config.get('type') == 'tls' else None)
+        self.smtp_config = smtp_config
+        self.window = window
+        self.max_per_minute = max_per_minute
+        self.max_entries = max_entries
+        # A given pool is shared (Ex. by AppTool.send_email), only a pool created here is closed by close()
+        self._owns_pool = smtp_pool is None
+        self.smtp_pool = smtp_pool if smtp_pool is not None else SMTPPool(idle_timeout=max(60, window * 2))
+        self._entries = OrderedDict()   # {key: [formatted record, subject, count, first created, last created]}
+        self._omitted = 0
+        self._sent_times = deque()      # time.monotonic() of digests sent in last minute
+        self._buffer_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._timer = None
+
+
+    @staticmethod
+    def digest_key(record) -> tuple:
+        """(logger, level, message template, exception type), kept by BoundedQueueHandler.prepare() for queued record.
+        """
+        key = getattr(record, '_digest_key', None)
+        if key is not None:
+            return key
+        exc_type = record.exc_info[0].__name__ if record.exc_info and record.exc_info[0] else None
+        return (record.name, record.levelno, str(record.msg), exc_type)
+
+
+    def emit(self, record):
+        try:
+            key = self.digest_key(record)
+            with self._buffer_lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry[2] += 1
+                    entry[4] = record.created
+                elif len(self._entries) >= self.max_entries:
+                    self._omitted += 1
+                else:
+                    text = self.format(record)
+                    self._entries[key] = [text, self.getSubject(record), 1, record.created, record.created]
+                if self._timer is None:
+                    self._schedule(self.window)
+        except Exception:
+            self.handleError(record)
+
+
+    def _schedule(self, delay: float):
+        self._timer = threading.Timer(delay, self._on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+
+    def _on_timer(self):
+        with self._buffer_lock:
+            self._timer = None
+        self.send_digest()
+
+
+    def send_digest(self, force: bool=False) -> bool:
+        """Send buffered records in one email, unless over max_per_minute, then it's retried when allowed.
+
+        Keyword Arguments:
+            force {bool} -- Send even if over max_per_minute (default: {False})
+
+        Returns:
+            bool -- True if a digest was sent
+        """
+        with self._send_lock:
+            with self._buffer_lock:
+                if not self._entries:
+                    return False
+                now = time.monotonic()
+                while self._sent_times and self._sent_times[0] <= now - 60:
+                    self._sent_times.popleft()
+                if not force and len(self._sent_times) >= self.max_per_minute:
+                    if self._timer is None:
+                        self._schedule(self._sent_times[0] + 60 - now)
+                    return False
+                entries, self._entries = self._entries, OrderedDict()
+                omitted, self._omitted = self._omitted, 0
+                self._sent_times.append(now)
+            try:
+                self.smtp_pool.send_message(self.smtp_config, self.make_digest(list(entries.values()), omitted))
+            except Exception:
+                # Report by logging.raiseExceptions like other handlers, records are kept for next digest
+                self.handleError(logging.makeLogRecord({'msg': 'Failed to send log digest', 'exc_info': None}))
+                self._restore(entries, omitted)
+                return False
+            return True
+
+
+    def _restore(self, entries: OrderedDict, omitted: int):
+        """Put entries of a failed digest back before records buffered since, and retry after window.
+        """
+        with self._buffer_lock:
+            for key, entry in self._entries.items():
+                restored = entries.get(key)
+                if restored is not None:
+                    restored[2] += entry[2]
+                    restored[4] = entry[4]
+                elif len(entries) >= self.max_entries:
+                    omitted += entry[2]
+                else:
+                    entries[key] = entry
+            self._entries = entries
+            self._omitted += omitted
+            if self._timer is None:
+                self._schedule(self.window)
+
+
+    def make_digest(self, entries: list, omitted: int=0):
+        """EmailMessage of entries [formatted record, subject, count, first created, last created].
+        """
+        from email.message import EmailMessage
+        import email.utils
+        total = sum(entry[2] for entry in entries) + omitted
+        subject = entries[0][1]
+        if total > 1:
+            subject = f'[{total} records] {subject}'
+        lines = []
+        for text, _, count, first, last in entries:
+            if count > 1:
+                lines.append(f'=== {count} times from {_format_time(first)} to {_format_time(last)} ===')
+            lines.append(text)
+            lines.append('')
+        if omitted:
+            lines.append(f'=== {omitted} more records omitted ===')
+
+        msg = EmailMessage()
+        msg['From'] = self.fromaddr
+        msg['To'] = ','.join(self.toaddrs)
+        msg['Subject'] = subject
+        msg['Date'] = email.utils.localtime()
+        msg.set_content('\n'.join(lines))
+        return msg
+
+
+    def flush(self):
+        """Nothing to do, buffered records are sent by timer after window, or by close().
+        Ex. QueueLogging.flush() and stop() do not bypass window and max_per_minute.
+        """
+
+
+    def close(self):
+        """Send buffered records regardless of max_per_minute, then close SMTP sessions if the pool is created by handler.
+        """
+        try:
+            self.send_digest(force=True)
+        finally:
+            # After sending, a failed digest schedules a retry which is not wanted any more
+            with self._buffer_lock:
+                timer, self._timer = self._timer, None
+            if timer is not None:
+                timer.cancel()
+            if self._owns_pool:
+                self.smtp_pool.close()
+            super().close()
+
+
+def _format_time(created: float) -> str:
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(created))
+
+
+ROTATE_INTERVALS = {'S': 1, 'M': 60, 'H': 3600, 'D': 86400}
+COMPRESSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+
+class RotatingCompressedFileHandler(logging.FileHandler):
+    """File handler rotated by size (max_bytes), time (when * interval, aligned to local clock) or both.
+    Rotation on logging thread is only a rename, rotated files are compressed and pruned by a background thread,
+    so total size of log files is capped by max_total_bytes and their count by backup_count.
+    Rotated files are named like app.log.2024-01-31_23-59-59-999999.log.gz, which sort by rotation time.
+    Ex.
+        handler = RotatingCompressedFileHandler('logs/app.log', max_bytes=100 * 1024 * 1024, compress='gzip')
+    """
+    def __init__(self, filename: str, max_bytes: int=0, when: str='D', interval: int=1, backup_count: int=7, 
+        compress: str=None, max_total_bytes: int=0, encoding: str='utf-8', close_timeout: float=5):
+        """
+        Arguments:
+            filename {str} -- Log file
+
+        Keyword Arguments:
+            max_bytes {int} -- Rotate before file exceeds it, 0 for no size limit (default: {0})
+            when {str} -- Unit of rotation interval, one of S, M, H, D, None for no time limit (default: {'D'})
+            interval {int} -- Rotate every so many units (default: {1})
+            backup_count {int} -- Max rotated files to keep, 0 for no limit (default: {7})
+            compress {str} -- gzip, zstd (needs zstandard installed) or None (default: {None})
+            max_total_bytes {int} -- Oldest rotated files are removed while all log files exceed it, 0 for no limit (default: {0})
+            encoding {str} -- Encoding of log file (default: {'utf-8'})
+            close_timeout {float} -- Max seconds close() waits for background thread, 
+                a file whose compression is aborted is compressed after next start (default: {5})
+
+        Raises:
+            AppToolError: If when or compress is invalid, or zstandard is not installed for zstd.
+        """
+        if when and when.upper() not in ROTATE_INTERVALS:
+            raise AppToolError(f'Invalid log rotation unit {when!r}, should be one of {", ".join(ROTATE_INTERVALS)}.')
+        if compress and compress not in COMPRESSIONS:
+            raise AppToolError(f'Invalid log compression {compress!r}, should be one of {", ".join(COMPRESSIONS)}.')
+        if compress == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise AppToolError('Log compression zstd needs zstandard, pip install zstandard or use gzip.')
+        super().__init__(filename, mode='ab', delay=True)
+        self.max_bytes = max_bytes
+        self.period = ROTATE_INTERVALS[when.upper()] * interval if when else 0
+        self.backup_count = backup_count
+        self.compress = compress
+        self.max_total_bytes = max_total_bytes
+        self.text_encoding = encoding
+        self._size = 0
+        self._rollover_at = None
+        self.close_timeout = close_timeout
+        self._last_rotated = 0
+        self._jobs = queue.Queue()
+        self._closing = threading.Event()
+        self._worker = None
+        self._resumed = False
+
+
+    def _open_stream(self):
+        if not self._resumed:
+            # Rotated files left uncompressed or unpruned by last run
+            self._resumed = True
+            if self.rotated_files():
+                self._submit()
+        self.stream = self._open()
+        self._size = os.fstat(self.stream.fileno()).st_size
+        if self.period:
+            now = time.time()
+            offset = time.localtime(now).tm_gmtoff
+            self._rollover_at = ((now + offset) // self.period + 1) * self.period - offset
+
+
+    def emit(self, record):
+        try:
+            data = (self.format(record) + self.terminator).encode(self.text_encoding, 'backslashreplace')
+            if self.stream is None:
+                self._open_stream()
+            if (self.max_bytes and self._size and self._size + len(data) > self.max_bytes) or \
+                (self._rollover_at is not None and record.created >= self._rollover_at):
+                self.doRollover()
+            self.stream.write(data)
+            self.stream.flush()
+            self._size += len(data)
+        except Exception:
+            self.handleError(record)
+
+
+    def doRollover(self):
+        """Rename log file and open a new one, compression and pruning are left to background thread.
+        """
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename):
+            os.rename(self.baseFilename, self._rotated_name())
+            self._submit()
+        self._open_stream()
+
+
+    def _rotated_name(self) -> str:
+        # Microseconds are bumped instead of adding a counter on collision, so names still sort by rotation
+        micros = max(int(time.time() * 1000000), self._last_rotated + 1)
+        while True:
+            seconds, fraction = divmod(micros, 1000000)
+            stamp = time.strftime('%Y-%m-%d_%H-%M-%S', time.localtime(seconds)) + f'-{fraction:06d}'
+            name = f'{self.baseFilename}.{stamp}.log'
+            if not any(os.path.exists(name + ext) for ext in ('', '.gz', '.zst')):
+                self._last_rotated = micros
+                return name
+            micros += 1
+
+
+    def rotated_files(self) -> list:
+        """Paths of rotated files, oldest first.
+        """
+        log_dir, prefix = os.path.split(self.baseFilename)
+        prefix += '.'
+        return [os.path.join(log_dir, name) for name in sorted(os.listdir(log_dir)) 
+                if name.startswith(prefix) and name.endswith(('.log', '.log.gz', '.log.zst'))]
+
+
+    def _submit(self):
+        if self._worker is None:
+            # A worker left running by close() keeps its own queue and event
+            self._jobs = queue.Queue()
+            self._closing = threading.Event()
+            self._worker = threading.Thread(target=self._work, args=(self._jobs, self._closing), 
+                                            name=f'{type(self).__name__}({self.baseFilename})', daemon=True)
+            self._worker.start()
+        self._jobs.put(True)
+
+
+    def _work(self, jobs: queue.Queue, closing: threading.Event):
+        while True:
+            job = jobs.get()
+            try:
+                if job is None:
+                    return
+                if self.compress:
+                    # Including files left uncompressed by last run
+                    for rotated in self.rotated_files():
+                        if rotated.endswith('.log') and not self._compress(rotated, closing):
+                            return
+                self._prune()
+            except Exception:
+                self.handleError(logging.makeLogRecord({'msg': f'Failed to compress or prune rotated {self.baseFilename}'}))
+            finally:
+                jobs.task_done()
+
+
+    def _compress(self, path: str, closing: threading.Event) -> bool:
+        """Compress rotated file chunk by chunk, False if aborted by close(), then it's left as it is.
+        """
+        target = path + COMPRESSIONS[self.compress]
+        with open(path, 'rb') as src, open(target + '.tmp', 'wb') as dst:
+            if self.compress == 'zstd':
+                import zstandard
+                compressor = zstandard.ZstdCompressor().compressobj()
+                write, flush = lambda chunk: dst.write(compressor.compress(chunk)), lambda: dst.write(compressor.flush())
+            else:
+                import gzip
+                gzip_dst = gzip.GzipFile(os.path.basename(path), 'wb', 6, dst)
+                write, flush = gzip_dst.write, gzip_dst.close
+            while not closing.is_set():
+                chunk = src.read(1024 * 1024)
+                if not chunk:
+                    break
+                write(chunk)
+            flush()
+        if closing.is_set():
+            os.remove(target + '.tmp')
+            return False
+        os.replace(target + '.tmp', target)
+        os.remove(path)
+        return True
+
+
+    def _prune(self):
+        rotated = self.rotated_files()
+        if self.backup_count and len(rotated) > self.backup_count:
+            for path in rotated[:-self.backup_count]:
+                os.remove(path)
+            rotated = rotated[-self.backup_count:]
+        if self.max_total_bytes:
+            sizes = [os.path.getsize(path) for path in rotated]
+            total = sum(sizes) + (os.path.getsize(self.baseFilename) if os.path.exists(self.baseFilename) else 0)
+            for path, size in zip(rotated, sizes):
+                if total <= self.max_total_bytes:
+                    break
+                os.remove(path)
+                total -= size
+
+
+    def wait_background(self):
+        """Wait until rotated files are compressed and pruned.
+        """
+        self._jobs.join()
+
+
+    def close(self):
+        """Close log file, then wait at most close_timeout seconds for background thread.
+        Compression still in progress is aborted, and the file is compressed after next start.
+        """
+        super().close()
+        worker, self._worker = self._worker, None
+        if worker is not None:
+            self._jobs.put(None)
+            worker.join(self.close_timeout)
+            if worker.is_alive():
+                # Aborted within a chunk
+                self._closing.set()
+                worker.join(1)
+
+
+class BoundedQueueHandler(handlers.QueueHandler):
+    """QueueHandler on a bounded queue, what to do when it's full is decided by overflow:
+        block       -- Caller waits for room, no record is lost.
+        drop_oldest -- Oldest queued record is dropped for the new one.
+        drop_debug  -- New DEBUG records are dropped, records of higher levels wait for room.
+    Count of dropped records is kept in dropped.
+    """
+    def __init__(self, queue_size: int=10000, overflow: str='block'):
+        if overflow not in OVERFLOW_POLICIES:
+            raise AppToolError(f'Invalid log overflow policy {overflow!r}, should be one of {", ".join(OVERFLOW_POLICIES)}.')
+        super().__init__(queue.Queue(queue_size))
+        self.overflow = overflow
+        self.dropped = 0
+
+
+    def enqueue(self, record):
+        if self.overflow == 'block':
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+            return
+        except queue.Full:
+            pass
+        if self.overflow == 'drop_debug':
+            if record.levelno <= logging.DEBUG:
+                self.dropped += 1
+            else:
+                self.queue.put(record)
+            return
+        while True:
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+                self.dropped += 1
+            except queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(record)
+                return
+            except queue.Full:
+                pass
+
+
+    def prepare(self, record):
+        """Merge args into message and render traceback into exc_text, so record can be handled in another thread.
+        Unlike QueueHandler.prepare(), traceback is not merged into message, so it's not in subject of mail.
+        """
+        record = copy.copy(record)
+        # Message template and exception type are gone after rendering, DigestSMTPHandler groups by them
+        record._digest_key = DigestSMTPHandler.digest_key(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class _QueueListener(handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # Wait for room, sentinel must not be dropped or lost
+        self.queue.put(self._sentinel)
+
+
+class QueueLogging(object):
+    """Handlers are run by a listener thread, logger only puts records into a bounded queue.
+    Records left in queue are handled before exit.
+    Ex.
+        queue_logging = QueueLogging(logger, [file_handler, mail_handler], overflow='drop_debug').start()
+        logger.info('Returns at once')
+        queue_logging.stop()
+    """
+    def __init__(self, logger: logging.Logger, target_handlers: list, queue_size: int=10000, overflow: str='block'):
+        """
+        Arguments:
+            logger {Logger} -- Logger which records come from
+            target_handlers {list} -- Handlers run by listener thread, their levels are respected
+
+        Keyword Arguments:
+            queue_size {int} -- Max records in queue (default: {10000})
+            overflow {str} -- Policy when queue is full, one of OVERFLOW_POLICIES (default: {'block'})
+        """
+        self.logger = logger
+        self.handlers = list(target_handlers)
+        self.handler = BoundedQueueHandler(queue_size, overflow)
+        self._listener = _QueueListener(self.handler.queue, *self.handlers, respect_handler_level=True)
+        self._started = False
+
+
+    @property
+    def dropped(self) -> int:
+        return self.handler.dropped
+
+
+    def start(self):
+        if not self._started:
+            self._listener.start()
+            self.logger.addHandler(self.handler)
+            atexit.register(self.stop)
+            self._started = True
+        return self
+
+
+    def flush(self):
+        """Wait until queued records are handled, then flush handlers.
+        """
+        self.handler.queue.join()
+        for handler in self.handlers:
+            handler.flush()
+
+
+    def stop(self):
+        """Detach from logger, handle records left in queue and stop listener thread. Handlers are not closed.
+        """
+        if self._started:
+            self._started = False
+            self.logger.removeHandler(self.handler)
+            self._listener.stop()
+            atexit.unregister(self.stop)
+            for handler in self.handlers:
+                handler.flush()
+
+
+# Attributes every LogRecord has, the others are from extra
+_RECORD_ATTRS = frozenset(logging.makeLogRecord({}).__dict__) | {'message', 'asctime', 'fields', '_json_line', '_digest_key'}
+
+
+class TextFormatter(logging.Formatter):
+    """logging.Formatter which formats time once per second, and appends keyword fields of AppTool.info() etc.
+    as key=value to message.
+    """
+    def __init__(self, fmt: str=None, datefmt: str=None):
+        super().__init__(fmt, datefmt)
+        self._second = (None, '')     # (second, formatted), replaced as a whole so it's thread safe
+
+
+    def formatTime(self, record, datefmt=None):
+        if datefmt:
+            return super().formatTime(record, datefmt)
+        second = int(record.created)
+        cached = self._second
+        if cached[0] != second:
+            cached = self._second = (second, time.strftime(self.default_time_format, self.converter(second)))
+        return self.default_msec_format % (cached[1], record.msecs)
+
+
+    def formatMessage(self, record):
+        text = super().formatMessage(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            text += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as a JSON object in one line, with time, level, logger, message, 
+    fields from extra and keyword fields of AppTool.info() etc., exception and stack.
+    Time is formatted once per second, traceback once per record (kept in exc_text like logging.Formatter),
+    and the JSON line is kept in record, so handlers sharing this formatter serialize it once.
+    Ex.
+        {"time":"2024-01-31T23:59:59.123+08:00","level":"INFO","logger":"app","message":"Synced","count":3}
+    """
+    def __init__(self):
+        super().__init__()
+        import json
+        self._encode = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=str).encode
+        self._second = (None, '', '')     # (second, formatted, utc offset)
+
+
+    def formatTime(self, record, datefmt=None):
+        second = int(record.created)
+        cached = self._second
+        if cached[0] != second:
+            local = time.localtime(second)
+            offset = time.strftime('%z', local)
+            cached = self._second = (second, time.strftime('%Y-%m-%dT%H:%M:%S', local), f'{offset[:3]}:{offset[3:]}')
+        return f'{cached[1]}.{int(record.msecs):03d}{cached[2]}'
+
+
+    def format(self, record):
+        cached = record.__dict__.get('_json_line')
+        if cached is not None and cached[0] is self:
+            return cached[1]
+
+        doc = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        attrs = record.__dict__
+        if not attrs.keys() <= _RECORD_ATTRS:
+            for key, value in attrs.items():
+                if key not in _RECORD_ATTRS and key[0] != '_':
+                    doc[key] = value
+        fields = getattr(record, 'fields', None)
+        if fields:
+            doc.update(fields)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            doc['exception'] = record.exc_text
+        if record.stack_info:
+            doc['stack'] = record.stack_info
+
+        line = self._encode(doc)
+        record._json_line = (self, line)
+        return line
+
+
+class Lazy(object):
+    """Message, arg or field of a log record which is only built when the record is formatted,
+    so it costs nothing if the level is disabled. It's built once however many handlers format the record.
+    Ex.
+        APP.debug(Lazy(dump_tree, root))
+        APP.debug('Tree: %s', Lazy(dump_tree, root))
+    """
+    __slots__ = ('func', 'args', 'kwargs', '_text')
+
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self._text = None
+
+
+    def __str__(self):
+        if self._text is None:
+            self._text = str(self.func(*self.args, **self.kwargs))
+        return self._text
+
+
+    __repr__ = __str__
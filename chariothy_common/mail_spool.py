@@ -0,0 +1,322 @@
+import os
+import threading
+import time
+import uuid
+from email.parser import BytesHeaderParser
+from email.utils import getaddresses
+from smtplib import SMTPException, SMTPResponseException, SMTPRecipientsRefused, SMTPNotSupportedError
+
+from .email_assets import write_message, send_chunks
+from .smtp_pool import SMTPPool
+from .utils import coerce_config, SMTP_SCHEMA
+
+
+class MailSpool(object):
+    """Outbound mail queue on disk, delivered by a background worker thread.
+    Messages are written into spool_dir/queue atomically, then a worker claims them by moving into spool_dir/sending,
+    sends them by pooled SMTP sessions, retries them with exponential backoff, or moves them into spool_dir/dead.
+    Due time and attempts are kept in file name, so the queue survives process restarts and is shared by processes.
+    Messages which can never be sent (Ex. without sender, or with an invalid spool name) are moved into dead at once.
+    Ex.
+        spool = MailSpool('/var/spool/my_app', smtp_config).start()
+        send_email(from_addr, to_addrs, subject, text_body, spool=spool)
+    """
+    def __init__(self, spool_dir: str, smtp_config: dict, smtp_pool: SMTPPool=None, max_attempts: int=8,
+        retry_delay: float=30, max_retry_delay: float=3600, poll_interval: float=5, claim_timeout: float=600, logger=None):
+        """
+        Arguments:
+            spool_dir {str} -- Spool directory, created if not exists.
+            smtp_config {dict} -- SMTP config, same as send_email()
+
+        Keyword Arguments:
+            smtp_pool {SMTPPool} -- SMTP sessions to reuse (default: {a new SMTPPool})
+            max_attempts {int} -- Message is moved into dead folder after so many failed attempts (default: {8})
+            retry_delay {float} -- Seconds before the first retry, doubled for each next retry (default: {30})
+            max_retry_delay {float} -- Max seconds between retries (default: {3600})
+            poll_interval {float} -- Seconds between scanning queue for messages put by other processes (default: {5})
+            claim_timeout {float} -- Messages claimed longer than these seconds are taken as abandoned by
+                a crashed worker, and are queued again (default: {600})
+            logger {Logger} -- Logger for retries and dead messages (default: {None})
+        """
+        self.spool_dir = spool_dir
+        self.smtp_config = coerce_config(smtp_config, SMTP_SCHEMA, 'smtp_config')
+        self.smtp_pool = smtp_pool if smtp_pool is not None else SMTPPool()
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.poll_interval = poll_interval
+        self.claim_timeout = claim_timeout
+        self.logger = logger
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._worker = None
+        for sub_dir in ('tmp', 'queue', 'sending', 'dead'):
+            os.makedirs(os.path.join(spool_dir, sub_dir), exist_ok=True)
+
+
+    def _path(self, sub_dir: str, name: str='') -> str:
+        return os.path.join(self.spool_dir, sub_dir, name)
+
+
+    def put(self, msg) -> str:
+        """Write msg into queue and wake up worker, return as soon as it's on disk.
+
+        Returns:
+            str -- Name of spooled message
+        """
+        name = _spool_name(time.time(), 0)
+        tmp_path = self._path('tmp', name)
+        with open(tmp_path, 'wb') as fp:
+            write_message(msg, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, self._path('queue', name))
+        self._wakeup.set()
+        return name
+
+
+    @property
+    def queued(self) -> list:
+        return sorted(name for name in os.listdir(self._path('queue')) if name.endswith('.eml'))
+
+
+    @property
+    def dead(self) -> list:
+        return sorted(name for name in os.listdir(self._path('dead')) if name.endswith('.eml'))
+
+
+    def deliver_due(self) -> int:
+        """Deliver messages which are due now, in order of due time.
+
+        Returns:
+            int -- Count of messages delivered
+        """
+        self._requeue_abandoned()
+        delivered = 0
+        now = time.time()
+        for name in self.queued:
+            try:
+                due, attempts, _ = _parse_spool_name(name)
+            except ValueError as ex:
+                self._bury(self._path('queue', name), name, 0, ex)
+                continue
+            if due > now or self._stopping.is_set():
+                break
+            sending_path = self._path('sending', name)
+            try:
+                # Claim it, other workers can't move it any more
+                os.replace(self._path('queue', name), sending_path)
+                os.utime(sending_path)
+            except FileNotFoundError:
+                continue
+            if self._deliver(sending_path, name, attempts):
+                delivered += 1
+        return delivered
+
+
+    def _deliver(self, sending_path: str, name: str, attempts: int) -> bool:
+        """Send message file by chunks, so its size is not limited by memory.
+        """
+        try:
+            with open(sending_path, 'rb') as fp:
+                from_addr, receivers = _read_envelope(fp)
+        except Exception as ex:
+            # Malformed message is never sent
+            self._bury(sending_path, name, attempts + 1, ex)
+            return False
+
+        try:
+            server = self.smtp_pool.acquire(self.smtp_config)
+        except (SMTPException, OSError) as ex:
+            self._retry(sending_path, name, attempts, ex)
+            return False
+        try:
+            with open(sending_path, 'rb') as fp:
+                refused = send_chunks(server, from_addr, receivers, _iter_spool_chunks(fp))
+        except SMTPRecipientsRefused as ex:
+            self._release(server)
+            self._retry(sending_path, name, attempts, ex, permanent=all(code >= 500 for code, _ in ex.recipients.values()))
+            return False
+        except SMTPResponseException as ex:
+            self._release(server)
+            self._retry(sending_path, name, attempts, ex, permanent=ex.smtp_code >= 500)
+            return False
+        except (SMTPNotSupportedError, ValueError) as ex:
+            # Ex. non-ASCII address without SMTPUTF8
+            server.close()
+            self._bury(sending_path, name, attempts + 1, ex)
+            return False
+        except (SMTPException, OSError) as ex:
+            server.close()
+            self._retry(sending_path, name, attempts, ex)
+            return False
+        self.smtp_pool.release(self.smtp_config, server)
+        if refused and self.logger:
+            # Others have got it, so it's not sent again
+            self.logger.error(f'Mail {name} is refused by some receivers: {refused!r}')
+        os.remove(sending_path)
+        return True
+
+
+    def _release(self, server):
+        # Server is closed if it replied 421
+        if server.sock is not None:
+            self.smtp_pool.release(self.smtp_config, server)
+
+
+    def _retry(self, sending_path: str, name: str, attempts: int, ex: Exception, permanent: bool=False):
+        attempts += 1
+        if permanent or attempts >= self.max_attempts:
+            self._bury(sending_path, name, attempts, ex)
+            return
+        delay = min(self.retry_delay * 2 ** (attempts - 1), self.max_retry_delay)
+        _, _, msg_id = _parse_spool_name(name)
+        os.replace(sending_path, self._path('queue', _spool_name(time.time() + delay, attempts, msg_id)))
+        if self.logger:
+            self.logger.warning(f'Mail {name} failed (attempt {attempts}), retry in {delay:.0f}s: {ex!r}')
+
+
+    def _bury(self, path: str, name: str, attempts: int, ex: Exception):
+        """Move message into dead folder, ones without a valid spool name are renamed.
+        """
+        try:
+            _parse_spool_name(name)
+            dead_name = name
+        except ValueError:
+            dead_name = _spool_name(time.time(), attempts)
+        try:
+            os.replace(path, self._path('dead', dead_name))
+        except FileNotFoundError:
+            return
+        if self.logger:
+            self.logger.error(f'Mail {name} is dead after {attempts} attempts: {ex!r}')
+
+
+    def _requeue_abandoned(self):
+        expire = time.time() - self.claim_timeout
+        for name in os.listdir(self._path('sending')):
+            sending_path = self._path('sending', name)
+            try:
+                if os.stat(sending_path).st_mtime < expire:
+                    os.replace(sending_path, self._path('queue', name))
+            except FileNotFoundError:
+                pass
+
+
+    def start(self):
+        """Start worker thread (daemon), which is stopped by stop().
+        """
+        if self._worker is None:
+            self._stopping.clear()
+            self._worker = threading.Thread(target=self._work, name=f'MailSpool({self.spool_dir})', daemon=True)
+            self._worker.start()
+        return self
+
+
+    def stop(self, timeout: float=None):
+        """Stop worker after the message being sent, messages left in queue are delivered next time.
+        """
+        worker = self._worker
+        if worker is not None:
+            self._stopping.set()
+            self._wakeup.set()
+            worker.join(timeout)
+            self._worker = None
+            self._stopping.clear()
+        self.smtp_pool.close()
+
+
+    def _work(self):
+        while not self._stopping.is_set():
+            self._wakeup.clear()
+            wait = self.poll_interval
+            try:
+                self.deliver_due()
+                wait = self._next_wait()
+            except Exception as ex:
+                # Keep worker alive, Ex. spool dir is removed for a while
+                if self.logger:
+                    self.logger.exception(f'Mail spool worker failed: {ex!r}')
+            self._wakeup.wait(wait)
+
+
+    def _next_wait(self) -> float:
+        for name in self.queued:
+            try:
+                due = _parse_spool_name(name)[0]
+            except ValueError:
+                # Buried by next deliver_due()
+                return 0
+            return max(0, min(due - time.time(), self.poll_interval))
+        return self.poll_interval
+
+
+def _spool_name(due: float, attempts: int, msg_id: str=None) -> str:
+    """Ex. 0001700000000000-0-2f1c...eml, file names sort by due time.
+    """
+    return f'{int(due * 1000):016d}-{attempts}-{msg_id or uuid.uuid4().hex}.eml'
+
+
+def _parse_spool_name(name: str) -> tuple:
+    """(due, attempts, msg_id) of spool name.
+
+    Raises:
+        ValueError: If name is not made by _spool_name().
+    """
+    due, attempts, msg_id = name[:-len('.eml')].split('-', 2)
+    return int(due) / 1000, int(attempts), msg_id
+
+
+def _read_envelope(fp) -> tuple:
+    """(from address, receivers in To, Cc and Bcc) from headers of message file, like SMTP.send_message().
+
+    Raises:
+        ValueError: If there is no sender or receiver.
+    """
+    lines = []
+    for line in fp:
+        if not line.strip():
+            break
+        lines.append(line)
+    headers = BytesHeaderParser().parsebytes(b''.join(lines))
+    senders = getaddresses(headers.get_all('Sender') or headers.get_all('From') or [])
+    if not senders or not senders[0][1]:
+        raise ValueError('Mail has no Sender or From.')
+    receivers = [addr for _, addr in getaddresses(headers.get_all('To', []) + headers.get_all('Cc', []) + 
+                                                 headers.get_all('Bcc', [])) if addr]
+    if not receivers:
+        raise ValueError('Mail has no To, Cc or Bcc.')
+    return senders[0][1], receivers
+
+
+def _iter_spool_chunks(fp, chunk_size: int=64 * 1024):
+    """Message file for SMTP DATA in chunks: without Bcc header, lines end with CRLF and leading dots are doubled.
+    """
+    chunk = []
+    size = 0
+    in_headers = True
+    in_bcc = False
+    for line in fp:
+        if in_headers:
+            if not line.strip():
+                in_headers = False
+            elif line[:1] in b' \t':
+                # Folded line of previous header
+                if in_bcc:
+                    continue
+            else:
+                in_bcc = line[:4].lower() == b'bcc:'
+                if in_bcc:
+                    continue
+        if not line.endswith(b'\r\n'):
+            line = line[:-1] + b'\r\n' if line.endswith(b'\n') else line + b'\r\n'
+        if line[:1] == b'.':
+            line = b'.' + line
+        chunk.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            yield b''.join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield b''.join(chunk)
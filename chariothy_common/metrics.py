@@ -0,0 +1,343 @@
+import atexit
+import functools
+import os
+import re
+import threading
+import time
+import weakref
+
+from .exception import AppToolError
+from .timing import TimingStats, clock_ns
+
+
+# CPU time of calling thread in nanoseconds, thread_time_ns() is new in Python 3.7
+cpu_clock_ns = getattr(time, 'thread_time_ns', None) or (lambda: int(time.process_time() * 1000000000))
+
+# Upper bounds (seconds) of Prometheus histogram buckets
+PROMETHEUS_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+CAPTURE_KINDS = ('cprofile', 'tracemalloc')
+
+# Only one cProfile profiler can be active in a process
+_profile_lock = threading.Lock()
+
+
+class FunctionMetrics(object):
+    """Calls, errors, and histograms of wall and CPU time of sampled calls of a function.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.errors = 0
+        self.wall = TimingStats(name)
+        self.cpu = TimingStats(name)
+        self.capture = None     # _Capture of next calls
+        self.captured = None    # Text report of last capture
+        self._lock = threading.Lock()
+
+
+    def count(self) -> int:
+        """Count a call, return count of calls before it.
+        """
+        with self._lock:
+            calls = self.calls
+            self.calls = calls + 1
+        return calls
+
+
+    def count_error(self):
+        with self._lock:
+            self.errors += 1
+
+
+class _Capture(object):
+    """cProfile or tracemalloc capture of next calls of a function.
+    """
+    def __init__(self, kind: str, calls: int, top: int):
+        self.kind = kind
+        self.left = calls
+        self.top = top
+        self.lock = threading.Lock()
+        self.stats = None           # pstats.Stats
+        self.baseline = None        # tracemalloc.Snapshot
+        self.started_tracemalloc = False
+
+
+    def run(self, func, args, kwargs):
+        if self.kind == 'tracemalloc':
+            return self._run_tracemalloc(func, args, kwargs)
+        if not _profile_lock.acquire(blocking=False):
+            return func(*args, **kwargs)
+        try:
+            import cProfile
+            profiler = cProfile.Profile()
+            try:
+                return profiler.runcall(func, *args, **kwargs)
+            finally:
+                import pstats
+                with self.lock:
+                    if self.stats is None:
+                        self.stats = pstats.Stats(profiler)
+                    else:
+                        self.stats.add(profiler)
+        finally:
+            _profile_lock.release()
+
+
+    def _run_tracemalloc(self, func, args, kwargs):
+        import tracemalloc
+        with self.lock:
+            if self.baseline is None:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                    self.started_tracemalloc = True
+                self.baseline = tracemalloc.take_snapshot()
+        return func(*args, **kwargs)
+
+
+    def done(self) -> bool:
+        """Count a captured call, True if it's the last one.
+        """
+        with self.lock:
+            self.left -= 1
+            return self.left == 0
+
+
+    def report(self) -> str:
+        import io
+        if self.kind == 'tracemalloc':
+            import tracemalloc
+            snapshot = tracemalloc.take_snapshot()
+            if self.started_tracemalloc:
+                tracemalloc.stop()
+            lines = [str(diff) for diff in snapshot.compare_to(self.baseline, 'lineno')[:self.top]]
+            return 'Top allocations since capture started:\n' + '\n'.join(lines)
+        if self.stats is None:
+            return ''
+        output = io.StringIO()
+        self.stats.stream = output
+        self.stats.sort_stats('cumulative').print_stats(self.top)
+        return output.getvalue()
+
+
+class Instrumentation(object):
+    """Per function call counts, exception counts, wall and CPU time histograms of instrumented functions,
+    exported in Prometheus text format.
+    Ex.
+        metrics = Instrumentation('my_app', sample_every=10)
+        func = metrics.instrument(func)
+        metrics.capture(func, calls=5)      # cProfile next 5 calls
+        metrics.write_prometheus('/var/lib/node_exporter/my_app.prom')
+    """
+    def __init__(self, app_name: str='', sample_every: int=1):
+        """
+        Keyword Arguments:
+            app_name {str} -- Value of label app (default: {''})
+            sample_every {int} -- Time 1 of every so many calls, all calls and errors are counted (default: {1})
+        """
+        self.app_name = app_name
+        self.sample_every = max(1, sample_every)
+        self._functions = {}
+        self._lock = threading.Lock()
+        self._exporter = None
+        self._server = None
+
+
+    def function(self, name: str) -> FunctionMetrics:
+        metrics = self._functions.get(name)
+        if metrics is None:
+            with self._lock:
+                metrics = self._functions.setdefault(name, FunctionMetrics(name))
+        return metrics
+
+
+    @property
+    def functions(self) -> dict:
+        with self._lock:
+            return dict(self._functions)
+
+
+    def instrument(self, func, name: str=None):
+        """Wrap func to record its calls, errors and time, keyed by name (default: {qualified name of func}).
+        """
+        metrics = self.function(name or f'{func.__module__}.{func.__qualname__}')
+        sample_every = self.sample_every
+        count = metrics.count
+        wall = metrics.wall
+        cpu = metrics.cpu
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            capture = metrics.capture
+            if capture is not None:
+                return self._run_captured(metrics, capture, func, args, kwargs)
+            if count() % sample_every:
+                try:
+                    return func(*args, **kwargs)
+                except BaseException:
+                    metrics.count_error()
+                    raise
+
+            start_cpu = cpu_clock_ns()
+            start = clock_ns()
+            try:
+                return func(*args, **kwargs)
+            except BaseException:
+                metrics.count_error()
+                raise
+            finally:
+                wall.add(clock_ns() - start)
+                cpu.add(cpu_clock_ns() - start_cpu)
+        wrapper.metrics = metrics
+        return wrapper
+
+
+    def _run_captured(self, metrics: FunctionMetrics, capture: _Capture, func, args, kwargs):
+        metrics.count()
+        try:
+            return capture.run(func, args, kwargs)
+        except BaseException:
+            metrics.count_error()
+            raise
+        finally:
+            if capture.done():
+                metrics.capture = None
+                metrics.captured = capture.report()
+
+
+    def capture(self, func, calls: int=1, kind: str='cprofile', top: int=30):
+        """Capture next calls of an instrumented function by cProfile or tracemalloc,
+        report is kept in func.metrics.captured when done.
+
+        Arguments:
+            func {function|str} -- Instrumented function or its name
+
+        Keyword Arguments:
+            calls {int} -- Calls to capture (default: {1})
+            kind {str} -- cprofile or tracemalloc (default: {'cprofile'})
+            top {int} -- Lines in report (default: {30})
+
+        Raises:
+            AppToolError: If kind is invalid or func is not instrumented.
+        """
+        if kind not in CAPTURE_KINDS:
+            raise AppToolError(f'Invalid capture kind {kind!r}, should be one of {", ".join(CAPTURE_KINDS)}.')
+        metrics = getattr(func, 'metrics', None) if not isinstance(func, str) else self._functions.get(func)
+        if metrics is None:
+            raise AppToolError(f'{func!r} is not instrumented.')
+        metrics.captured = None
+        metrics.capture = _Capture(kind, calls, top)
+
+
+    def to_prometheus(self) -> str:
+        """Metrics in Prometheus text exposition format.
+        """
+        app = _escape_label(self.app_name)
+        functions = sorted(self.functions.items())
+        lines = [
+            '# HELP app_function_calls_total Calls of instrumented function.',
+            '# TYPE app_function_calls_total counter',
+        ]
+        lines += [f'app_function_calls_total{{app="{app}",function="{_escape_label(name)}"}} {metrics.calls}'
+                  for name, metrics in functions]
+        lines += [
+            '# HELP app_function_errors_total Calls of instrumented function which raised an exception.',
+            '# TYPE app_function_errors_total counter',
+        ]
+        lines += [f'app_function_errors_total{{app="{app}",function="{_escape_label(name)}"}} {metrics.errors}'
+                  for name, metrics in functions]
+        for metric, attr, help_text in (
+            ('app_function_wall_seconds', 'wall', 'Wall time of sampled calls.'),
+            ('app_function_cpu_seconds', 'cpu', 'CPU time of calling thread in sampled calls.'),
+        ):
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} histogram')
+            for name, metrics in functions:
+                stats = getattr(metrics, attr)
+                labels = f'app="{app}",function="{_escape_label(name)}"'
+                counts = stats.cumulative_counts([int(bound * 1e9) for bound in PROMETHEUS_BUCKETS])
+                for bound, count in zip(PROMETHEUS_BUCKETS, counts):
+                    lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'{metric}_bucket{{{labels},le="+Inf"}} {stats.count}')
+                lines.append(f'{metric}_sum{{{labels}}} {stats.total_ns / 1e9}')
+                lines.append(f'{metric}_count{{{labels}}} {stats.count}')
+        return '\n'.join(lines) + '\n'
+
+
+    def write_prometheus(self, file_path: str):
+        """Write metrics into file atomically, Ex. for textfile collector of node_exporter.
+        """
+        tmp_path = f'{file_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf8') as fp:
+            fp.write(self.to_prometheus())
+        os.replace(tmp_path, file_path)
+
+
+    def export_to_file(self, file_path: str, interval: float=15):
+        """Write metrics into file every interval seconds by a daemon thread, and at exit.
+        """
+        stopped = threading.Event()
+        def export():
+            while not stopped.wait(interval):
+                self.write_prometheus(file_path)
+        self.stop_exporting()
+        self._exporter = threading.Thread(target=export, name=f'metrics-exporter({file_path})', daemon=True)
+        self._exporter.stopped = stopped
+        self._exporter.file_path = file_path
+        self._exporter.start()
+        _exporting.add(self)
+
+
+    def stop_exporting(self):
+        exporter, self._exporter = self._exporter, None
+        if exporter is not None:
+            exporter.stopped.set()
+            exporter.join()
+            self.write_prometheus(exporter.file_path)
+        _exporting.discard(self)
+
+
+    def serve(self, port: int, host: str='127.0.0.1'):
+        """Serve metrics at http://host:port/metrics by a daemon thread.
+
+        Returns:
+            HTTPServer -- Call its shutdown() to stop, server_address has the port if port is 0.
+        """
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        from socketserver import ThreadingMixIn
+        instrumentation = self
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] not in ('/metrics', '/'):
+                    self.send_error(404)
+                    return
+                body = instrumentation.to_prometheus().encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = Server((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name=f'metrics-server({host}:{port})', daemon=True).start()
+        self._server = server
+        return server
+
+
+_exporting = weakref.WeakSet()     # Instrumentations exporting to file, stopped at exit
+
+
+@atexit.register
+def _stop_exporting():
+    for instrumentation in list(_exporting):
+        instrumentation.stop_exporting()
+
+
+def _escape_label(value: str) -> str:
+    return re.sub(r'(["\\])', r'\\\1', str(value)).replace('\n', r'\n')
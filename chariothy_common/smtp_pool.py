@@ -0,0 +1,197 @@
+import threading
+import time
+from smtplib import SMTP, SMTP_SSL, SMTPException, SMTPServerDisconnected, SMTPResponseException, SMTPRecipientsRefused
+
+from .email_assets import send_message
+
+
+def connect_smtp(smtp_config: dict, debug: bool=False) -> SMTP:
+    """Connect to SMTP server and login.
+
+    Arguments:
+        smtp_config {dict} -- SMTP config, same as send_email()
+
+    Keyword Arguments:
+        debug {bool} -- If True output debug info. (default: {False})
+
+    Returns:
+        SMTP -- Logged-in SMTP session
+    """
+    if smtp_config.get('type') == 'ssl':
+        server = SMTP_SSL(smtp_config['host'], smtp_config['port'])
+    elif smtp_config.get('type') == 'tls':
+        server = SMTP(smtp_config['host'], smtp_config['port'])
+        server.starttls()
+    else:
+        server = SMTP(smtp_config['host'], smtp_config['port'])
+
+    server.ehlo()
+    if debug:
+        server.set_debuglevel(1)
+    server.login(smtp_config['user'], smtp_config['pwd'])
+    return server
+
+
+def close_smtp(server: SMTP):
+    """Quit SMTP session, close socket only if server is gone.
+    """
+    try:
+        server.quit()
+    except (SMTPException, OSError):
+        server.close()
+
+
+def send_smtp_message(server: SMTP, smtp_config: dict, msg, debug: bool=False) -> tuple:
+    """Send msg by server, retry once by a new session if the server disconnected.
+
+    Returns:
+        tuple -- (server, result), server is the new session if reconnected, 
+            result is same as SMTP.send_message().
+            If it raises, server is closed if it has been disconnected.
+    """
+    try:
+        return server, send_message(server, msg)
+    except SMTPServerDisconnected:
+        server.close()
+    new_server = connect_smtp(smtp_config, debug)
+    try:
+        return new_server, send_message(new_server, msg)
+    except BaseException:
+        close_smtp(new_server)
+        raise
+
+
+def _is_alive(server: SMTP) -> bool:
+    try:
+        return server.noop()[0] == 250
+    except (SMTPException, OSError):
+        return False
+
+
+class SMTPPool(object):
+    """Logged-in SMTP sessions kept for reuse, keyed by (host, port, type, user).
+    A session is checked by NOOP before reused, sessions idle longer than idle_timeout are closed.
+    Ex.
+        pool = SMTPPool(idle_timeout=30)
+        send_email(from_addr, to_addrs, subject, text_body, smtp_config=smtp_config, smtp_pool=pool)
+    """
+    def __init__(self, idle_timeout: float=60, max_idle: int=4):
+        """
+        Keyword Arguments:
+            idle_timeout {float} -- Seconds before an idle session is closed (default: {60})
+            max_idle {int} -- Max idle sessions kept for each key, more are closed when released (default: {4})
+        """
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self._idle = {}     # {key: [(server, released_at)]}, the latest released at the tail
+        self._lock = threading.Lock()
+        self._reaper = None
+
+
+    @staticmethod
+    def key(smtp_config: dict) -> tuple:
+        return (smtp_config['host'], smtp_config['port'], smtp_config.get('type', 'plain'), smtp_config['user'])
+
+
+    @property
+    def idle_count(self) -> int:
+        with self._lock:
+            return sum(len(idle) for idle in self._idle.values())
+
+
+    def acquire(self, smtp_config: dict, debug: bool=False) -> SMTP:
+        """Get an idle session which is still alive, or connect a new one.
+        Give it back by release() (or discard() if it's broken) after use.
+        """
+        key = self.key(smtp_config)
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                if not idle:
+                    break
+                server, released_at = idle.pop()
+            if time.monotonic() - released_at < self.idle_timeout and _is_alive(server):
+                server.set_debuglevel(1 if debug else 0)
+                return server
+            close_smtp(server)
+        return connect_smtp(smtp_config, debug)
+
+
+    def release(self, smtp_config: dict, server: SMTP):
+        if server.sock is None:
+            # Closed
+            return
+        key = self.key(smtp_config)
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append((server, time.monotonic()))
+                server = None
+                if self._reaper is None:
+                    self._schedule_reaper(self.idle_timeout)
+        if server is not None:
+            close_smtp(server)
+
+
+    def discard(self, server: SMTP):
+        close_smtp(server)
+
+
+    def send_message(self, smtp_config: dict, msg, debug: bool=False) -> dict:
+        """Send msg by a pooled session, retry once by a new session if the server disconnected.
+
+        Returns:
+            dict -- Same as SMTP.send_message(), {} if success, else {receiver: (code, message)}.
+        """
+        server = self.acquire(smtp_config, debug)
+        try:
+            server, result = send_smtp_message(server, smtp_config, msg, debug)
+        except (SMTPResponseException, SMTPRecipientsRefused):
+            # Session has been reset by RSET, still usable
+            self.release(smtp_config, server)
+            raise
+        except BaseException:
+            self.discard(server)
+            raise
+        self.release(smtp_config, server)
+        return result
+
+
+    def close_idle(self, idle_timeout: float=None):
+        """Close sessions idle longer than idle_timeout (default: {self.idle_timeout})
+        """
+        if idle_timeout is None:
+            idle_timeout = self.idle_timeout
+        expired = []
+        with self._lock:
+            now = time.monotonic()
+            next_expire = None
+            for idle in self._idle.values():
+                alive = []
+                for server, released_at in idle:
+                    if now - released_at >= idle_timeout:
+                        expired.append(server)
+                    else:
+                        alive.append((server, released_at))
+                        expire = released_at + self.idle_timeout - now
+                        next_expire = expire if next_expire is None else min(next_expire, expire)
+                idle[:] = alive
+            if self._reaper is not None and self._reaper is not threading.current_thread():
+                self._reaper.cancel()
+            self._reaper = None
+            if next_expire is not None:
+                self._schedule_reaper(next_expire)
+        for server in expired:
+            close_smtp(server)
+
+
+    def close(self):
+        """Close all idle sessions.
+        """
+        self.close_idle(0)
+
+
+    def _schedule_reaper(self, delay: float):
+        self._reaper = threading.Timer(delay, self.close_idle)
+        self._reaper.daemon = True
+        self._reaper.start()
@@ -0,0 +1,312 @@
+import functools
+import inspect
+import itertools
+import json
+import logging
+import threading
+import time
+
+
+# Nanoseconds, perf_counter_ns() is new in Python 3.7
+clock_ns = getattr(time, 'perf_counter_ns', None) or (lambda: int(time.perf_counter() * 1000000000))
+
+_SUB_BUCKET_BITS = 4
+_SUB_BUCKETS = 1 << _SUB_BUCKET_BITS
+_NO_MIN = 1 << 62
+
+
+def _bucket_index(value: int) -> int:
+    """Log-linear bucket of value: exact below 32, else 16 buckets per power of 2 (relative error < 1/16).
+    Inlined in TimingStats.add().
+    """
+    if value < 2 * _SUB_BUCKETS:
+        return value
+    exponent = value.bit_length()
+    return (exponent - _SUB_BUCKET_BITS) * _SUB_BUCKETS + ((value >> (exponent - _SUB_BUCKET_BITS - 1)) & (_SUB_BUCKETS - 1))
+
+
+def _bucket_range(index: int) -> tuple:
+    """(lowest value, width) of bucket index.
+    """
+    if index < 2 * _SUB_BUCKETS:
+        return index, 1
+    exponent, sub_bucket = divmod(index, _SUB_BUCKETS)
+    shift = exponent - 1
+    return (_SUB_BUCKETS + sub_bucket) << shift, 1 << shift
+
+
+class TimingStats(object):
+    """Streaming statistics of elapsed nanoseconds: count, total, min, max, and percentiles by a compact histogram
+    of sparse log-linear buckets, so memory does not grow with count.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self._min_ns = _NO_MIN
+        self._buckets = {}      # {bucket index: count}
+        self._lock = threading.Lock()
+
+
+    def add(self, elapsed_ns: int):
+        if elapsed_ns < 2 * _SUB_BUCKETS:
+            index = elapsed_ns
+        else:
+            exponent = elapsed_ns.bit_length()
+            index = (exponent - _SUB_BUCKET_BITS) * _SUB_BUCKETS + ((elapsed_ns >> (exponent - _SUB_BUCKET_BITS - 1)) & (_SUB_BUCKETS - 1))
+        with self._lock:
+            self.count += 1
+            self.total_ns += elapsed_ns
+            if elapsed_ns > self.max_ns:
+                self.max_ns = elapsed_ns
+            if elapsed_ns < self._min_ns:
+                self._min_ns = elapsed_ns
+            buckets = self._buckets
+            buckets[index] = buckets.get(index, 0) + 1
+
+
+    @property
+    def min_ns(self) -> int:
+        return self._min_ns if self.count else 0
+
+
+    @property
+    def mean_ns(self) -> float:
+        return self.total_ns / self.count if self.count else 0.0
+
+
+    def percentile(self, percent: float) -> float:
+        """Approximate percentile in nanoseconds, middle of its bucket clamped by min and max.
+        """
+        with self._lock:
+            if not self.count:
+                return 0.0
+            rank = max(1, -(-self.count * percent // 100))
+            if rank >= self.count:
+                return float(self.max_ns)
+            seen = 0
+            for index in sorted(self._buckets):
+                seen += self._buckets[index]
+                if seen >= rank:
+                    low, width = _bucket_range(index)
+                    return float(min(max(low + (width - 1) / 2, self.min_ns), self.max_ns))
+            return float(self.max_ns)
+
+
+    def cumulative_counts(self, bounds_ns: list) -> list:
+        """Counts of values <= each of ascending bounds, Ex. for Prometheus histogram buckets.
+        A bucket is counted when its upper end is within bound, so counts are exact to bucket width.
+        """
+        with self._lock:
+            buckets = sorted(self._buckets.items())
+        counts = []
+        total = 0
+        position = 0
+        for bound in bounds_ns:
+            while position < len(buckets):
+                low, width = _bucket_range(buckets[position][0])
+                if low + width - 1 > bound:
+                    break
+                total += buckets[position][1]
+                position += 1
+            counts.append(total)
+        return counts
+
+
+    def to_dict(self) -> dict:
+        """Statistics in milliseconds.
+        """
+        return {
+            'count': self.count,
+            'total_ms': self.total_ns / 1e6,
+            'mean_ms': self.mean_ns / 1e6,
+            'min_ms': self.min_ns / 1e6,
+            'p50_ms': self.percentile(50) / 1e6,
+            'p95_ms': self.percentile(95) / 1e6,
+            'p99_ms': self.percentile(99) / 1e6,
+            'max_ms': self.max_ns / 1e6,
+        }
+
+
+    def __str__(self):
+        stats = self.to_dict()
+        return (f'{self.name}: count={stats["count"]} mean={stats["mean_ms"]:.3f}ms p50={stats["p50_ms"]:.3f}ms '
+                f'p95={stats["p95_ms"]:.3f}ms p99={stats["p99_ms"]:.3f}ms max={stats["max_ms"]:.3f}ms')
+
+
+class TimingRegistry(object):
+    """Thread-safe {name: TimingStats} which @benchmark records into.
+    Ex.
+        timings.report(APP.logger)
+        timings.dump_json('timings.json')
+    """
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+
+    def stats(self, name: str) -> TimingStats:
+        """TimingStats of name, created if not exists.
+        """
+        stats = self._stats.get(name)
+        if stats is None:
+            with self._lock:
+                stats = self._stats.setdefault(name, TimingStats(name))
+        return stats
+
+
+    def record(self, name: str, elapsed_ns: int):
+        self.stats(name).add(elapsed_ns)
+
+
+    def __contains__(self, name: str):
+        return name in self._stats
+
+
+    def names(self) -> list:
+        with self._lock:
+            return sorted(self._stats)
+
+
+    def reset(self, name: str=None):
+        with self._lock:
+            if name is None:
+                self._stats.clear()
+            else:
+                self._stats.pop(name, None)
+
+
+    def snapshot(self) -> dict:
+        """{name: TimingStats.to_dict()}
+        """
+        return {name: self._stats[name].to_dict() for name in self.names()}
+
+
+    def report(self, logger: logging.Logger=None, level: int=logging.INFO):
+        """Log a line of statistics per name by logger, or print them if logger is None.
+        """
+        for name in self.names():
+            line = str(self._stats[name])
+            if logger is None:
+                print(line)
+            else:
+                logger.log(level, line)
+
+
+    def dump_json(self, file_path: str=None, indent: int=2) -> str:
+        """Statistics as JSON, written into file_path if given.
+        """
+        text = json.dumps(self.snapshot(), indent=indent)
+        if file_path:
+            with open(file_path, 'w', encoding='utf8') as fp:
+                fp.write(text)
+        return text
+
+
+timings = TimingRegistry()
+
+
+def find_regressions(baseline: dict, current: dict, threshold: float=0.2, key: str='p50_ms') -> dict:
+    """Compare statistics of TimingRegistry.snapshot() (or loaded from its dump_json()) with a baseline.
+
+    Keyword Arguments:
+        threshold {float} -- Allowed growth of key, 0.2 is 20% (default: {0.2})
+        key {str} -- Statistic to compare (default: {'p50_ms'})
+
+    Returns:
+        dict -- {name: (baseline value, current value)} of names which grew more than threshold, 
+            names not in both are skipped
+    """
+    regressions = {}
+    for name, stats in current.items():
+        base = baseline.get(name)
+        if base is None or not base.get(key):
+            continue
+        if stats[key] > base[key] * (1 + threshold):
+            regressions[name] = (base[key], stats[key])
+    return regressions
+
+
+def measure(func, *args, warmup: int=1, repeat: int=5, name: str=None, registry: TimingRegistry=None, **kwargs) -> TimingStats:
+    """Run func(*args, **kwargs) warmup times unrecorded, then repeat times recorded.
+
+    Returns:
+        TimingStats -- Statistics of recorded runs, also kept in registry if given
+    """
+    stats = (registry if registry is not None else TimingRegistry()).stats(name or func.__qualname__)
+    for _ in range(warmup):
+        func(*args, **kwargs)
+    for _ in range(repeat):
+        start = clock_ns()
+        func(*args, **kwargs)
+        stats.add(clock_ns() - start)
+    return stats
+
+
+def benchmark(func=None, *, name: str=None, warmup: int=0, repeat: int=1, echo: bool=True,
+    logger: logging.Logger=None, registry: TimingRegistry=None):
+    """Decorator which records elapsed time of each call into registry, works on async def functions too.
+    Ex.
+        @benchmark
+        def func(): ...
+
+        @benchmark(echo=False, warmup=10)
+        async def func(): ...
+
+    Keyword Arguments:
+        name {str} -- Name in registry (default: {qualified name of func})
+        warmup {int} -- First calls which are not recorded (default: {0})
+        repeat {int} -- Run func so many times per call, each is recorded, result of the last is returned (default: {1})
+        echo {bool} -- Report elapsed time of each call by logger (at DEBUG level) or print (default: {True})
+        logger {Logger} -- Logger to echo (default: {None})
+        registry {TimingRegistry} -- Registry to record into (default: {timings})
+    """
+    if func is None:
+        return functools.partial(benchmark, name=name, warmup=warmup, repeat=repeat, echo=echo, logger=logger, registry=registry)
+
+    stats_name = name or func.__qualname__
+    stats = (registry if registry is not None else timings).stats(stats_name)
+    calls = itertools.count(1)
+
+    def done(elapsed_ns: int):
+        if next(calls) <= warmup:
+            return
+        stats.add(elapsed_ns)
+        if echo:
+            line = f'Elapsed {elapsed_ns / 1e6:.3f} ms during running {stats_name}'
+            if logger is None:
+                print(line)
+            else:
+                logger.debug(line)
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            for _ in range(repeat):
+                start = clock_ns()
+                result = await func(*args, **kwargs)
+                done(clock_ns() - start)
+            return result
+        async_wrapper.stats = stats
+        return async_wrapper
+
+    if repeat == 1 and not warmup and not echo:
+        # Hot path, nothing but timing and recording
+        add = stats.add
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = clock_ns()
+            result = func(*args, **kwargs)
+            add(clock_ns() - start)
+            return result
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            for _ in range(repeat):
+                start = clock_ns()
+                result = func(*args, **kwargs)
+                done(clock_ns() - start)
+            return result
+    wrapper.stats = stats
+    return wrapper
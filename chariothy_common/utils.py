@@ -5,16 +5,24 @@ import functools
 import platform
 import warnings
 import copy
-from datetime import datetime
 import time
 import random
 import json
+import io
+import itertools
+import threading
 import re
 from typing import Union
+from collections import OrderedDict
+from collections.abc import Mapping, MutableMapping
+from types import MappingProxyType
+import weakref
 
 from .exception import AppToolError
+from .timing import benchmark
 
 REG_NUM_INDEX = re.compile(r'\[([\+\-]?\d+)\]')
+_MISSING = object()
 
 WIN = 'Windows'
 LINUX = 'Linux'
@@ -58,94 +66,507 @@ def get_home_dir():
     return expanduser('~')
 
 
-def deep_merge_in(dict1: dict, dict2: dict) -> dict:
+LIST_STRATEGIES = ('replace', 'append', 'index', 'key')
+_SCALAR_TYPES = frozenset((str, int, float, bool, type(None), bytes, object))
+_PLAIN_TYPES = _SCALAR_TYPES | {list, tuple}
+
+
+def _is_mapping(value) -> bool:
+    value_type = type(value)
+    return value_type is dict or (value_type not in _PLAIN_TYPES and isinstance(value, Mapping))
+
+
+def _is_list(value) -> bool:
+    return type(value) is list or type(value) is tuple
+
+
+def _copy_mapping(mapping: Mapping) -> MutableMapping:
+    """Shallow copy of mapping, keep its type if it's mutable (Ex. OrderedDict), else dict.
+    """
+    if type(mapping) is dict or (isinstance(mapping, MutableMapping) and hasattr(mapping, 'copy')):
+        return mapping.copy()
+    return dict(mapping)
+
+
+def _child_key(parent_key: str, key) -> str:
+    """Key of child item in format of get(), for conflict report.
+    """
+    if type(key) is _ListSlot:
+        return f'{parent_key}[{key}]'
+    key = str(key).replace('.', '#')
+    return parent_key + '.' + key if parent_key else key
+
+
+class _ListSlot(int):
+    """Index of list item, to be told from int key of dict in conflict report.
+    """
+
+
+def _check_list_strategy(list_strategy: str, list_key):
+    if list_strategy not in LIST_STRATEGIES:
+        raise AppToolError(f'Invalid list_strategy "{list_strategy}", should be one of {LIST_STRATEGIES}.')
+    if list_strategy == 'key' and list_key is None:
+        raise AppToolError('list_key is required if list_strategy is "key".')
+
+
+def _list_item_key(list_strategy: str, list_key, index: int, item):
+    """Key to match items of lists, None if item can not be matched.
+    """
+    if list_strategy == 'index':
+        return index
+    if _is_mapping(item) and list_key in item:
+        try:
+            hash(item[list_key])
+            return ('key', item[list_key])
+        except TypeError:
+            pass
+    return None
+
+
+def deep_merge_in(dict1: dict, dict2: dict, *, list_strategy: str='replace', list_key=None, conflicts: list=None) -> dict:
     """Deeply merge dictionary2 into dictionary1
+    Any mapping (Ex. OrderedDict) is merged, without recursion so very deep dictionaries are OK.
     
     Arguments:
         dict1 {dict} -- Dictionary female
         dict2 {dict} -- Dictionary mail to be added to dict1
+
+    Keyword Arguments:
+        list_strategy {str} -- How to merge lists (and tuples) in both dictionaries (default: {'replace'})
+            replace - list in dictionary2 replaces list in dictionary1
+            append  - list in dictionary2 is appended to list in dictionary1
+            index   - items at the same index are merged
+            key     - mapping items having the same value of list_key are merged, others are appended
+        list_key {any} -- Key of mapping items if list_strategy is 'key' (default: {None})
+        conflicts {list} -- If given, (key, old value, new value) is appended for every replaced different value,
+            key is in format of get() (default: {None})
     
     Returns:
         dict -- Merged dictionary
     """
-    if type(dict1) is dict and type(dict2) is dict:
-        for key in dict2.keys():
-            if key in dict1.keys() and type(dict1[key]) is dict and type(dict2[key]) is dict:
-                deep_merge_in(dict1[key], dict2[key])
-            else:
-                dict1[key] = dict2[key]
+    _check_list_strategy(list_strategy, list_key)
+    if not (isinstance(dict1, MutableMapping) and _is_mapping(dict2)):
+        return dict1
+
+    if list_strategy == 'replace' and conflicts is None and type(dict1) is dict and type(dict2) is dict:
+        stack = []
+        _merge_dicts_in(dict1, dict2, stack, 0)
+    else:
+        stack = [(dict1, dict2, '')]
+    while stack:
+        target, source, parent_key = stack.pop()
+        if _is_mapping(target):
+            items = source.items()
+        else:
+            # Lists merged by index or key in place
+            positions = {}
+            for index, item in enumerate(target):
+                item_key = _list_item_key(list_strategy, list_key, index, item)
+                if item_key is not None:
+                    positions.setdefault(item_key, index)
+            items = []
+            for index, item in enumerate(source):
+                item_key = _list_item_key(list_strategy, list_key, index, item)
+                position = positions.get(item_key) if item_key is not None else None
+                if position is None:
+                    target.append(item)
+                    if item_key is not None:
+                        positions[item_key] = len(target) - 1
+                else:
+                    items.append((_ListSlot(position), item))
+
+        for key, value in items:
+            old_value = target.get(key, _MISSING) if type(key) is not _ListSlot else target[key]
+            if old_value is not _MISSING:
+                if _is_mapping(value) and _is_mapping(old_value):
+                    if not isinstance(old_value, MutableMapping):
+                        old_value = target[key] = _copy_mapping(old_value)
+                    stack.append((old_value, value, _child_key(parent_key, key)))
+                    continue
+                if list_strategy != 'replace' and _is_list(value) and _is_list(old_value):
+                    if type(old_value) is not list:
+                        old_value = target[key] = list(old_value)
+                    if list_strategy == 'append':
+                        old_value.extend(value)
+                    else:
+                        stack.append((old_value, value, _child_key(parent_key, key)))
+                    continue
+                if conflicts is not None and old_value != value:
+                    conflicts.append((_child_key(parent_key, key), old_value, value))
+            target[key] = value
     return dict1
 
 
-def deep_merge(dict1: dict, dict2: dict) -> dict:
-    """Deeply merge dictionary2 and dictionary1 then return a new dictionary
+def deep_merge(dict1: dict, dict2: dict, *dicts, list_strategy: str='replace', list_key=None, conflicts: list=None) -> dict:
+    """Deeply merge dictionary2 (and more dictionaries) into dictionary1 then return a new dictionary
+    All dictionaries are merged in one pass, without recursion so very deep dictionaries are OK. 
+    Any mapping (Ex. OrderedDict) is merged, merged mapping keeps type of the first one if it's mutable.
+    Untouched items, including sub dictionaries, are shared with inputs instead of being copied, 
+    so treat the result as read-only or write it with put().
     
     Arguments:
         dict1 {dict} -- Dictionary female
         dict2 {dict} -- Dictionary mail to be added to dict1
+        dicts {dict} -- More dictionaries to be added in order, Ex. deep_merge(base, local, env, overrides)
+
+    Keyword Arguments:
+        list_strategy {str} -- Same as deep_merge_in() (default: {'replace'})
+        list_key {any} -- Same as deep_merge_in() (default: {None})
+        conflicts {list} -- Same as deep_merge_in() (default: {None})
     
     Returns:
         dict -- Merged dictionary
     """
-    if type(dict1) is dict and type(dict2) is dict:
-        dict1_copy = dict1.copy()
-        for key in dict2.keys():
-            if key in dict1.keys() and type(dict1[key]) is dict and type(dict2[key]) is dict:
-                dict1_copy[key] = deep_merge(dict1[key], dict2[key])
+    _check_list_strategy(list_strategy, list_key)
+    layers = (dict1, dict2) + dicts
+    if not all(_is_mapping(layer) for layer in layers):
+        return dict1
+    if not dicts and list_strategy == 'replace' and conflicts is None and type(dict1) is dict and type(dict2) is dict:
+        return _merge_dicts(dict1, dict2, 0)
+    return _merge_layers(layers, list_strategy, list_key, conflicts)
+
+
+# Fast paths of merging plain dicts recurse up to this depth, then go on without recursion
+_FAST_MERGE_DEPTH = 256
+
+
+def _merge_dicts_in(dict1: dict, dict2: dict, rest: list, depth: int):
+    """Fast path of deep_merge_in() for plain dicts with replace strategy and no conflict report.
+    Other mappings to be merged, and dicts deeper than _FAST_MERGE_DEPTH, are left in rest as (target, source, '').
+    """
+    for key, value in dict2.items():
+        value_type = type(value)
+        if value_type is not dict and (value_type in _PLAIN_TYPES or not isinstance(value, Mapping)):
+            dict1[key] = value
+            continue
+        old_value = dict1.get(key)
+        if value_type is dict and type(old_value) is dict:
+            if depth < _FAST_MERGE_DEPTH:
+                _merge_dicts_in(old_value, value, rest, depth + 1)
             else:
-                dict1_copy[key] = dict2[key]
-        return dict1_copy
-    return dict1
+                rest.append((old_value, value, ''))
+        elif _is_mapping(old_value):
+            rest.append((dict1, {key: value}, ''))
+        else:
+            dict1[key] = value
 
 
-def send_email(from_addr, to_addrs, subject: str, text_body: str='', smtp_config: dict={}, 
-    html_body: str=None, 
-    image_paths: Union[dict, tuple]=None, file_paths: Union[dict, tuple]=None, 
-    debug: bool=False, send_to_file: bool=False, email_file_dir=None
-    ) -> dict:
-    """Helper for sending email
+def _merge_dicts(dict1: dict, dict2: dict, depth: int) -> dict:
+    """Fast path of deep_merge() for 2 plain dicts with replace strategy and no conflict report.
+    """
+    merged = dict1.copy()
+    for key, value in dict2.items():
+        value_type = type(value)
+        if value_type is not dict and (value_type in _PLAIN_TYPES or not isinstance(value, Mapping)):
+            merged[key] = value
+            continue
+        old_value = merged.get(key)
+        if value_type is dict and type(old_value) is dict and depth < _FAST_MERGE_DEPTH:
+            merged[key] = _merge_dicts(old_value, value, depth + 1)
+        elif _is_mapping(old_value):
+            merged[key] = _merge_layers((old_value, value), 'replace', None, None)
+        else:
+            merged[key] = value
+    return merged
+
+
+def _merge_layers(layers: tuple, list_strategy: str, list_key, conflicts: list) -> dict:
+    """Merge all mappings of layers in one pass without recursion, see deep_merge().
+    """
+    merge_list = list_strategy != 'replace'
+    plain_types = _SCALAR_TYPES if merge_list else _PLAIN_TYPES
+    track = conflicts is not None
+    result = [_MappingGroup(layers)]
+    stack = [(result, 0, result[0], '')]
+    while stack:
+        parent, slot, group, parent_key = stack.pop()
+        if parent[slot] is not group:
+            # Group was replaced by a later layer
+            continue
+        if type(group) is _ListGroup:
+            if list_strategy == 'append':
+                parent[slot] = [item for sub_layer in group for item in sub_layer]
+                continue
+            parent[slot] = merged = list(group[0])
+            _merge_lists(merged, group, list_strategy, list_key, conflicts, parent_key, stack)
+        else:
+            first = group[0]
+            parent[slot] = merged = first.copy() if type(first) is dict else _copy_mapping(first)
+            # Sub mappings (or lists) in more than one layer are collected in a group in place, 
+            # which is replaced by the merged one later.
+            for layer in group[1:]:
+                for key, value in layer.items():
+                    value_type = type(value)
+                    if value_type is dict:
+                        group_type = _MappingGroup
+                    elif value_type in plain_types:
+                        group_type = None
+                    elif isinstance(value, Mapping):
+                        group_type = _MappingGroup
+                    elif merge_list and (value_type is list or value_type is tuple):
+                        group_type = _ListGroup
+                    else:
+                        group_type = None
+
+                    if group_type is not None:
+                        old_value = merged.get(key)
+                        old_type = type(old_value)
+                        if old_type is group_type:
+                            old_value.append(value)
+                            continue
+                        if group_type is _MappingGroup:
+                            same_type = old_type is dict or (old_type not in plain_types and old_type is not _ListGroup 
+                                                             and isinstance(old_value, Mapping))
+                        else:
+                            same_type = old_type is list or old_type is tuple
+                        if same_type:
+                            merged[key] = sub_group = group_type((old_value, value))
+                            stack.append((merged, key, sub_group, _child_key(parent_key, key) if track else None))
+                            continue
+                    if track and key in merged:
+                        old_value = merged[key]
+                        if type(old_value) in _GROUP_TYPES:
+                            old_value = old_value[-1]
+                        if old_value != value:
+                            conflicts.append((_child_key(parent_key, key), old_value, value))
+                    merged[key] = value
+    return result[0]
+
+
+class _MappingGroup(list):
+    """Mappings to be merged.
+    """
+
+
+class _ListGroup(list):
+    """Lists to be merged.
+    """
+
+
+_GROUP_TYPES = (_MappingGroup, _ListGroup)
+
+
+def _group_type(value):
+    """_MappingGroup, _ListGroup or None if value is not to be merged.
+    """
+    value_type = type(value)
+    if value_type is dict or (value_type not in _PLAIN_TYPES and value_type not in _GROUP_TYPES 
+                              and isinstance(value, Mapping)):
+        return _MappingGroup
+    if value_type is list or value_type is tuple:
+        return _ListGroup
+    return None
+
+
+def _merge_lists(merged: list, layers, list_strategy: str, list_key, conflicts: list, parent_key: str, stack: list):
+    """Merge items of list layers by index or key into merged, 
+    items which should be merged further are pushed to stack of deep_merge().
+    """
+    positions = {}
+    for index, item in enumerate(merged):
+        item_key = _list_item_key(list_strategy, list_key, index, item)
+        if item_key is not None:
+            positions.setdefault(item_key, index)
+
+    for layer in layers[1:]:
+        for index, item in enumerate(layer):
+            item_key = _list_item_key(list_strategy, list_key, index, item)
+            position = positions.get(item_key) if item_key is not None else None
+            if position is None:
+                if item_key is not None:
+                    positions[item_key] = len(merged)
+                merged.append(item)
+                continue
+
+            position = _ListSlot(position)
+            old_value = merged[position]
+            group_type = _group_type(item)
+            if group_type is not None:
+                if type(old_value) is group_type:
+                    old_value.append(item)
+                    continue
+                if _group_type(old_value) is group_type:
+                    merged[position] = group = group_type((old_value, item))
+                    stack.append((merged, position, group, _child_key(parent_key, position) if conflicts is not None else None))
+                    continue
+            if conflicts is not None:
+                if type(old_value) in _GROUP_TYPES:
+                    old_value = old_value[-1]
+                if old_value != item:
+                    conflicts.append((_child_key(parent_key, position), old_value, item))
+            merged[position] = item
+
+
+def put(dictionary: dict, key: str, value, replacement_for_dot_in_key: str=None) -> dict:
+    """Put value in a copy of dictionary, keys are connected by dot like get().
+    Only containers along the key path are copied (tuple becomes list), others are shared with dictionary.
+    Missing dictionaries along the key path are created, missing list items are not.
+    Ex. put({'a': {'b': [1, 2]}, 'c': {}}, 'a.b[-1]', 3) == {'a': {'b': [1, 3]}, 'c': {}}
+
+    Args:
+        dictionary (dict): dictionary data, which is not modified
+        key (str): Key for config item which are coneected by dot.
+        value (any): Value to put
+        replacement_for_dot_in_key (str, optional): Same as get(). Defaults to None.
+
+    Raises:
+        AppToolError: If an indexed key part is not a list or tuple, or index is out of range.
+
+    Returns:
+        dict: New dictionary
+    """
+    steps = _compile_key(key, replacement_for_dot_in_key)
+    root = node = dictionary.copy()
+    last_pos = len(steps) - 1
+    for pos, (key_part, key_indexes, _) in enumerate(steps):
+        if not key_indexes:
+            if pos == last_pos:
+                node[key_part] = value
+                break
+            child = node.get(key_part)
+            child = child.copy() if type(child) is dict else {}
+            node[key_part] = node = child
+            continue
+
+        child = node.get(key_part)
+        if type(child) is not list and type(child) is not tuple:
+            raise _get_error(steps, pos, 'Config is not list or tuple', child, pos, key_part)
+        items = node[key_part] = list(child)
+        for index_pos, key_index in enumerate(key_indexes):
+            try:
+                child = items[key_index]
+            except IndexError as ex:
+                raise _get_error(steps, pos, f'Invalid index "{key_index}", {ex}', items, pos, key_part)
+            if index_pos == len(key_indexes) - 1:
+                if pos == last_pos:
+                    items[key_index] = value
+                else:
+                    child = child.copy() if type(child) is dict else {}
+                    items[key_index] = node = child
+            elif type(child) is list or type(child) is tuple:
+                items[key_index] = items = list(child)
+            else:
+                raise _get_error(steps, pos, 'Config is not list or tuple', child, pos, key_part)
+    return root
+
+
+SMTP_SCHEMA = {
+    'host': str,
+    'port': int,
+    'user': str,
+    'pwd': str
+}
+
+TRUE_STRINGS = ('1', 'true', 'yes', 'y', 'on')
+FALSE_STRINGS = ('0', 'false', 'no', 'n', 'off', '')
+
+
+def _to_bool(value: str) -> bool:
+    lower_value = value.strip().lower()
+    if lower_value in TRUE_STRINGS:
+        return True
+    if lower_value in FALSE_STRINGS:
+        return False
+    raise ValueError(f'"{value}" is not a bool')
+
+
+def _to_list(value: str) -> list:
+    if value.lstrip().startswith('['):
+        data = json.loads(value)
+        if type(data) is not list:
+            raise ValueError(f'"{value}" is not a list')
+        return data
+    return [item.strip() for item in value.split(',')] if value.strip() else []
+
+
+def _to_dict(value: str) -> dict:
+    data = json.loads(value)
+    if type(data) is not dict:
+        raise ValueError(f'"{value}" is not a dict')
+    return data
+
+
+@functools.lru_cache(maxsize=None)
+def _converter(target):
+    """Get converter from str to target, converters are cached per target.
+    """
+    if target is None or target is type(None) or target is str:
+        return str
+    if target is bool:
+        return _to_bool
+    if target in (list, tuple):
+        return lambda value: target(_to_list(value))
+    if target is dict:
+        return _to_dict
+    return target
+
+
+def coerce(value, target):
+    """Coerce value (usually str from env) to target.
+    Ex. coerce('465', int) == 465
+        coerce('on', bool) == True
+        coerce('a, b', list) == ['a', 'b']
+        coerce('["a", "b"]', list) == ['a', 'b']
+        coerce('{"a": 1}', dict) == {'a': 1}
     
     Arguments:
-        from_addr {str|tuple} -- From address, can be email or (name, email).
-            Ex. : ('Henry TIAN', 'henrytian@163.com')
-                : 'Henry TIAN <henrytian@163.com>'
-        to_addrs {str|tuple} -- To address, can be email or list of emails or list of (name, email)
-            Ex. : (('Henry TIAN', 'henrytian@163.com'), ('Henry TIAN', 'chariothy@gmail.com'),)
-                : 'Henry TIAN <henrytian@163.com>,Henry TIAN <chariothy@gmail.com>'
-                : ('Henry TIAN <henrytian@163.com>', 'Henry TIAN <chariothy@gmail.com>')
-        subject {str} -- Email subject
-        text_body {str} -- Email text body
-        html_body {str} -- Email html body
-        image_paths {list|tuple} -- image file path array
-        file_paths {list|tuple} -- attachment file path array
-        smtp_config {dict} -- SMTP config for SMTPHandler (default: {{}}), Ex.: 
-        {
-            'host': 'smtp.163.com',
-            'port': 465,
-            'user': 'henrytian@163.com',
-            'pwd': '123456',
-            'type': 'plain'         # plain (default) / ssl / tls
-        }
-        debug {bool} -- If True output debug info.
-        send_to_file {str} -- File path for writing email info to text file.
-        
+        value {any} -- Value to be coerced, non-str value is only checked if target is a type.
+        target {type|callable} -- int, float, bool, list, tuple, dict, str or any converter like lambda v: v.lower()
+    
+    Raises:
+        AppToolError: If value can not be coerced.
+
     Returns:
-        dict -- Email sending errors. {} if success, else {receiver: message}.
+        any -- Coerced value
     """
-    assert(type(from_addr) in (str, tuple, list))
-    assert(type(to_addrs) in (str, tuple, list))
-    assert(type(subject) is str)
-    assert(type(text_body) is str or type(html_body) is str)
-    assert(type(smtp_config) is dict)
+    try:
+        if type(value) is str:
+            return _converter(target)(value)
+        if isinstance(target, type):
+            if target is float and type(value) is int:
+                return float(value)
+            if not isinstance(value, target):
+                raise TypeError(f'{value!r} is not {target.__name__}')
+            return value
+        return target(value)
+    except Exception as ex:
+        raise AppToolError(f'Failed to coerce {value!r} to {getattr(target, "__name__", target)}: {ex}')
 
-    if send_to_file:
-        if not email_file_dir:
-            email_file_dir = os.path.join(os.getcwd(), 'logs')
-        if not os.path.exists(email_file_dir):
-            os.mkdir(email_file_dir)
 
-    #TODO: Use schema to validate smtp_config
+def coerce_config(config: dict, schema: dict, name: str='config') -> dict:
+    """Validate config by schema and coerce its items, return a new dict.
+    Ex. coerce_config({'host': 'smtp.163.com', 'port': '465', 'user': 'u', 'pwd': 'p'}, SMTP_SCHEMA)['port'] == 465
     
+    Arguments:
+        config {dict} -- Config to be validated
+        schema {dict} -- {key: target of coerce()}, all keys are required, keys not in schema are kept as is.
+        name {str} -- Config name in error message (default: {'config'})
+
+    Raises:
+        AppToolError: If config is not dict, or any key is missing or its value can not be coerced.
+
+    Returns:
+        dict -- Coerced config
+    """
+    if type(config) is not dict:
+        raise AppToolError(f'Invalid {name}: {config!r} is not dict.')
+    result = config.copy()
+    for key, target in schema.items():
+        if key not in config:
+            raise AppToolError(f'Invalid {name}: "{key}" is required.')
+        try:
+            result[key] = coerce(config[key], target)
+        except AppToolError as ex:
+            raise AppToolError(f'Invalid {name}: "{key}", {ex}')
+    return result
+
+
+def _format_addrs(from_addr, to_addrs) -> tuple:
+    """Format from and to addresses of send_email() into header strings.
+    """
+    assert(type(from_addr) in (str, tuple, list))
+    assert(type(to_addrs) in (str, tuple, list))
+
     if type(from_addr) in (tuple, list):
         assert(len(from_addr) == 2)
         # @deprecated 字符串形式更方便docker用环境变量
@@ -175,10 +596,28 @@ def send_email(from_addr, to_addrs, subject: str, text_body: str='', smtp_config
             to_addrs = ','.join(to_addrs)
     # else: 
     # Ex. to_addrs == 'Henry TIAN <chariothy@gmail.com>,Henry TIAN <6314849@qq.com>'
+    return from_addr, to_addrs
+
+
+def _load_images(image_paths) -> list:
+    """Inline MIME parts of images, each one has a unique Content-ID. Small files are cached, large ones streamed.
+    """
+    from .email_assets import image_part
+    return [image_part(image_path) for image_path in image_paths or ()]
+
+
+def _load_attachments(file_paths) -> list:
+    """Attachment MIME parts of files. Small files are cached, large ones streamed.
+    """
+    from .email_assets import attachment_part
+    return [attachment_part(file_path) for file_path in file_paths or ()]
+
 
+def _build_message(from_addr: str, to_addrs: str, subject: str, text_body: str, html_body: str, 
+    image_parts: list, file_parts: list):
+    """Build EmailMessage, parts of images and files are attached as is, so they can be shared by messages.
+    """
     from email.message import EmailMessage
-    from email.utils import make_msgid
-    from mimetypes import guess_type
 
     msg = EmailMessage()
     # generic email headers
@@ -190,74 +629,231 @@ def send_email(from_addr, to_addrs, subject: str, text_body: str='', smtp_config
     msg.set_content(text_body)
 
     if html_body:
-        img_nodes = []
-        if image_paths and len(image_paths) > 0:
-            for image_path in image_paths:
-                # print(guess_type(image_path)[0].split('/', 1))
-                with open(image_path, 'rb') as fp:
-                    img_nodes.append({
-                        'cid': make_msgid('chariothy_common'),
-                        'bin': fp.read(),
-                        'type': guess_type(image_path)[0].split('/', 1)
-                    })
+        if image_parts:
             # note that we needed to peel the <> off the msgid for use in the html.
-            html_body = html_body.format(*(x['cid'][1:-1] for x in img_nodes))
+            html_body = html_body.format(*(part['Content-ID'][1:-1] for part in image_parts))
         msg.add_alternative(html_body, subtype='html')
 
-        for img_node in img_nodes:
-            maintype, subtype = img_node['type']
-            msg.get_payload()[1].add_related(
-                img_node['bin'],
-                maintype=maintype, 
-                subtype=subtype, 
-                cid=img_node['cid']
-            )
-
-    if file_paths and len(file_paths) > 0:
-        for file_path in file_paths:
-            ctype, encoding = guess_type(file_path)
-            if ctype is None or encoding is not None:
-                # No guess could be made, or the file is encoded (compressed), so
-                # use a generic bag-of-bits type.
-                ctype = 'application/octet-stream'
-            maintype, subtype = ctype.split('/', 1)
-            
-            with open(file_path, 'rb') as fp:
-                file_name = os.path.basename(file_path)
-                msg.add_attachment(fp.read(),
-                    maintype=maintype,
-                    subtype=subtype,
-                    filename=file_name
-                )
+        if image_parts:
+            html_part = msg.get_payload()[1]
+            html_part.make_related()
+            for part in image_parts:
+                html_part.attach(part)
+
+    if file_parts:
+        msg.make_mixed()
+        for part in file_parts:
+            msg.attach(part)
+    return msg
+
+
+def _write_email_file(msg, email_file_dir: str, suffix: str=''):
+    from .email_assets import write_message
+    email_file_name = now().replace(' ', '_').replace(':', '-') + '_' + str(random.randint(1000, 9999)) + suffix + '.txt'
+    with open(os.path.join(email_file_dir, email_file_name), 'wb') as fp:
+        write_message(msg, fp)
+
+
+def _prepare_email_file_dir(email_file_dir):
+    if not email_file_dir:
+        email_file_dir = os.path.join(os.getcwd(), 'logs')
+    if not os.path.exists(email_file_dir):
+        os.mkdir(email_file_dir)
+    return email_file_dir
+
+
+def send_email(from_addr, to_addrs, subject: str, text_body: str='', smtp_config: dict={}, 
+    html_body: str=None, 
+    image_paths: Union[dict, tuple]=None, file_paths: Union[dict, tuple]=None, 
+    debug: bool=False, send_to_file: bool=False, email_file_dir=None, smtp_pool=None, spool=None
+    ) -> dict:
+    """Helper for sending email
+    
+    Arguments:
+        from_addr {str|tuple} -- From address, can be email or (name, email).
+            Ex. : ('Henry TIAN', 'henrytian@163.com')
+                : 'Henry TIAN <henrytian@163.com>'
+        to_addrs {str|tuple} -- To address, can be email or list of emails or list of (name, email)
+            Ex. : (('Henry TIAN', 'henrytian@163.com'), ('Henry TIAN', 'chariothy@gmail.com'),)
+                : 'Henry TIAN <henrytian@163.com>,Henry TIAN <chariothy@gmail.com>'
+                : ('Henry TIAN <henrytian@163.com>', 'Henry TIAN <chariothy@gmail.com>')
+        subject {str} -- Email subject
+        text_body {str} -- Email text body
+        html_body {str} -- Email html body
+        image_paths {list|tuple} -- image file path array
+        file_paths {list|tuple} -- attachment file path array
+        smtp_config {dict} -- SMTP config for SMTPHandler (default: {{}}), Ex.: 
+        {
+            'host': 'smtp.163.com',
+            'port': 465,
+            'user': 'henrytian@163.com',
+            'pwd': '123456',
+            'type': 'plain'         # plain (default) / ssl / tls
+        }
+        debug {bool} -- If True output debug info.
+        send_to_file {str} -- File path for writing email info to text file.
+        smtp_pool {SMTPPool} -- If given, logged-in SMTP session is reused from the pool, 
+            else a new session is opened and closed for this email.
+        spool {MailSpool} -- If given, email is put into the spool and sent by its worker later, 
+            it returns as soon as the email is on disk.
+        
+    Returns:
+        dict -- Email sending errors. {} if success, else {receiver: message}.
+    """
+    assert(type(subject) is str)
+    assert(type(text_body) is str or type(html_body) is str)
+    assert(type(smtp_config) is dict)
+
+    if send_to_file:
+        email_file_dir = _prepare_email_file_dir(email_file_dir)
+
+    from_addr, to_addrs = _format_addrs(from_addr, to_addrs)
+    msg = _build_message(from_addr, to_addrs, subject, text_body, html_body, 
+                         _load_images(image_paths) if html_body else None, _load_attachments(file_paths))
     
     if send_to_file or debug:
-        email_file_name = now().replace(' ', '_').replace(':', '-') + '_' + str(random.randint(1000, 9999)) + '.txt'
-        from email.policy import SMTP
-        with open(os.path.join(email_file_dir, email_file_name), 'wb') as fp:
-            fp.write(msg.as_bytes(policy=SMTP))
+        _write_email_file(msg, email_file_dir)
         result = {}
 
     if not send_to_file:
-        from smtplib import SMTP, SMTP_SSL
-        if smtp_config.get('type') == 'ssl':
-            server = SMTP_SSL(smtp_config['host'], smtp_config['port'])
-        elif smtp_config.get('type') == 'tls':
-            server = SMTP(smtp_config['host'], smtp_config['port'])
-            server.starttls()
-        else:
-            server = SMTP(smtp_config['host'], smtp_config['port'])
-        
-        server.ehlo()
-        if debug:
-            server.set_debuglevel(1)
-        server.login(smtp_config['user'], smtp_config['pwd'])
+        if spool is not None:
+            spool.put(msg)
+            return {}
+        smtp_config = coerce_config(smtp_config, SMTP_SCHEMA, 'smtp_config')
+        if smtp_pool is not None:
+            return smtp_pool.send_message(smtp_config, msg, debug)
 
+        from .smtp_pool import connect_smtp
+        from .email_assets import send_message
+        server = connect_smtp(smtp_config, debug)
         #result = server.sendmail(from_addr, to_addrs, msg.as_string())
-        result = server.send_message(msg)
+        result = send_message(server, msg)
         server.quit()
     return result
 
 
+def send_emails(from_addr, messages, subject: str='', text_body: str='', smtp_config: dict={}, 
+    html_body: str=None, 
+    image_paths: Union[dict, tuple]=None, file_paths: Union[dict, tuple]=None, 
+    sessions: int=2, messages_per_session: int=100, 
+    debug: bool=False, send_to_file: bool=False, email_file_dir=None, smtp_pool=None
+    ) -> list:
+    """Send many emails over a few SMTP sessions in parallel.
+    Images and files are loaded once and shared by all messages, messages are built while being sent, 
+    so messages can be a generator of thousands of receivers.
+    Ex. send_emails(from_addr, ('a@163.com', {'to_addrs': 'b@163.com', 'subject': 'Hi B'}), 'Hi', 'Daily digest', smtp_config)
+
+    Arguments:
+        from_addr {str|tuple} -- Same as send_email()
+        messages {iterable} -- Message specs, each one is to_addrs of send_email() or a dict of 
+            {'to_addrs': ..., 'subject': ..., 'text_body': ..., 'html_body': ...}, missing items are taken from arguments.
+
+    Keyword Arguments:
+        subject, text_body, smtp_config, html_body, image_paths, file_paths, debug, send_to_file, email_file_dir, 
+        smtp_pool -- Same as send_email()
+        sessions {int} -- Max SMTP sessions sending in parallel (default: {2})
+        messages_per_session {int} -- A session is closed and a new one opened after sending so many messages 
+            (default: {100})
+
+    Returns:
+        list -- Email sending errors of messages in order, each one is {} if success, else {receiver: message}.
+    """
+    from smtplib import SMTPException, SMTPResponseException, SMTPRecipientsRefused
+    from .smtp_pool import connect_smtp, close_smtp, send_smtp_message
+    assert(type(smtp_config) is dict)
+    assert(sessions > 0 and messages_per_session > 0)
+
+    if send_to_file:
+        email_file_dir = _prepare_email_file_dir(email_file_dir)
+    else:
+        smtp_config = coerce_config(smtp_config, SMTP_SCHEMA, 'smtp_config')
+
+    from_addr = _format_addrs(from_addr, '')[0]
+    image_parts = _load_images(image_paths)
+    file_parts = _load_attachments(file_paths)
+    specs = enumerate(messages)
+    specs_lock = threading.Lock()
+    results = []
+    errors = []
+
+    def next_message():
+        with specs_lock:
+            spec = next(specs, None)
+        if spec is None:
+            return None
+        index, spec = spec
+        if type(spec) is not dict:
+            spec = {'to_addrs': spec}
+        msg_subject = spec.get('subject', subject)
+        msg_text_body = spec.get('text_body', text_body)
+        msg_html_body = spec.get('html_body', html_body)
+        assert(type(msg_subject) is str)
+        assert(type(msg_text_body) is str or type(msg_html_body) is str)
+        to_addrs = _format_addrs(from_addr, spec['to_addrs'])[1]
+        return index, _build_message(from_addr, to_addrs, msg_subject, msg_text_body, msg_html_body, 
+                                     image_parts if msg_html_body else None, file_parts)
+
+    def send_all():
+        server = None
+        sent = 0
+        try:
+            while True:
+                message = next_message()
+                if message is None:
+                    break
+                index, msg = message
+                if send_to_file or debug:
+                    _write_email_file(msg, email_file_dir, f'_{index}')
+                if send_to_file:
+                    results.append((index, {}))
+                    continue
+
+                if server is not None and sent >= messages_per_session:
+                    close_smtp(server)
+                    server = None
+                if server is None:
+                    server = smtp_pool.acquire(smtp_config, debug) if smtp_pool is not None else connect_smtp(smtp_config, debug)
+                    sent = 0
+                try:
+                    server, result = send_smtp_message(server, smtp_config, msg, debug)
+                except SMTPRecipientsRefused as ex:
+                    result = ex.recipients
+                except SMTPResponseException as ex:
+                    result = {receiver: (ex.smtp_code, ex.smtp_error) for receiver in _receivers(msg)}
+                except (SMTPException, OSError) as ex:
+                    result = {receiver: (-1, str(ex)) for receiver in _receivers(msg)}
+                    server.close()
+                    server = None
+                sent += 1
+                results.append((index, result))
+        except BaseException as ex:
+            errors.append(ex)
+        finally:
+            if server is not None:
+                if smtp_pool is not None and sent < messages_per_session:
+                    smtp_pool.release(smtp_config, server)
+                else:
+                    close_smtp(server)
+
+    if sessions == 1 or send_to_file:
+        send_all()
+    else:
+        workers = [threading.Thread(target=send_all, daemon=True) for _ in range(sessions)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    if errors:
+        raise errors[0]
+    results.sort(key=lambda result: result[0])
+    return [result for _, result in results]
+
+
+def _receivers(msg) -> list:
+    from email.utils import getaddresses
+    return [addr for _, addr in getaddresses(msg.get_all('To', []))]
+
+
 def alignment(s, space, align='left'):
     """中英文混排对齐
     中英文混排时对齐是比较麻烦的，一个先决条件是必须是等宽字体，每个汉字占2个英文字符的位置。
@@ -349,103 +945,707 @@ def get(dictionary: dict, key:str, default=None, check:bool=False, replacement_f
     Returns:
         any: return config value
     """
-    key_parts = key.split('.')
+    steps = _compile_key(key, replacement_for_dot_in_key)
     config = dictionary
-    parsed_keys = []
-    
-    for key_part in key_parts:
-        if replacement_for_dot_in_key:
-            key_part = key_part.replace(replacement_for_dot_in_key, '.')
-        parsed_keys.append(key_part)
-        parsing_key = '.'.join(parsed_keys)
-        config_str = f'Config("{parsing_key}")={config}'
 
-        idx_parts = REG_NUM_INDEX.split(key_part)   # REG_NUM_INDEX.split('a[-1][0]') => ['a', '-1', '', '0', '']
-        if len(idx_parts) == 1:
+    for pos, (key_part, key_indexes, _) in enumerate(steps):
+        if not key_indexes:
             # no numberic index
             # not array, it's a dict
-            amend_parsed_key = '.'.join(parsed_keys[:-1])
-            config_str = f'Config("{amend_parsed_key}")={config}'
             if check:
                 if type(config) is not dict:
-                    raise AppToolError(f'Failed to get config at "{parsing_key}": Config is not dict. {config_str}')
-
+                    raise _get_error(steps, pos, 'Config is not dict', config)
                 if key_part not in config:
-                    raise AppToolError(f'Failed to get config at "{parsing_key}": "{key_part}" is not in config. {config_str}')
-
-            try:
-                config = config.get(key_part, default)
-            except (AttributeError, TypeError) as ex:
-                if check:
-                    raise AppToolError(f'Failed to get config at "{parsing_key}": {ex}. {config_str}')
-                config = default
+                    raise _get_error(steps, pos, f'"{key_part}" is not in config', config)
+                config = config[key_part]
+            else:
+                try:
+                    config = config.get(key_part, default)
+                except (AttributeError, TypeError):
+                    config = default
         else:
             # has numberic index
             # is list or tuple
-            if idx_parts[0] == '':
-                raise AppToolError(f'Failed to get config at "{parsing_key}": "{key_part}" should have parent.')
-            if idx_parts[-1] != '':
-                raise AppToolError(f'Failed to get config at "{parsing_key}": "{key_part}" should be at the tail.')
-
-            key_indexes = list(filter(lambda x: x, idx_parts))
-            key_indexes.reverse()
-            key_part = key_indexes.pop()
-            key_indexes.reverse()
             if type(config) is not dict or key_part not in config:
-                raise AppToolError(f'Failed to get config at "{parsing_key}": "{key_part}" is not in config. {config_str}')
+                raise _get_error(steps, pos, f'"{key_part}" is not in config', config, pos + 1)
 
             config = config[key_part]
-            amend_parsed_keys = parsed_keys[:-1]
-            amend_parsed_keys.append(key_part)
-            amend_parsed_key = '.'.join(amend_parsed_keys)
-            config_str = f'Config("{amend_parsed_key}")={config}'
             if type(config) is not list and type(config) is not tuple:
-                raise AppToolError(f'Failed to get config at "{parsing_key}": Config is not list or tuple. {config_str}')
-                
+                raise _get_error(steps, pos, 'Config is not list or tuple', config, pos, key_part)
+
+            items = config
             for key_index in key_indexes:
                 try:
-                    key_index = int(key_index)
                     config = config[key_index]
-                except (ValueError, IndexError) as ex:
-                    raise AppToolError(f'Failed to get config at "{parsing_key}": Invalid index "{key_index}", {ex}. {config_str}')
+                except IndexError as ex:
+                    raise _get_error(steps, pos, f'Invalid index "{key_index}", {ex}', items, pos, key_part)
 
     return config
 
 
-def benchmark(func):
-    """This is a decorator which can be used to benchmark time elapsed during running func."""
-    @functools.wraps(func)
-    def new_func(*args, **kwargs):
-        start = datetime.now()
-        result = func(*args, **kwargs)
-        end = datetime.now()
-        elapsed = (end - start).microseconds
-        print(f'Elapsed {elapsed} ms during running {func.__name__}')
-        return result
-    return new_func
+@functools.lru_cache(maxsize=1024)
+def _compile_key(key: str, replacement_for_dot_in_key: str=None) -> tuple:
+    """Parse a key of get() into an immutable tuple of steps, parsed keys are cached (LRU).
+    Ex. _compile_key('a.b[0][-1]') == (('a', (), 'a'), ('b', (0, -1), 'b[0][-1]'))
+
+    Args:
+        key (str): Key for config item which are coneected by dot.
+        replacement_for_dot_in_key (str, optional): Same as get().
+
+    Raises:
+        AppToolError: If an indexed key part is malformed.
+
+    Returns:
+        tuple: (dict key, tuple of int indexes, key part) for each key part.
+    """
+    steps = []
+    parsed_keys = []
+    for key_part in key.split('.'):
+        if replacement_for_dot_in_key:
+            key_part = key_part.replace(replacement_for_dot_in_key, '.')
+        parsed_keys.append(key_part)
+
+        idx_parts = REG_NUM_INDEX.split(key_part)   # REG_NUM_INDEX.split('a[-1][0]') => ['a', '-1', '', '0', '']
+        if len(idx_parts) == 1:
+            steps.append((key_part, (), key_part))
+            continue
+
+        parsing_key = '.'.join(parsed_keys)
+        if idx_parts[0] == '':
+            raise AppToolError(f'Failed to get config at "{parsing_key}": "{key_part}" should have parent.')
+        if idx_parts[-1] != '':
+            raise AppToolError(f'Failed to get config at "{parsing_key}": "{key_part}" should be at the tail.')
+
+        key_indexes = []
+        for key_index in filter(lambda x: x, idx_parts[1:]):
+            try:
+                key_indexes.append(int(key_index))
+            except ValueError as ex:
+                raise AppToolError(f'Failed to get config at "{parsing_key}": Invalid index "{key_index}", {ex}.')
+        steps.append((idx_parts[0], tuple(key_indexes), key_part))
+    return tuple(steps)
+
+
+def _get_error(steps: tuple, pos: int, reason: str, config, config_pos: int=None, config_key: str=None) -> AppToolError:
+    """Build the error of get() lazily, only when a lookup actually fails.
+    """
+    parsed_keys = [step[2] for step in steps]
+    config_keys = parsed_keys[:pos if config_pos is None else config_pos]
+    if config_key is not None:
+        config_keys.append(config_key)
+    parsing_key = '.'.join(parsed_keys[:pos + 1])
+    config_key = '.'.join(config_keys)
+    return AppToolError(f'Failed to get config at "{parsing_key}": {reason}. Config("{config_key}")={config}')
+
+
+def flatten(dictionary: dict, replacement_for_dot_in_key: str='#') -> dict:
+    """Flatten dictionary into {key: value} for every key which can be got by get().
+    Values are shared with dictionary, so containers are also in result under their own keys.
+    Ex. flatten({'a': {'b.c': [[1]]}}) == {
+            'a': {'b.c': [[1]]},
+            'a.b#c': [[1]],
+            'a.b#c[0]': [1], 'a.b#c[-1]': [1],
+            'a.b#c[0][0]': 1, 'a.b#c[0][-1]': 1
+        }
+    Items which can not be got by get() with the same replacement_for_dot_in_key are skipped,
+    such as non-str keys, keys containing replacement_for_dot_in_key or looking like "a[0]".
+
+    Args:
+        dictionary (dict): dictionary data
+        replacement_for_dot_in_key (str, optional): Same as get(). Defaults to '#'.
+
+    Returns:
+        dict: flattened dictionary
+    """
+    flat = {}
+    nodes = [('', dictionary)]
+    while nodes:
+        parent_key, node = nodes.pop()
+        if type(node) is dict:
+            for key, value in node.items():
+                if type(key) is not str or REG_NUM_INDEX.search(key):
+                    continue
+                if replacement_for_dot_in_key and replacement_for_dot_in_key in key:
+                    continue
+                if '.' in key:
+                    if not replacement_for_dot_in_key:
+                        continue
+                    key = key.replace('.', replacement_for_dot_in_key)
+                full_key = parent_key + '.' + key if parent_key else key
+                flat[full_key] = value
+                nodes.append((full_key, value))
+        elif parent_key and type(node) in (list, tuple):
+            length = len(node)
+            for index, value in enumerate(node):
+                full_key = f'{parent_key}[{index}]'
+                flat[full_key] = value
+                flat[f'{parent_key}[{index - length}]'] = value
+                nodes.append((full_key, value))
+    return flat
+
+
+def diff_keys(dict1: dict, dict2: dict, replacement_for_dot_in_key: str='#') -> set:
+    """Get keys (in format of get()) of items which are different between dict1 and dict2.
+    Dictionaries are compared deeply, other values (including lists) are compared as a whole.
+    Ex. diff_keys({'a': {'b': 1, 'c': 2}}, {'a': {'b': 1, 'c': 3}, 'd': 4}) == {'a.c', 'd'}
+
+    Args:
+        dict1 (dict): old dictionary
+        dict2 (dict): new dictionary
+        replacement_for_dot_in_key (str, optional): Same as get(). Defaults to '#'.
+
+    Returns:
+        set: keys of added, removed or changed items
+    """
+    keys = set()
+    nodes = [('', dict1, dict2)]
+    while nodes:
+        parent_key, node1, node2 = nodes.pop()
+        for key in node1.keys() | node2.keys():
+            value1 = node1.get(key, _MISSING)
+            value2 = node2.get(key, _MISSING)
+            if value1 is value2:
+                continue
+            key = str(key)
+            if replacement_for_dot_in_key:
+                key = key.replace('.', replacement_for_dot_in_key)
+            full_key = parent_key + '.' + key if parent_key else key
+            if type(value1) is dict and type(value2) is dict:
+                nodes.append((full_key, value1, value2))
+            elif value1 is _MISSING or value2 is _MISSING or value1 != value2:
+                keys.add(full_key)
+    return keys
 
 
 def random_sleep(min=0, max=3):
     time.sleep(random.uniform(min, max))
 
 
-def load_json(file_path, default=None):
-    data = default
-    if os.path.exists(file_path):
+class _FileLock(object):
+    """Advisory lock of file_path by a sidecar file file_path.lock, so it survives os.replace() of file_path.
+    Shared (read) or exclusive (write) by fcntl.flock on POSIX, always exclusive by msvcrt.locking on Windows.
+    flock locks open files, so it also locks threads of the same process out.
+    """
+    def __init__(self, file_path, exclusive: bool=True):
+        self.lock_path = f'{file_path}.lock'
+        self.exclusive = exclusive
+        self._fp = None
+
+
+    def __enter__(self):
+        dir_path = os.path.dirname(self.lock_path)
+        if dir_path and not os.path.exists(dir_path):
+            os.makedirs(dir_path, exist_ok=True)
+        self._fp = open(self.lock_path, 'a+b')
+        try:
+            if is_win():
+                import msvcrt
+                while True:
+                    try:
+                        self._fp.seek(0)
+                        msvcrt.locking(self._fp.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        # LK_LOCK gives up after 10 seconds
+                        continue
+            else:
+                import fcntl
+                fcntl.flock(self._fp, fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH)
+        except BaseException:
+            self._fp.close()
+            raise
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if is_win():
+                import msvcrt
+                self._fp.seek(0)
+                msvcrt.locking(self._fp.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self._fp, fcntl.LOCK_UN)
+        finally:
+            self._fp.close()
+
+
+class JsonCache(object):
+    """Parsed JSON files keyed by absolute path and validated by (mtime_ns, size, inode) of os.stat(),
+    so a file is parsed again only if it's changed. dump_json() of the same process invalidates its file.
+    Data is kept marshalled, which is loaded as a copy faster than JSON is parsed,
+    and as a read-only view (dict as MappingProxyType, list as tuple) once it's asked for.
+    Memory held by a file is the marshalled bytes plus the view estimated by sys.getsizeof(),
+    files are evicted by LRU when it adds up over max_bytes, and a file holding more than max_item_bytes is not cached.
+    """
+    def __init__(self, max_bytes: int=64 * 1024 * 1024, max_item_bytes: int=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self._entries = OrderedDict()   # {path: [(mtime_ns, size, inode), marshalled data, read-only data or None, bytes held]}, least recently used first
+        self._bytes = 0
+        self._lock = threading.Lock()
+        _json_caches.add(self)
+
+
+    @property
+    def bytes(self) -> int:
+        return self._bytes
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def load(self, file_path, default=None, readonly: bool=False, lock: bool=False):
+        """Cached data of file_path, see load_json().
+        """
+        import marshal
+        path = os.path.abspath(file_path)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.invalidate(path)
+            return default
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == (stat.st_mtime_ns, stat.st_size, stat.st_ino):
+                self._entries.move_to_end(path)
+            else:
+                entry = None
+
+        if entry is not None:
+            if not readonly:
+                return marshal.loads(entry[1])
+            frozen = entry[2]
+            if frozen is None:
+                frozen = _freeze_json(marshal.loads(entry[1]))
+                self._add_frozen(path, entry, frozen)
+            return frozen
+
+        try:
+            if lock:
+                with _FileLock(path, exclusive=False):
+                    stamp, data = _read_json(path)
+            else:
+                stamp, data = _read_json(path)
+        except FileNotFoundError:
+            self.invalidate(path)
+            return default
+        # Just parsed data is not shared yet, so it's returned as the copy
+        blob = marshal.dumps(data)
+        if readonly:
+            frozen = _freeze_json(data)
+            self._put(path, [stamp, blob, frozen, len(blob) + _json_bytes(frozen)])
+            return frozen
+        self._put(path, [stamp, blob, None, len(blob)])
+        return data
+
+
+    def _put(self, path, entry):
+        with self._lock:
+            old = self._entries.pop(path, None)
+            if old is not None:
+                self._bytes -= old[3]
+            if entry[3] > self.max_item_bytes:
+                return
+            self._entries[path] = entry
+            self._bytes += entry[3]
+            self._evict()
+
+
+    def _add_frozen(self, path, entry, frozen):
+        size = _json_bytes(frozen)
+        with self._lock:
+            if self._entries.get(path) is not entry or entry[2] is not None:
+                return
+            if entry[3] + size > self.max_item_bytes:
+                del self._entries[path]
+                self._bytes -= entry[3]
+                return
+            entry[2] = frozen
+            entry[3] += size
+            self._bytes += size
+            self._evict()
+
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted[3]
+
+
+    def invalidate(self, file_path):
+        with self._lock:
+            entry = self._entries.pop(os.path.abspath(file_path), None)
+            if entry is not None:
+                self._bytes -= entry[3]
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+_json_caches = weakref.WeakSet()
+json_cache = JsonCache()
+
+
+def _invalidate_json_caches(file_path):
+    for cache in list(_json_caches):
+        cache.invalidate(file_path)
+
+
+def _read_json(path) -> tuple:
+    """((mtime_ns, size, inode), data) of the file which is actually read.
+    """
+    with open(path, 'r', encoding='utf8') as fp:
+        stat = os.fstat(fp.fileno())
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino), json.load(fp)
+
+
+_JSON_CONTAINERS = (dict, list)
+_PROXY_BYTES = sys.getsizeof(MappingProxyType({}))
+
+
+def _freeze_json(value):
+    kind = type(value)
+    if kind is dict:
+        return MappingProxyType({key: _freeze_json(item) if type(item) in _JSON_CONTAINERS else item 
+                                 for key, item in value.items()})
+    if kind is list:
+        return tuple(_freeze_json(item) if type(item) in _JSON_CONTAINERS else item for item in value)
+    return value
+
+
+def _json_bytes(frozen) -> int:
+    """Estimated memory held by read-only data from _freeze_json().
+    """
+    getsizeof = sys.getsizeof
+    if type(frozen) is MappingProxyType:
+        # The proxied dict is sized like a copy of the proxy
+        return _PROXY_BYTES + getsizeof(dict(frozen)) + sum(getsizeof(key) + _json_bytes(item) for key, item in frozen.items())
+    if type(frozen) is tuple:
+        return getsizeof(frozen) + sum(_json_bytes(item) for item in frozen)
+    return getsizeof(frozen)
+
+
+def _load_json(file_path, default):
+    try:
         with open(file_path, 'r', encoding='utf8') as fp:
-            data = json.load(fp)
+            return json.load(fp)
+    except FileNotFoundError:
+        return default
+
+
+def _dump_json(file_path, data, indent, ensure_ascii, atomic):
+    dir_path = os.path.dirname(file_path)
+    if dir_path and not os.path.exists(dir_path):
+        os.makedirs(dir_path, exist_ok=True)
+    if not atomic:
+        with open(file_path, 'w', encoding='utf8') as fp:
+            json.dump(data, fp, indent=indent, ensure_ascii=ensure_ascii)
+        return
+
+    # Replace target of symlink, not symlink itself
+    file_path = os.path.realpath(file_path)
+    dir_path = os.path.dirname(file_path)
+    tmp_path = f'{file_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_path, 'w', encoding='utf8') as fp:
+            json.dump(data, fp, indent=indent, ensure_ascii=ensure_ascii)
+            fp.flush()
+            os.fsync(fp.fileno())
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            stat = None
+        if stat is not None:
+            os.chmod(tmp_path, stat.st_mode & 0o7777)
+            if hasattr(os, 'chown') and (stat.st_uid, stat.st_gid) != (os.getuid(), os.getgid()):
+                try:
+                    os.chown(tmp_path, stat.st_uid, stat.st_gid)
+                except PermissionError:
+                    pass
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    if not is_win():
+        # Persist the rename itself
+        dir_fd = os.open(dir_path or '.', os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+def load_json(file_path, default=None, lock: bool=False, cache=False, readonly: bool=False):
+    """Load JSON file.
+
+    Arguments:
+        file_path {str} -- JSON file path
+
+    Keyword Arguments:
+        default {any} -- Returned if file does not exist (default: {None})
+        lock {bool} -- Hold a shared lock while reading, so it waits for dump_json(lock=True) of other processes (default: {False})
+        cache {bool|JsonCache} -- If True (json_cache) or a JsonCache, parse file only if it's changed since last load (default: {False})
+        readonly {bool} -- Return read-only data (dict as MappingProxyType, list as tuple), 
+            cached data is returned without copying (default: {False})
+
+    Returns:
+        any -- Loaded data
+    """
+    if cache is True or isinstance(cache, JsonCache):
+        # Not by truth value, an empty JsonCache is falsy
+        return (json_cache if cache is True else cache).load(file_path, default, readonly, lock)
+    if not lock or not os.path.exists(os.path.dirname(os.path.abspath(file_path))):
+        data = _load_json(file_path, default)
+    else:
+        with _FileLock(file_path, exclusive=False):
+            data = _load_json(file_path, default)
+    return _freeze_json(data) if readonly and data is not default else data
+
+
+def dump_json(file_path, data, indent=2, ensure_ascii=False, lock=False, atomic=False):
+    """Dump data into JSON file.
+    If atomic, data is written into a temp file in the same dir, fsynced, then renamed to file_path,
+    so readers and a crash see either the old or the new file, never a truncated one.
+    A symlink is followed and the file it points to is replaced, mode (and owner if allowed) is kept,
+    but the new file is not hard linked by other names of the old one.
+    If lock, the sidecar file_path.lock is left in place, it's shared by processes locking file_path.
+
+    Arguments:
+        file_path {str} -- JSON file path, its dir is created if not exists
+        data {any} -- Data to dump
+
+    Keyword Arguments:
+        indent {int} -- JSON indent (default: {2})
+        ensure_ascii {bool} -- Escape non-ASCII characters (default: {False})
+        lock {bool} -- Hold an exclusive lock of file_path.lock while writing (default: {False})
+        atomic {bool} -- Write by temp file and rename (default: {False})
+    """
+    if not lock:
+        _dump_json(file_path, data, indent, ensure_ascii, atomic)
+    else:
+        with _FileLock(file_path):
+            _dump_json(file_path, data, indent, ensure_ascii, atomic)
+    _invalidate_json_caches(file_path)
+
+
+def update_json(file_path, update, default=None, indent=2, ensure_ascii=False):
+    """Load, update and dump JSON file atomically under an exclusive lock,
+    so concurrent updates by processes or threads are not lost.
+
+    Arguments:
+        file_path {str} -- JSON file path
+        update {function} -- update(data) returns new data, or None if data is changed in place
+
+    Keyword Arguments:
+        default {any} -- Data if file does not exist (default: {None})
+
+    Returns:
+        any -- Dumped data
+
+    Example:
+        update_json('state.json', lambda state: state.update(count=state['count'] + 1), {'count': 0})
+    """
+    with _FileLock(file_path):
+        data = _load_json(file_path, copy.deepcopy(default))
+        result = update(data)
+        data = data if result is None else result
+        _dump_json(file_path, data, indent, ensure_ascii, True)
+    _invalidate_json_caches(file_path)
     return data
 
 
-def dump_json(file_path, data, indent=2, ensure_ascii=False, lock=False):
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_JSON_NUMBERS = (int, float)
+_JSON_NUMBER_CHARS = frozenset('0123456789.eE+-')
+
+
+def iter_json(file_path, key: str=None, lines: bool=None, chunk_size: int=1024 * 1024, replacement_for_dot_in_key: str=None):
+    """Iterate items of a top-level JSON array, or records of a JSON Lines file, lazily.
+    Memory is bounded by the largest item (plus chunk_size), not the file size.
+
+    Arguments:
+        file_path {str} -- JSON or JSON Lines file path
+
+    Keyword Arguments:
+        key {str} -- Yield get(item, key) instead of item, keys are connected by dot like get(), 
+            items without key are skipped (default: {None})
+        lines {bool} -- True for JSON Lines, False for a JSON array, 
+            None to detect by extension (.jsonl, .ndjson) or first character (default: {None})
+        chunk_size {int} -- Characters read at a time (default: {1024 * 1024})
+        replacement_for_dot_in_key {str} -- See get() (default: {None})
+
+    Raises:
+        AppToolError: If file is not a JSON array or JSON Lines.
+        json.JSONDecodeError: If anything but whitespace follows the array, Ex. JSON Lines of arrays, 
+            which should be read with lines=True.
+
+    Example:
+        for order in iter_json('orders.json', 'customer.addresses[0]'):
+            pass
+    """
+    with open(file_path, 'r', encoding='utf8') as fp:
+        if lines is None and file_path.endswith(('.jsonl', '.ndjson')):
+            lines = True
+        buffer = ''
+        if lines is None:
+            # Peek first character, an array is streamed, others are records of JSON Lines
+            while True:
+                chunk = fp.read(chunk_size)
+                buffer += chunk
+                if not chunk or buffer.strip():
+                    break
+            lines = not buffer.lstrip().startswith('[')
+        items = _iter_json_lines(fp, buffer, file_path) if lines else _iter_json_array(fp, buffer, chunk_size, file_path)
+        if key is None:
+            yield from items
+            return
+        for item in items:
+            try:
+                value = get(item, key, _MISSING, replacement_for_dot_in_key=replacement_for_dot_in_key)
+            except AppToolError:
+                # Missing list or index
+                continue
+            if value is not _MISSING:
+                yield value
+
+
+def _iter_json_lines(fp, buffer, file_path):
+    decode = json.JSONDecoder().decode
+    line_no = 0
+    for line in itertools.chain(io.StringIO(buffer), fp) if buffer else fp:
+        line_no += 1
+        if not line.strip():
+            continue
+        # A peeked buffer may end in the middle of a line
+        while not line.endswith('\n'):
+            rest = fp.readline()
+            if not rest:
+                break
+            line += rest
+        try:
+            yield decode(line)
+        except ValueError as ex:
+            raise AppToolError(f'Invalid JSON at line {line_no} of {file_path}: {ex}') from ex
+
+
+def _iter_json_array(fp, buffer, chunk_size, file_path):
+    decode = json.JSONDecoder().raw_decode
+    pos = 0
+    eof = False
+
+    def more(size):
+        """Read at least size characters, drop consumed ones, False if at end of file."""
+        nonlocal buffer, pos, eof
+        chunks = []
+        while size > 0:
+            chunk = fp.read(max(size, chunk_size))
+            if not chunk:
+                eof = True
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+        buffer = buffer[pos:] + ''.join(chunks)
+        pos = 0
+        return bool(chunks)
+
+    def next_char():
+        nonlocal pos
+        while True:
+            pos = _JSON_WHITESPACE.match(buffer, pos).end()
+            if pos < len(buffer):
+                return buffer[pos]
+            if not more(chunk_size):
+                raise AppToolError(f'Unexpected end of {file_path}, JSON array is not closed.')
+
+    if next_char() != '[':
+        raise AppToolError(f'{file_path} is not a JSON array.')
+    pos += 1
+    def check_end():
+        """Only whitespace may follow the array, Ex. JSON Lines of arrays is not taken as an array."""
+        nonlocal pos
+        while True:
+            pos = _JSON_WHITESPACE.match(buffer, pos).end()
+            if pos < len(buffer):
+                raise json.JSONDecodeError('Extra data after top-level array', buffer, pos)
+            if not more(chunk_size):
+                return
+
+    if next_char() == ']':
+        pos += 1
+        check_end()
+        return
+    while True:
+        while True:
+            try:
+                item, end = decode(buffer, pos)
+                # A number at end of buffer, or followed by its prefix (Ex. "12." of "12.5"), may go on in next chunk
+                if eof or end < len(buffer) and not (type(item) in _JSON_NUMBERS and buffer[end] in _JSON_NUMBER_CHARS):
+                    break
+            except ValueError as ex:
+                if eof:
+                    raise AppToolError(f'Invalid JSON item in {file_path}: {ex}') from ex
+            # Double pending characters, so a large item is parsed a few times, not once per chunk
+            more(len(buffer) - pos)
+        pos = end
+        yield item
+        char = next_char()
+        pos += 1
+        if char == ']':
+            check_end()
+            return
+        if char != ',':
+            raise AppToolError(f'Invalid JSON array in {file_path}: expected "," or "]" but got {char!r}.')
+        next_char()
+
+
+def dump_jsonl(file_path, records, batch_size: int=1000, ensure_ascii: bool=False, lock: bool=False) -> int:
+    """Append records into a JSON Lines file, a record a line, written in batches.
+
+    Arguments:
+        file_path {str} -- JSON Lines file path, its dir is created if not exists
+        records {iterable} -- Records to append, consumed lazily
+
+    Keyword Arguments:
+        batch_size {int} -- Records per write (default: {1000})
+        ensure_ascii {bool} -- Escape non-ASCII characters (default: {False})
+        lock {bool} -- Hold an exclusive lock of file_path.lock while appending, like dump_json() (default: {False})
+
+    Returns:
+        int -- Count of appended records
+    """
+    if not lock:
+        count = _dump_jsonl(file_path, records, batch_size, ensure_ascii)
+    else:
+        with _FileLock(file_path):
+            count = _dump_jsonl(file_path, records, batch_size, ensure_ascii)
+    _invalidate_json_caches(file_path)
+    return count
+
+
+def _dump_jsonl(file_path, records, batch_size, ensure_ascii):
     dir_path = os.path.dirname(file_path)
-    if not os.path.exists(dir_path):
-        os.makedirs(dir_path)
-    with open(file_path, 'w', encoding='utf8') as fp:
-        if lock and is_win():
-            import fcntl
-            fcntl.flock(fp, fcntl.LOCK_EX)
-        json.dump(data, fp, indent=indent, ensure_ascii=ensure_ascii)
+    if dir_path and not os.path.exists(dir_path):
+        os.makedirs(dir_path, exist_ok=True)
+    encode = json.JSONEncoder(ensure_ascii=ensure_ascii, separators=(',', ':')).encode
+    count = 0
+    with open(file_path, 'a', encoding='utf8') as fp:
+        batch = []
+        for record in records:
+            batch.append(encode(record))
+            if len(batch) >= batch_size:
+                fp.write('\n'.join(batch) + '\n')
+                count += len(batch)
+                batch = []
+        if batch:
+            fp.write('\n'.join(batch) + '\n')
+            count += len(batch)
+    return count
 
 
 def now():
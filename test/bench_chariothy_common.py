@@ -0,0 +1,661 @@
+"""Micro-benchmarks of chariothy_common.
+Run in test dir: python bench_chariothy_common.py
+
+Regression suite, run in test dir:
+    python bench_chariothy_common.py suite --save       # Save results as baseline
+    python bench_chariothy_common.py suite              # Exit with 1 if a case is slower than baseline by more than threshold
+"""
+import copy
+import json
+import re
+import sys
+import time
+import timeit
+
+import os
+
+from chariothy_common import get, deep_merge, deep_merge_in, AppTool, AppToolError, send_email, send_email_async, benchmark
+from chariothy_common import alignment, load_json, dump_json, find_regressions, TimingRegistry
+
+
+REG_NUM_INDEX = re.compile(r'\[([\+\-]?\d+)\]')
+
+CONFIG = {
+    'mail': {
+        'from': 'Henry TIAN <chariothy@gmail.com>',
+        'to': 'Henry TIAN <chariothy@gmail.com>,Henry TIAN <6314849@qq.com>'
+    },
+    'demo.key': {
+        'from': ['Henry TIAN', 'chariothy@gmail.com'],
+        'to': [['Henry TIAN', 'chariothy@gmail.com']]
+    },
+    'big': {str(i): {'value': i, 'items': list(range(10))} for i in range(1000)},
+}
+
+
+def legacy_get(dictionary: dict, key:str, default=None, check:bool=False, replacement_for_dot_in_key:str=None):
+    """utils.get before key paths were compiled, kept for comparison."""
+    key_parts = key.split('.')
+    config = dictionary
+    parsed_keys = []
+
+    for key_part in key_parts:
+        if replacement_for_dot_in_key:
+            key_part = key_part.replace(replacement_for_dot_in_key, '.')
+        parsed_keys.append(key_part)
+        parsing_key = '.'.join(parsed_keys)
+        config_str = f'Config("{parsing_key}")={config}'
+
+        idx_parts = REG_NUM_INDEX.split(key_part)
+        if len(idx_parts) == 1:
+            amend_parsed_key = '.'.join(parsed_keys[:-1])
+            config_str = f'Config("{amend_parsed_key}")={config}'
+            if check:
+                if type(config) is not dict:
+                    raise AppToolError(f'Failed to get config at "{parsing_key}": Config is not dict. {config_str}')
+                if key_part not in config:
+                    raise AppToolError(f'Failed to get config at "{parsing_key}": "{key_part}" is not in config. {config_str}')
+            try:
+                config = config.get(key_part, default)
+            except (AttributeError, TypeError) as ex:
+                if check:
+                    raise AppToolError(f'Failed to get config at "{parsing_key}": {ex}. {config_str}')
+                config = default
+        else:
+            if idx_parts[0] == '':
+                raise AppToolError(f'Failed to get config at "{parsing_key}": "{key_part}" should have parent.')
+            if idx_parts[-1] != '':
+                raise AppToolError(f'Failed to get config at "{parsing_key}": "{key_part}" should be at the tail.')
+
+            key_indexes = list(filter(lambda x: x, idx_parts))
+            key_indexes.reverse()
+            key_part = key_indexes.pop()
+            key_indexes.reverse()
+            if type(config) is not dict or key_part not in config:
+                raise AppToolError(f'Failed to get config at "{parsing_key}": "{key_part}" is not in config. {config_str}')
+
+            config = config[key_part]
+            amend_parsed_keys = parsed_keys[:-1]
+            amend_parsed_keys.append(key_part)
+            amend_parsed_key = '.'.join(amend_parsed_keys)
+            config_str = f'Config("{amend_parsed_key}")={config}'
+            if type(config) is not list and type(config) is not tuple:
+                raise AppToolError(f'Failed to get config at "{parsing_key}": Config is not list or tuple. {config_str}')
+
+            for key_index in key_indexes:
+                try:
+                    key_index = int(key_index)
+                    config = config[key_index]
+                except (ValueError, IndexError) as ex:
+                    raise AppToolError(f'Failed to get config at "{parsing_key}": Invalid index "{key_index}", {ex}. {config_str}')
+
+    return config
+
+
+def legacy_use_env_var(config, parent_key: str):
+    """AppTool._use_env_var before env was indexed, kept for comparison."""
+    if type(config) is tuple:
+        config = list(config)
+
+    if type(config) is dict:
+        for key in config.keys():
+            full_key = (parent_key + '_' + re.sub(r'\W+', '_', key)).upper()
+            if full_key in os.environ.keys():
+                config[key] = os.environ.get(full_key)
+            elif type(config[key]) in (list, dict, tuple):
+                config[key] = legacy_use_env_var(config[key], full_key)
+    elif type(config) is list:
+        for index, _ in enumerate(config):
+            full_key = (parent_key + '_' + str(index)).upper()
+            if full_key in os.environ.keys():
+                config[index] = os.environ.get(full_key)
+            elif type(config[index]) in (list, dict, tuple):
+                config[index] = legacy_use_env_var(config[index], full_key)
+    return config
+
+
+def legacy_deep_merge(dict1: dict, dict2: dict) -> dict:
+    """utils.deep_merge before layers were merged in one pass, kept for comparison."""
+    if type(dict1) is dict and type(dict2) is dict:
+        dict1_copy = dict1.copy()
+        for key in dict2.keys():
+            if key in dict1.keys() and type(dict1[key]) is dict and type(dict2[key]) is dict:
+                dict1_copy[key] = legacy_deep_merge(dict1[key], dict2[key])
+            else:
+                dict1_copy[key] = dict2[key]
+        return dict1_copy
+    return dict1
+
+
+def legacy_deep_merge_in(dict1: dict, dict2: dict) -> dict:
+    """utils.deep_merge_in before any mapping was merged without recursion, kept for comparison."""
+    if type(dict1) is dict and type(dict2) is dict:
+        for key in dict2.keys():
+            if key in dict1.keys() and type(dict1[key]) is dict and type(dict2[key]) is dict:
+                legacy_deep_merge_in(dict1[key], dict2[key])
+            else:
+                dict1[key] = dict2[key]
+    return dict1
+
+
+def deep_tree(depth, leaf):
+    tree = {'leaf': leaf}
+    for level in range(depth):
+        tree = {f'k{level}': tree, f'v{level}': level}
+    return tree
+
+
+def wide_tree(width, leaf):
+    return {f'k{i}': {'a': i, 'b': {'c': leaf}} for i in range(width)}
+
+
+def report(name, func):
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    elapsed = min(timer.repeat(number=number, repeat=3))
+    print(f'{name:<40} {elapsed / number * 1e9:>12.0f} ns/call')
+
+
+def bench_get():
+    for key in ('mail.from', 'demo#key.to[0][-1]', 'big.999.items[9]'):
+        report(f'legacy_get({key!r})', lambda: legacy_get(CONFIG, key, check=True, replacement_for_dot_in_key='#'))
+        report(f'get({key!r})', lambda: get(CONFIG, key, check=True, replacement_for_dot_in_key='#'))
+
+
+def bench_frozen_app():
+    app = AppTool('bench', os.getcwd())
+    frozen_app = AppTool('bench', os.getcwd(), frozen=True)
+    for key in ('mail.from', 'demo#key2.to[0][-1]'):
+        report(f'AppTool[{key!r}]', lambda: app[key])
+        report(f'AppTool(frozen=True)[{key!r}]', lambda: frozen_app[key])
+
+
+def bench_app_startup(number=100):
+    sys_path_len = len(sys.path)
+    start = time.perf_counter()
+    for _ in range(number):
+        AppTool('bench', os.getcwd())
+    elapsed = time.perf_counter() - start
+    print(f'{number} x AppTool()'.ljust(40), f'{elapsed / number * 1e9:>12.0f} ns/call, sys.path grown by {len(sys.path) - sys_path_len}')
+
+
+def bench_init_logger():
+    import logging
+    app = AppTool('bench', os.getcwd())
+    report('AppTool.init_logger() unchanged', app.init_logger)
+    print(f'{"handlers after repeated init_logger()":<40} {len(logging.getLogger("bench").handlers):>12}')
+
+
+def bench_env_overlay():
+    app = AppTool('bench', os.getcwd())
+    env = {f'BENCH_BIG_{i}_ITEMS_{i % 10}': str(i) for i in range(0, 1000, 50)}
+    env.update({f'OTHER_VAR_{i}': str(i) for i in range(500)})
+    os.environ.update(env)
+    # Legacy version replaces items in place, so it runs on a copy and CONFIG stays the same for later benchmarks.
+    # Only leaves are replaced, so later calls on the copy visit the same nodes as the first one
+    config = copy.deepcopy(CONFIG)
+    try:
+        report('legacy _use_env_var(5000 nodes)', lambda: legacy_use_env_var(config, 'bench'))
+        report('AppTool._use_env_var(5000 nodes)', lambda: app._use_env_var(config, 'bench'))
+    finally:
+        for key in env:
+            del os.environ[key]
+
+
+def bench_deep_merge():
+    for name, make_tree in (
+        ('deep', lambda leaf: deep_tree(200, leaf)), 
+        ('wide', lambda leaf: wide_tree(10000, leaf)),
+        ('sparse', lambda leaf: wide_tree(10000 if leaf == 0 else 10, leaf)),
+    ):
+        layers = [make_tree(leaf) for leaf in range(4)]
+        def pairwise():
+            merged = layers[0]
+            for layer in layers[1:]:
+                merged = legacy_deep_merge(merged, layer)
+            return merged
+        report(f'legacy deep_merge({name}, 4 layers)', pairwise)
+        report(f'deep_merge({name}, 4 layers)', lambda: deep_merge(*layers))
+        report(f'legacy deep_merge({name}, 2 layers)', lambda: legacy_deep_merge(layers[0], layers[1]))
+        report(f'deep_merge({name}, 2 layers)', lambda: deep_merge(layers[0], layers[1]))
+        target = make_tree(0)
+        report(f'legacy deep_merge_in({name})', lambda: legacy_deep_merge_in(target, layers[1]))
+        report(f'deep_merge_in({name})', lambda: deep_merge_in(target, layers[1]))
+
+
+def bench_async_send(number=1000, concurrency=50):
+    import asyncio
+
+    async def measure_lag(sends):
+        """Max delay of a 5ms ticker while sends are running, which is how long the loop was blocked.
+        """
+        max_lag = 0
+        done = asyncio.ensure_future(sends)
+        while not done.done():
+            start = time.perf_counter()
+            await asyncio.sleep(0.005)
+            max_lag = max(max_lag, time.perf_counter() - start - 0.005)
+        await done
+        return max_lag
+
+    async def send_async():
+        semaphore = asyncio.Semaphore(concurrency)
+        await asyncio.gather(*(send_email_async('from@localhost', f'to{i}@localhost', 'Bench', 'Bench', smtp_config, 
+                                                semaphore=semaphore) for i in range(number)))
+
+    async def send_sync():
+        await asyncio.sleep(0)
+        for i in range(number // 10):
+            send_email('from@localhost', f'to{i}@localhost', 'Bench', 'Bench', smtp_config)
+
+    # Server runs in another process so it does not compete for GIL with the event loop
+    import subprocess
+    server = subprocess.Popen([sys.executable, 'smtp_server.py'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    smtp_config = {'host': '127.0.0.1', 'port': int(server.stdout.readline()), 'user': 'user@localhost', 'pwd': 'pwd'}
+    try:
+        loop = asyncio.new_event_loop()
+        try:
+            for name, sends, count in (('send_email_async', send_async, number), ('send_email in loop', send_sync, number // 10)):
+                start = time.perf_counter()
+                max_lag = loop.run_until_complete(measure_lag(sends()))
+                elapsed = time.perf_counter() - start
+                print(f'{count} x {name}'.ljust(40), f'{elapsed / count * 1e9:>12.0f} ns/call, max loop lag {max_lag * 1e3:.1f} ms')
+        finally:
+            loop.close()
+    finally:
+        server.stdin.close()
+        server.wait()
+
+def send_large_attachment(size_mb, dest):
+    """Send an attachment of size_mb to file or stand-in SMTP server, then print peak RSS, run in a subprocess.
+    """
+    import resource
+    import tempfile
+    from smtp_server import SMTPStandIn
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, 'large.bin')
+        with open(file_path, 'wb') as fp:
+            for _ in range(size_mb):
+                fp.write(os.urandom(1024 * 1024))
+        if dest == 'file':
+            send_email('from@localhost', 'to@localhost', 'Large', 'Large', file_paths=(file_path,), 
+                       send_to_file=True, email_file_dir=temp_dir)
+        else:
+            with SMTPStandIn() as server:
+                server.keep_messages = False
+                send_email('from@localhost', 'to@localhost', 'Large', 'Large', server.smtp_config, file_paths=(file_path,))
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def bench_large_attachment():
+    import subprocess
+    for dest in ('file', 'smtp'):
+        for size_mb in (8, 64):
+            output = subprocess.check_output([sys.executable, __file__, 'send_large_attachment', str(size_mb), dest])
+            print(f'send_email({size_mb}MB attachment to {dest})'.ljust(40), f'peak RSS {int(output) / 1024:>8.1f} MB')
+
+
+def load_large_json(size_mb, mode):
+    """Load a JSON array of size_mb by load_json or iter_json, then print peak RSS, run in a subprocess.
+    """
+    import resource
+    import tempfile
+    from chariothy_common import iter_json, dump_jsonl
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, 'large.json' if mode != 'jsonl' else 'large.jsonl')
+        records = ({'id': i, 'name': f'Item {i}', 'tags': ['a', 'b'], 'value': i / 2} for i in range(size_mb * 14000))
+        if mode == 'jsonl':
+            dump_jsonl(file_path, records)
+        else:
+            with open(file_path, 'w') as fp:
+                fp.write('[\n')
+                for i, record in enumerate(records):
+                    fp.write((',\n' if i else '') + json.dumps(record))
+                fp.write('\n]')
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        if mode == 'load_json':
+            count = len(load_json(file_path))
+        else:
+            count = sum(1 for _ in iter_json(file_path))
+        elapsed = time.perf_counter() - start
+    print(count, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline)
+
+
+def bench_large_json(size_mb=64):
+    import subprocess
+    for mode in ('load_json', 'iter_json', 'jsonl'):
+        output = subprocess.check_output([sys.executable, __file__, 'load_large_json', str(size_mb), mode])
+        count, elapsed, rss = output.split()
+        print(f'{mode}({size_mb}MB)'.ljust(40), f'{float(elapsed) * 1e3:>12.0f} ms, {count.decode()} items, '
+              f'peak RSS grown by {int(rss) / 1024:.1f} MB')
+
+
+def bench_logging(number=2000):
+    """Latency of logging calls with handlers run by caller (sync) or by QueueLogging listener thread (async).
+    """
+    import logging
+    import subprocess
+    import tempfile
+    from logging import handlers
+    from chariothy_common.app_tool import MySMTPHandler
+    from chariothy_common.log_handlers import QueueLogging
+
+    server = subprocess.Popen([sys.executable, 'smtp_server.py'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    port = int(server.stdout.readline())
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            for mode in ('sync', 'async'):
+                logger = logging.getLogger(f'bench-logging-{mode}')
+                logger.setLevel(logging.DEBUG)
+                logger.propagate = False
+                file_handler = handlers.TimedRotatingFileHandler(os.path.join(temp_dir, f'{mode}.log'), when='D')
+                file_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+                mail_handler = MySMTPHandler(('127.0.0.1', port), 'from@localhost', 'to@localhost', 
+                                             '%(name)s - %(levelname)s - %(message)s', ('user@localhost', 'pwd'))
+                mail_handler.setLevel(logging.ERROR)
+                target_handlers = [file_handler, mail_handler]
+                if mode == 'async':
+                    queue_logging = QueueLogging(logger, target_handlers, queue_size=number * 2).start()
+                else:
+                    for handler in target_handlers:
+                        logger.addHandler(handler)
+
+                for level, count in ((logging.INFO, number), (logging.ERROR, number // 20)):
+                    latencies = []
+                    for i in range(count):
+                        start = time.perf_counter()
+                        logger.log(level, 'Bench %d', i)
+                        latencies.append(time.perf_counter() - start)
+                    latencies.sort()
+                    name = f'{count} x {logging.getLevelName(level).lower()}() {mode}'
+                    print(name.ljust(40), f'{sum(latencies) / count * 1e9:>12.0f} ns/call, '
+                          f'p99 {latencies[int(count * 0.99)] * 1e6:.0f} us, max {latencies[-1] * 1e6:.0f} us')
+
+                if mode == 'async':
+                    start = time.perf_counter()
+                    queue_logging.stop()
+                    print('  flushed by listener in'.ljust(40), f'{(time.perf_counter() - start) * 1e3:>12.1f} ms')
+                for handler in target_handlers:
+                    logger.removeHandler(handler)
+                    handler.close()
+    finally:
+        server.stdin.close()
+        server.wait()
+
+
+def bench_level_methods():
+    """Overhead of AppTool.debug() etc. for disabled and enabled levels, vs. Logger methods and the old wrapper.
+    """
+    import logging
+    from chariothy_common.log_handlers import Lazy
+    app = AppTool('bench-levels', os.getcwd())
+    app.config['log'] = {'level': 'INFO', 'dest': []}
+    logger = app.init_logger()
+    logger.propagate = False
+    logger.addHandler(logging.NullHandler())
+    items = list(range(100))
+
+    def wrapper_debug(msg, *args, **kwargs):
+        # AppTool.debug() before level methods were bound
+        logger.debug(msg, *args, **kwargs)
+
+    report('disabled Logger.debug()', lambda: logger.debug('Items %s', items))
+    report('disabled old AppTool.debug() wrapper', lambda: wrapper_debug('Items %s', items))
+    report('disabled AppTool.debug()', lambda: app.debug('Items %s', items))
+    report('disabled AppTool.debug(Lazy())', lambda: app.debug(Lazy(str, items)))
+    report('disabled AppTool.debug(**fields)', lambda: app.debug('Items', count=100))
+    report('enabled Logger.info()', lambda: logger.info('Items %d', 100))
+    report('enabled AppTool.info()', lambda: app.info('Items %d', 100))
+    report('enabled AppTool.info(**fields)', lambda: app.info('Items', count=100))
+
+
+def bench_timing():
+    from chariothy_common.timing import TimingRegistry
+    registry = TimingRegistry()
+    def noop():
+        pass
+    timed = benchmark(noop, echo=False, registry=registry)
+    report('noop()', noop)
+    report('@benchmark(echo=False) noop()', timed)
+    print(registry.stats('bench_timing.<locals>.noop'))
+
+
+def bench_instrumentation():
+    """Overhead of AppTool.log() with and without instrumentation, timing every call or 1 of 10.
+    """
+    from chariothy_common.metrics import Instrumentation
+    def noop():
+        pass
+    app = AppTool('bench-instrument', os.getcwd())
+    report('noop()', noop)
+    report('@log() noop()', app.log()(noop))
+    for sample_every in (1, 10):
+        app._metrics = Instrumentation('bench', sample_every)
+        report(f'@log() instrumented noop(), sample_every={sample_every}', app.log()(noop))
+
+
+def bench_log_format():
+    import logging
+    from chariothy_common.log_handlers import TextFormatter, JsonFormatter
+    plain = logging.makeLogRecord({'name': 'bench', 'levelname': 'INFO', 'levelno': logging.INFO, 'msg': 'Synced %d items', 'args': (3,)})
+    with_fields = logging.makeLogRecord(dict(plain.__dict__, fields={'job': 'sync', 'elapsed': 0.5}))
+    for name, formatter in (
+        ('logging.Formatter', logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")),
+        ('TextFormatter', TextFormatter("%(asctime)s - %(levelname)s - %(message)s")),
+        ('JsonFormatter', JsonFormatter()),
+    ):
+        for record in (plain, with_fields):
+            def format_record():
+                record.__dict__.pop('_json_line', None)
+                return formatter.format(record)
+            report(f'{name}.format({"fields" if record is with_fields else "plain"})', format_record)
+
+
+def bench_log_rotation(number=200000, batch=10000, max_bytes=4 * 1024 * 1024):
+    """Write throughput per batch of records while log file is rotated and compressed,
+    stdlib RotatingFileHandler compressing on the logging thread (rotator) vs RotatingCompressedFileHandler.
+    """
+    import gzip
+    import logging
+    import shutil
+    import tempfile
+    from logging import handlers
+    from chariothy_common.log_handlers import RotatingCompressedFileHandler
+
+    def gzip_rotator(source, dest):
+        with open(source, 'rb') as src, gzip.open(dest + '.gz', 'wb', 6) as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(source)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for name in ('RotatingFileHandler+gzip rotator', 'RotatingCompressedFileHandler'):
+            log_path = os.path.join(temp_dir, f'{len(name)}.log')
+            if name.startswith('RotatingFileHandler'):
+                handler = handlers.RotatingFileHandler(log_path, maxBytes=max_bytes, backupCount=10)
+                handler.rotator = gzip_rotator
+            else:
+                handler = RotatingCompressedFileHandler(log_path, max_bytes=max_bytes, when=None, backup_count=10, compress='gzip')
+            handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+            records = [logging.makeLogRecord({'msg': f'Bench record {i} ' + 'x' * 80, 'levelname': 'INFO'}) for i in range(batch)]
+            rates = []
+            for _ in range(number // batch):
+                start = time.perf_counter()
+                for record in records:
+                    handler.handle(record)
+                rates.append(batch / (time.perf_counter() - start))
+            handler.close()
+            rates.sort()
+            print(f'{number} x {name}'.ljust(40), f'{rates[len(rates) // 2]:>12.0f} records/s median, '
+                  f'{rates[0]:.0f} slowest batch')
+
+
+def suite_cases(stack, temp_dir):
+    """[(name, func)] of the regression suite, fixtures are set up in temp_dir and torn down by stack (ExitStack).
+    """
+    import contextlib
+    import logging
+    from smtp_server import SMTPStandIn
+    cases = []
+
+    deep_key = '.'.join(f'k{level}' for level in reversed(range(50))) + '.leaf'
+    deep = deep_tree(50, 'leaf')
+    cases += [
+        ('get(shallow)', lambda: get(CONFIG, 'mail.from')),
+        ('get(indexed)', lambda: get(CONFIG, 'big.999.items[9]')),
+        ('get(50 levels)', lambda: get(deep, deep_key)),
+    ]
+
+    # Legacy cases are the reference within a run, also when there is no baseline
+    layers = [wide_tree(10000, leaf) for leaf in range(4)]
+    target = wide_tree(10000, 0)
+    deep_layers = [deep_tree(200, leaf) for leaf in range(2)]
+    deep_target = deep_tree(200, 0)
+    cases += [
+        ('deep_merge(10000 keys, 4 layers)', lambda: deep_merge(*layers)),
+        ('deep_merge(10000 keys, 2 layers)', lambda: deep_merge(layers[0], layers[1])),
+        ('legacy deep_merge(10000 keys, 2 layers)', lambda: legacy_deep_merge(layers[0], layers[1])),
+        ('deep_merge(200 levels, 2 layers)', lambda: deep_merge(*deep_layers)),
+        ('legacy deep_merge(200 levels, 2 layers)', lambda: legacy_deep_merge(*deep_layers)),
+        ('deep_merge_in(10000 keys)', lambda: deep_merge_in(target, layers[1])),
+        ('legacy deep_merge_in(10000 keys)', lambda: legacy_deep_merge_in(target, layers[1])),
+        ('deep_merge_in(200 levels)', lambda: deep_merge_in(deep_target, deep_layers[1])),
+        ('legacy deep_merge_in(200 levels)', lambda: legacy_deep_merge_in(deep_target, deep_layers[1])),
+    ]
+
+    # Env vars of CONFIG, app name differs so AppTool() does not warn they match no config key
+    app = AppTool('bench-suite', os.getcwd())
+    env = {f'BENCH_BIG_{i}_ITEMS_{i % 10}': str(i) for i in range(0, 1000, 50)}
+    env.update({f'OTHER_VAR_{i}': str(i) for i in range(500)})
+    os.environ.update(env)
+    stack.callback(lambda: [os.environ.pop(key, None) for key in env])
+    config = copy.deepcopy(CONFIG)
+    cases += [
+        ('AppTool()', lambda: AppTool('bench-suite', os.getcwd())),
+        ('AppTool._use_env_var(5000 nodes)', lambda: app._use_env_var(config, 'bench')),
+    ]
+
+    json_path = os.path.join(temp_dir, 'bench.json')
+    data = {'items': [{'id': i, 'name': f'Item {i}', 'tags': ['a', 'b'], 'value': i / 2} for i in range(15000)]}
+    dump_json(json_path, data)
+    size = f'{os.path.getsize(json_path) / 1024 / 1024:.0f}MB'
+    cases += [
+        (f'dump_json({size})', lambda: dump_json(json_path, data)),
+        (f'dump_json({size}, atomic=True)', lambda: dump_json(json_path, data, atomic=True)),
+        (f'load_json({size})', lambda: load_json(json_path)),
+        (f'load_json({size}, cache=True)', lambda: load_json(json_path, cache=True)),
+        (f'load_json({size}, cache=True, readonly=True)', lambda: load_json(json_path, cache=True, readonly=True)),
+    ]
+
+    pwd = os.path.dirname(os.path.abspath(__file__))
+    image_paths = (os.path.join(pwd, 'train.png'), os.path.join(pwd, 'boat.png'))
+    mail_dir = os.path.join(temp_dir, 'mails')
+    os.mkdir(mail_dir)
+    cases.append(('send_email(2 attachments, to file)', 
+                  lambda: send_email('from@localhost', 'to@localhost', 'Bench', 'Bench', file_paths=image_paths, 
+                                     send_to_file=True, email_file_dir=mail_dir)))
+
+    # StreamHandler of stdout dest writes into sys.stderr when created
+    stack.enter_context(contextlib.redirect_stderr(stack.enter_context(open(os.devnull, 'w'))))
+    server = stack.enter_context(SMTPStandIn())
+    server.keep_messages = False
+    for dest in ('file', 'stdout', 'mail'):
+        log_app = AppTool(f'bench-suite-{dest}', temp_dir)
+        log_app.config.update(smtp=server.smtp_config, mail={'from': 'from@localhost', 'to': 'to@localhost'}, 
+                              log={'level': 'DEBUG', 'dest': [dest]})
+        log_app.init_logger().propagate = False
+        stack.callback(_close_logger, log_app)
+        log = log_app.error if dest == 'mail' else log_app.info
+        cases.append((f'AppTool logging to {dest}', lambda log=log: log('Bench %d', 1)))
+
+    cases += [
+        ('alignment(mixed)', lambda: alignment('My 姓名', 20, 'right')),
+    ]
+    return cases
+
+
+def _close_logger(app):
+    app.config['log'] = {'dest': []}
+    app.init_logger()
+
+
+def run_suite(baseline_path, save=False, threshold=0.25, key='min_ms', repeat=7, pattern=''):
+    """Time each case of suite_cases(), compare with baseline, save results as baseline if save.
+    Comparison is skipped if baseline file does not exist, no baseline is committed since timings depend on machine.
+
+    Returns:
+        dict -- {name: (baseline, current)} of regressions
+    """
+    import contextlib
+    import json
+    import tempfile
+    registry = TimingRegistry()
+    with tempfile.TemporaryDirectory() as temp_dir, contextlib.ExitStack() as stack:
+        for name, func in suite_cases(stack, temp_dir):
+            if pattern not in name:
+                continue
+            timer = timeit.Timer(func)
+            number, _ = timer.autorange()
+            for elapsed in timer.repeat(number=number, repeat=repeat):
+                registry.record(name, int(elapsed / number * 1e9))
+    current = registry.snapshot()
+
+    baseline = load_json(baseline_path, {}) if os.path.exists(baseline_path) else {}
+    if not baseline and not save:
+        print(f'No baseline in {baseline_path}, comparison is skipped. Run with --save on this machine first.')
+    regressions = find_regressions(baseline, current, threshold, key)
+    for name, stats in current.items():
+        line = f'{name:<40} {stats[key] * 1e6:>12.0f} ns/call'
+        if name in baseline:
+            change = stats[key] / baseline[name][key] - 1 if baseline[name][key] else 0
+            line += f' {change:>+8.1%} vs baseline' + (' REGRESSED' if name in regressions else '')
+        print(line)
+    if save:
+        with open(baseline_path, 'w', encoding='utf8') as fp:
+            json.dump(dict(baseline, **current), fp, indent=2)
+        print(f'Saved baseline into {baseline_path}')
+    return regressions
+
+
+def suite_main(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog='bench_chariothy_common.py suite', description='Regression suite of chariothy_common.')
+    parser.add_argument('--baseline', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json'), 
+                        help='Baseline JSON (default: bench_baseline.json in test dir)')
+    parser.add_argument('--save', action='store_true', help='Save results as baseline')
+    parser.add_argument('--threshold', type=float, default=0.25, help='Allowed slow down, 0.25 is 25%% (default: 0.25)')
+    parser.add_argument('--key', default='min_ms', help='Statistic to compare: min_ms, p50_ms, mean_ms... (default: min_ms)')
+    parser.add_argument('--repeat', type=int, default=7, help='Timed batches per case (default: 7)')
+    parser.add_argument('-k', dest='pattern', default='', help='Only run cases whose name contains it')
+    args = parser.parse_args(argv)
+    regressions = run_suite(args.baseline, args.save, args.threshold, args.key, args.repeat, args.pattern)
+    if regressions and not args.save:
+        print(f'{len(regressions)} case(s) regressed more than {args.threshold:.0%}: {", ".join(regressions)}')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'suite':
+        sys.exit(suite_main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'load_large_json':
+        load_large_json(int(sys.argv[2]), sys.argv[3])
+        sys.exit()
+    if len(sys.argv) > 1:
+        send_large_attachment(int(sys.argv[2]), sys.argv[3])
+        sys.exit()
+    bench_get()
+    bench_frozen_app()
+    bench_app_startup()
+    bench_init_logger()
+    bench_env_overlay()
+    bench_deep_merge()
+    bench_async_send()
+    bench_large_attachment()
+    bench_large_json()
+    bench_logging()
+    bench_log_format()
+    bench_level_methods()
+    bench_timing()
+    bench_instrumentation()
+    bench_log_rotation()
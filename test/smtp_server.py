@@ -0,0 +1,141 @@
+"""In-process SMTP stand-in for tests, counts connections, logins and messages.
+Ex.
+    with SMTPStandIn() as server:
+        send_email(..., smtp_config=server.smtp_config)
+        server.connections == 1
+"""
+import socketserver
+import threading
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        server = self.server.stand_in
+        with server.lock:
+            server.connections += 1
+            server.sockets.add(self.connection)
+            server.max_active = max(server.max_active, len(server.sockets))
+        try:
+            if server.stall:
+                # Never greet, until client gives up
+                self.rfile.read()
+                return
+            self.reply('220 localhost stand-in')
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    break
+                command = line.decode('ascii', 'replace').strip()
+                verb = command.split(' ', 1)[0].upper()
+                with server.lock:
+                    server.commands.append(verb)
+                if verb in ('EHLO', 'HELO'):
+                    self.reply('250-localhost', '250-AUTH PLAIN', '250 SIZE 10240000')
+                elif verb == 'AUTH':
+                    with server.lock:
+                        server.logins += 1
+                    self.reply('235 Authentication successful')
+                elif verb == 'MAIL':
+                    self.recipients = []
+                    self.reply('250 OK')
+                elif verb == 'RCPT':
+                    recipient = command.split(':', 1)[1].strip()
+                    if recipient.strip('<>') in server.refused:
+                        self.reply('550 No such user')
+                    else:
+                        self.recipients.append(recipient)
+                        self.reply('250 OK')
+                elif verb == 'DATA':
+                    self.reply('354 End data with <CR><LF>.<CR><LF>')
+                    data = []
+                    for data_line in self.rfile:
+                        if data_line in (b'.\r\n', b'.\n'):
+                            break
+                        if server.keep_messages:
+                            data.append(data_line)
+                    with server.lock:
+                        server.messages.append((self.recipients, b''.join(data)))
+                    self.reply('250 OK')
+                elif verb in ('NOOP', 'RSET'):
+                    self.reply('250 OK')
+                elif verb == 'QUIT':
+                    self.reply('221 Bye')
+                    break
+                else:
+                    self.reply('502 Command not implemented')
+        except OSError:
+            pass
+        finally:
+            with server.lock:
+                server.sockets.discard(self.connection)
+
+
+    def reply(self, *lines):
+        self.wfile.write(''.join(line + '\r\n' for line in lines).encode('ascii'))
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+class SMTPStandIn(object):
+    def __init__(self, refused=(), stall: bool=False):
+        self.refused = set(refused)
+        self.stall = stall
+        self.keep_messages = True
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.max_active = 0
+        self.logins = 0
+        self.commands = []
+        self.messages = []
+        self.sockets = set()
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.stand_in = self
+        self._thread = None
+
+
+    @property
+    def smtp_config(self):
+        return {
+            'host': '127.0.0.1',
+            'port': self._server.server_address[1],
+            'user': 'user@localhost',
+            'pwd': 'pwd',
+            'type': 'plain'
+        }
+
+
+    def drop_connections(self):
+        """Close all client connections from server side.
+        """
+        import socket
+        with self.lock:
+            sockets = list(self.sockets)
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self.drop_connections()
+        self._server.server_close()
+
+
+if __name__ == '__main__':
+    # Serve in a separate process (Ex. for benchmarks), print port then serve until stdin is closed.
+    import sys
+    with SMTPStandIn() as server:
+        print(server.smtp_config['port'], flush=True)
+        sys.stdin.read()
@@ -1,11 +1,14 @@
 import unittest, os, logging
 
 from chariothy_common import deep_merge, deep_merge_in, benchmark, is_win, is_linux, is_macos, is_darwin
-from chariothy_common import random_sleep, dump_json, load_json, send_email, get
-from chariothy_common import AppTool, AppToolError
+from chariothy_common import random_sleep, dump_json, load_json, update_json, iter_json, dump_jsonl, JsonCache, send_email, send_emails, get, put, flatten, coerce
+from chariothy_common import AppTool, AppToolError, SMTPPool, MailSpool, QueueLogging, BoundedQueueHandler, DigestSMTPHandler, send_email_async
+from chariothy_common import RotatingCompressedFileHandler, TextFormatter, JsonFormatter, Lazy
+from chariothy_common import timings, measure, find_regressions, TimingRegistry, TimingStats, Instrumentation
 
 from config import CONFIG
 from config_local import CONFIG as CONFIG_LOCAL
+from smtp_server import SMTPStandIn
 
 
 dict1 = {
@@ -60,6 +63,90 @@ class CoreTestCase(unittest.TestCase):
         self.assertLogs(logger, logging.DEBUG)
         self.assertLogs(logger, logging.ERROR)
 
+    def test_init_logger_idempotent(self):
+        logger = self.APP.init_logger()
+        handlers = list(logger.handlers)
+        for _ in range(3):
+            self.APP.init_logger()
+            AppTool(self.APP_NAME, os.getcwd())
+        self.assertEqual(handlers, logger.handlers)
+        self.assertEqual(len(set(map(type, handlers))), len(handlers))
+
+        file_handler = next(handler for handler in handlers if isinstance(handler, logging.FileHandler))
+        self.APP.config['log'] = dict(self.APP.config['log'], dest=['file'])
+        self.APP.init_logger()
+        self.assertEqual([file_handler], logger.handlers)
+        self.assertIsNotNone(file_handler.stream)
+
+        self.APP.config['log']['dest'] = []
+        self.APP.init_logger()
+        self.assertEqual([], logger.handlers)
+        self.assertIsNone(file_handler.stream)      # Closed
+
+        foreign = logging.NullHandler()
+        logger.addHandler(foreign)
+        self.addCleanup(logger.removeHandler, foreign)
+        self.APP.config['log']['dest'] = ['file']
+        self.APP.init_logger()
+        self.assertEqual(2, len(logger.handlers))
+        self.assertIn(foreign, logger.handlers)
+
+    def test_level_methods(self):
+        self.APP.config['log'] = dict(self.APP.config['log'], level='INFO', dest=[])
+        self.APP.init_logger()
+        self.addCleanup(self.APP.set_level, CONFIG_LOCAL['log']['level'])
+        built = []
+        def build(text):
+            built.append(text)
+            return text
+
+        self.APP.debug(Lazy(build, 'disabled'))
+        with self.assertLogs('testing', logging.DEBUG) as logs:
+            self.APP.info('Enabled %s', Lazy(build, 'arg'), job='sync')
+            self.APP.warn('Warned')
+            self.APP.set_level(logging.DEBUG)
+            self.APP.debug(Lazy(build, 'enabled'))
+            try:
+                1 / 0
+            except ZeroDivisionError:
+                self.APP.ex('Failed')
+        self.assertEqual(['arg', 'enabled'], built)
+        self.assertEqual(['Enabled arg', 'Warned', 'enabled', 'Failed'], [record.getMessage() for record in logs.records])
+        self.assertEqual(['INFO', 'WARNING', 'DEBUG', 'ERROR'], [record.levelname for record in logs.records])
+        self.assertEqual({'job': 'sync'}, logs.records[0].fields)
+        self.assertIsNotNone(logs.records[-1].exc_info)
+
+    def test_level_changed_by_others(self):
+        from unittest import mock
+        self.APP.config['log'] = dict(self.APP.config['log'], level='INFO', dest=[])
+        logger = self.APP.init_logger()
+        self.addCleanup(self.APP.set_level, CONFIG_LOCAL['log']['level'])
+        self.addCleanup(logging.disable, logging.NOTSET)
+        handler = logging.Handler()
+        handler.emit = mock.Mock()
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+
+        logging.disable(logging.CRITICAL)
+        self.APP.info('Disabled')
+        self.APP.fatal('Disabled')
+        logging.disable(logging.NOTSET)
+        self.APP.info('Enabled')
+        self.APP.debug('Disabled')
+        logger.setLevel(logging.DEBUG)
+        self.APP.debug('Enabled')
+        self.assertEqual(['Enabled', 'Enabled'], [call.args[0].msg for call in handler.emit.call_args_list])
+
+        # Built once for two handlers
+        another = logging.Handler()
+        another.emit = lambda record: another.format(record)
+        handler.emit = lambda record: handler.format(record)
+        logger.addHandler(another)
+        self.addCleanup(logger.removeHandler, another)
+        built = []
+        self.APP.info('Built %s', Lazy(lambda: built.append(1) or 'once'))
+        self.assertEqual([1], built)
+
     def test_deep_merge_in(self):
         self.assertDictEqual(deep_merge_in(dict1, dict2), dict3)
         self.assertDictEqual(dict1, dict3)
@@ -68,6 +155,108 @@ class CoreTestCase(unittest.TestCase):
         self.assertDictEqual(deep_merge(dict1, dict2), dict3)
         self.assertDictEqual(dict1, dict_ori)
 
+    def test_deep_merge_layers(self):
+        layers = (
+            {'a': {'b': 1, 'c': {'d': 2}}, 'e': {'f': 3}, 'g': 4},
+            {'a': {'b': 5}},
+            {'g': {'h': 6}},
+            {'a': {'c': {'i': 7}}, 'g': {'j': 8}},
+        )
+        merged = deep_merge(*layers)
+        self.assertDictEqual({'a': {'b': 5, 'c': {'d': 2, 'i': 7}}, 'e': {'f': 3}, 'g': {'h': 6, 'j': 8}}, merged)
+        self.assertDictEqual(merged, deep_merge(deep_merge(deep_merge(layers[0], layers[1]), layers[2]), layers[3]))
+        self.assertIs(layers[0]['e'], merged['e'])
+        self.assertDictEqual({'b': 1, 'c': {'d': 2}}, layers[0]['a'])
+
+    def test_deep_merge_mapping(self):
+        from collections import OrderedDict
+        from types import MappingProxyType
+        merged = deep_merge(OrderedDict(a=OrderedDict(b=1, c=2)), {'a': MappingProxyType({'c': 3, 'd': 4})})
+        self.assertIs(OrderedDict, type(merged))
+        self.assertIs(OrderedDict, type(merged['a']))
+        self.assertEqual(['b', 'c', 'd'], list(merged['a']))
+        self.assertDictEqual({'a': {'b': 1, 'c': 3, 'd': 4}}, merged)
+
+        target = {'a': MappingProxyType({'b': 1})}
+        deep_merge_in(target, {'a': OrderedDict(c=2)})
+        self.assertDictEqual({'a': {'b': 1, 'c': 2}}, target)
+
+        # Other mappings below plain dicts
+        merged = deep_merge({'a': {'b': MappingProxyType({'c': 1}), 'e': 1}}, {'a': {'b': {'d': 2}, 'e': OrderedDict(f=3)}})
+        self.assertDictEqual({'a': {'b': {'c': 1, 'd': 2}, 'e': {'f': 3}}}, merged)
+        target = {'a': {'b': MappingProxyType({'c': 1})}}
+        deep_merge_in(target, {'a': {'b': {'d': 2}, 'e': OrderedDict(f=3)}})
+        self.assertDictEqual({'a': {'b': {'c': 1, 'd': 2}, 'e': {'f': 3}}}, target)
+
+    def test_deep_merge_deep_tree(self):
+        def deep_tree(depth, leaf):
+            tree = {'leaf': leaf}
+            for _ in range(depth):
+                tree = {'k': tree}
+            return tree
+
+        depth = 5000
+        merged = deep_merge(deep_tree(depth, 1), deep_tree(depth, {'x': 2}), deep_tree(depth, {'y': 3}))
+        merged_two = deep_merge(deep_tree(depth, {'w': 1}), deep_tree(depth, {'x': 2}))
+        target = deep_tree(depth, {'z': 0})
+        deep_merge_in(target, deep_tree(depth, {'x': 2}))
+        for _ in range(depth):
+            merged = merged['k']
+            merged_two = merged_two['k']
+            target = target['k']
+        self.assertDictEqual({'leaf': {'x': 2, 'y': 3}}, merged)
+        self.assertDictEqual({'leaf': {'w': 1, 'x': 2}}, merged_two)
+        self.assertDictEqual({'leaf': {'z': 0, 'x': 2}}, target)
+
+    def test_deep_merge_list_strategy(self):
+        base = {'l': [1, {'a': 1}], 't': ({'id': 1, 'v': 1}, {'id': 2, 'v': 2})}
+        other = {'l': [2, {'b': 2}, 3], 't': [{'id': 2, 'v': 3}, {'id': 3}]}
+        self.assertDictEqual(other, deep_merge(base, other))
+        self.assertDictEqual({'l': [1, {'a': 1}, 2, {'b': 2}, 3],
+                              't': [{'id': 1, 'v': 1}, {'id': 2, 'v': 2}, {'id': 2, 'v': 3}, {'id': 3}]},
+                             deep_merge(base, other, list_strategy='append'))
+        self.assertDictEqual({'l': [2, {'a': 1, 'b': 2}, 3],
+                              't': [{'id': 2, 'v': 3}, {'id': 3, 'v': 2}]},
+                             deep_merge(base, other, list_strategy='index'))
+        self.assertDictEqual({'t': [{'id': 1, 'v': 1}, {'id': 2, 'v': 3}, {'id': 3}]},
+                             deep_merge({'t': base['t']}, {'t': other['t']}, list_strategy='key', list_key='id'))
+        self.assertEqual(({'id': 1, 'v': 1}, {'id': 2, 'v': 2}), base['t'])
+
+        target = {'l': [1, {'a': 1}]}
+        deep_merge_in(target, {'l': [2, {'b': 2}]}, list_strategy='index')
+        self.assertDictEqual({'l': [2, {'a': 1, 'b': 2}]}, target)
+        self.assertRaises(AppToolError, deep_merge, base, other, list_strategy='zip')
+        self.assertRaises(AppToolError, deep_merge, base, other, list_strategy='key')
+
+    def test_deep_merge_conflicts(self):
+        conflicts = []
+        deep_merge({'a': {'b': 1, 'c': 2}, 'd.e': [1]}, {'a': {'b': 1, 'c': 3}}, {'d.e': [2]},
+                   list_strategy='index', conflicts=conflicts)
+        self.assertListEqual([('a.c', 2, 3), ('d#e[0]', 1, 2)], sorted(conflicts))
+
+        conflicts = []
+        deep_merge_in({'a': {'b': 1}}, {'a': {'b': 2}, 'c': 3}, conflicts=conflicts)
+        self.assertListEqual([('a.b', 1, 2)], conflicts)
+
+    def test_put(self):
+        data = {'a': {'b': [1, (2, 3)]}, 'c': {'d': 4}}
+        result = put(data, 'a.b[-1][0]', 5)
+        self.assertDictEqual({'a': {'b': [1, [5, 3]]}, 'c': {'d': 4}}, result)
+        self.assertDictEqual({'a': {'b': [1, (2, 3)]}, 'c': {'d': 4}}, data)
+        self.assertIs(data['c'], result['c'])
+        self.assertDictEqual({'e.f': {'g': 6}}, put({}, 'e#f.g', 6, replacement_for_dot_in_key='#'))
+        self.assertRaises(AppToolError, put, data, 'a.b[2]', 6)
+        self.assertRaises(AppToolError, put, data, 'c.d[0]', 6)
+
+    def test_override_config(self):
+        changes = []
+        self.APP.subscribe(changes.append)
+        self.assertEqual({'smtp.port'}, self.APP.override('smtp.port', 465))
+        self.assertEqual(465, self.APP['smtp.port'])
+        self.assertEqual(set(), self.APP.reload_config(force=True))
+        self.assertEqual(465, self.APP['smtp.port'])
+        self.assertEqual([{'smtp.port'}], changes)
+
     def test_is_win(self):
         self.assertTrue(is_win())
 
@@ -101,6 +290,158 @@ class CoreTestCase(unittest.TestCase):
         self.assertDictEqual(data, load_data)
 
         os.remove(file_path)
+
+    def test_dump_json_atomic(self):
+        import tempfile
+        import threading
+        with tempfile.TemporaryDirectory() as dir_path:
+            file_path = os.path.join(dir_path, 'sub', 'state.json')
+            dump_json(file_path, {'count': 0}, lock=True)
+            os.chmod(file_path, 0o640)
+            dump_json(file_path, {'count': 1}, atomic=True)
+            self.assertEqual(0o640, os.stat(file_path).st_mode & 0o777)
+            self.assertDictEqual({'count': 1}, load_json(file_path, lock=True))
+            with self.assertRaises(TypeError):
+                dump_json(file_path, {'count': object()}, atomic=True)
+            self.assertDictEqual({'count': 1}, load_json(file_path))
+            self.assertListEqual(['state.json', 'state.json.lock'], sorted(os.listdir(os.path.dirname(file_path))))
+
+            if not is_win():
+                # Target of symlink is replaced, a hard link is kept by writing in place by default
+                link_path = os.path.join(dir_path, 'link.json')
+                os.symlink(file_path, link_path)
+                dump_json(link_path, {'count': 2}, atomic=True)
+                self.assertTrue(os.path.islink(link_path))
+                self.assertDictEqual({'count': 2}, load_json(file_path))
+                hard_path = os.path.join(dir_path, 'hard.json')
+                os.link(file_path, hard_path)
+                dump_json(file_path, {'count': 1})
+                self.assertDictEqual({'count': 1}, load_json(hard_path))
+                os.remove(link_path)
+                os.remove(hard_path)
+
+            def increase(state):
+                state['count'] += 1
+            def worker():
+                for _ in range(20):
+                    update_json(file_path, increase)
+            threads = [threading.Thread(target=worker) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertDictEqual({'count': 101}, load_json(file_path, lock=True))
+
+            new_path = os.path.join(dir_path, 'new.json')
+            self.assertListEqual([1], update_json(new_path, lambda items: items + [1], default=[]))
+            self.assertIsNone(load_json(os.path.join(dir_path, 'missing', 'state.json'), lock=True))
+
+    def test_load_json_cache(self):
+        import tempfile
+        from types import MappingProxyType
+        from unittest import mock
+        import marshal
+        cache = JsonCache()
+        with tempfile.TemporaryDirectory() as dir_path:
+            file_path = os.path.join(dir_path, 'state.json')
+            dump_json(file_path, {'items': [1, {'a': 2}]})
+            with mock.patch('json.load', wraps=__import__('json').load) as parse:
+                data = load_json(file_path, cache=cache)
+                data['items'].append(3)     # A copy
+                self.assertEqual(len(marshal.dumps({'items': [1, {'a': 2}]})), cache.bytes)
+                view = load_json(file_path, cache=cache, readonly=True)
+                self.assertGreater(cache.bytes, 300)     # Read-only view is charged too
+                self.assertIs(view, load_json(file_path, cache=cache, readonly=True))
+                self.assertEqual(1, parse.call_count)
+            self.assertIsInstance(view, MappingProxyType)
+            self.assertEqual((1, {'a': 2}), view['items'])
+            with self.assertRaises(TypeError):
+                view['items'][1]['a'] = 3
+            self.assertDictEqual({'items': [1, {'a': 2}]}, load_json(file_path, cache=cache))
+
+            # Invalidated by dump_json, and by a change from elsewhere
+            dump_json(file_path, {'items': []})
+            self.assertDictEqual({'items': []}, load_json(file_path, cache=cache, lock=True))
+            with open(file_path, 'w') as fp:
+                fp.write('{"items": [0]}')
+            os.utime(file_path, ns=(1, 1))
+            self.assertDictEqual({'items': [0]}, load_json(file_path, cache=cache))
+
+            # LRU within max_bytes, large file is not cached
+            cache = JsonCache(max_bytes=200, max_item_bytes=100)
+            load_json(file_path, cache=cache)
+            for i in range(5):
+                dump_json(os.path.join(dir_path, f'{i}.json'), {'i': i, 'pad': 'x' * 40})
+                load_json(os.path.join(dir_path, f'{i}.json'), cache=cache)
+            self.assertEqual(3, len(cache))
+            self.assertLessEqual(cache.bytes, 200)
+            self.assertNotIn(file_path, cache._entries)
+            self.assertIn(os.path.join(dir_path, '2.json'), cache._entries)
+            dump_json(file_path, {'items': list(range(100))})
+            self.assertEqual(list(range(100)), load_json(file_path, cache=cache)['items'])
+            self.assertNotIn(file_path, cache._entries)
+
+            os.remove(os.path.join(dir_path, '4.json'))
+            self.assertEqual('gone', load_json(os.path.join(dir_path, '4.json'), 'gone', cache=cache))
+            self.assertEqual(2, len(cache))
+            self.assertEqual(3, load_json(os.path.join(dir_path, '3.json'), cache=True)['i'])
+
+    def test_iter_json(self):
+        import json
+        import random
+        import tempfile
+        items = [{'id': i, 'name': f'名字 {i}', 'tags': [i, 12345678901234567890], 'nested': {'value': i / 3}} 
+                 for i in range(200)] + [None, 1.5e10, 'text, with ] and ,', [], {}]
+        with tempfile.TemporaryDirectory() as dir_path:
+            file_path = os.path.join(dir_path, 'items.json')
+            with open(file_path, 'w', encoding='utf8') as fp:
+                fp.write('  \n' + json.dumps(items, indent=2, ensure_ascii=False))
+            # Tiny chunks split items, strings and numbers
+            for chunk_size in (1, 7, 1024 * 1024):
+                self.assertListEqual(items, list(iter_json(file_path, chunk_size=chunk_size)))
+            self.assertListEqual([i / 3 for i in range(200)], list(iter_json(file_path, 'nested.value', chunk_size=16)))
+            self.assertListEqual([12345678901234567890] * 200, list(iter_json(file_path, 'tags[-1]')))
+            # Chunk boundary inside a top-level number, Ex. after "." or "e"
+            floats = [random.uniform(-1e6, 1e6) for _ in range(50)] + [1.5e-7, -2e+300, 0.0, -12, 10]
+            with open(file_path, 'w') as fp:
+                json.dump(floats, fp)
+            for chunk_size in range(1, 21):
+                self.assertListEqual(floats, list(iter_json(file_path, chunk_size=chunk_size)))
+
+            lines_path = os.path.join(dir_path, 'sub', 'items.log')
+            self.assertEqual(205, dump_jsonl(lines_path, iter(items), batch_size=64))
+            self.assertEqual(1, dump_jsonl(lines_path, [{'id': 'last'}], lock=True))
+            with open(lines_path, encoding='utf8') as fp:
+                self.assertEqual(206, len(fp.readlines()))
+            self.assertListEqual(items + [{'id': 'last'}], list(iter_json(lines_path, chunk_size=5)))
+            self.assertListEqual(list(range(200)) + ['last'], list(iter_json(lines_path, 'id', lines=True)))
+
+            for name, text in (('empty.json', '[ ]'), ('object.json', '{"a": 1}'), ('empty.jsonl', '\n\n')):
+                with open(os.path.join(dir_path, name), 'w') as fp:
+                    fp.write(text)
+            self.assertListEqual([], list(iter_json(os.path.join(dir_path, 'empty.json'))))
+            self.assertListEqual([{'a': 1}], list(iter_json(os.path.join(dir_path, 'object.json'))))
+            self.assertListEqual([], list(iter_json(os.path.join(dir_path, 'empty.jsonl'))))
+            with self.assertRaises(AppToolError):
+                list(iter_json(os.path.join(dir_path, 'object.json'), lines=False))
+            # JSON Lines of arrays without .jsonl extension
+            with open(file_path, 'w') as fp:
+                fp.write('[1, 2]\n[3]\n')
+            with self.assertRaises(json.JSONDecodeError):
+                list(iter_json(file_path, chunk_size=4))
+            self.assertListEqual([[1, 2], [3]], list(iter_json(file_path, lines=True)))
+            with open(file_path, 'w') as fp:
+                fp.write('[]\n[3]')
+            with self.assertRaises(json.JSONDecodeError):
+                list(iter_json(file_path))
+            with open(file_path, 'w') as fp:
+                fp.write('[1]\n\n  ')
+            self.assertListEqual([1], list(iter_json(file_path, chunk_size=1)))
+            for text in ('[1, 2', '[1 2]', '[1, {"a": }]'):
+                with open(file_path, 'w') as fp:
+                    fp.write(text)
+                with self.assertRaises(AppToolError):
+                    list(iter_json(file_path))
     
     def test_get_config(self):
         """
@@ -139,6 +480,188 @@ class CoreTestCase(unittest.TestCase):
 
         self.assertEqual(CONFIG_LOCAL['log']['level'], self.APP['log.level'])
 
+    def test_get_compiled_key(self):
+        from chariothy_common.utils import _compile_key
+        data = {'a': {'b.c': [[{'e': 'f'}]]}}
+        self.assertEqual((('a', (), 'a'), ('b.c', (0, -1), 'b.c[0][-1]'), ('e', (), 'e')), _compile_key('a.b#c[0][-1].e', '#'))
+        hits = _compile_key.cache_info().hits
+        self.assertEqual('f', get(data, 'a.b#c[0][-1].e', replacement_for_dot_in_key='#'))
+        self.assertEqual('f', get(data, 'a.b#c[0][-1].e', replacement_for_dot_in_key='#'))
+        self.assertGreater(_compile_key.cache_info().hits, hits)
+        self.assertRaises(AppToolError, get, data, 'a.b#c[1]', replacement_for_dot_in_key='#')
+        self.assertRaisesRegex(AppToolError, r'"a\.x\[0\]": "x" is not in config', get, data, 'a.x[0]')
+
+    def test_flatten(self):
+        data = {'a': {'b.c': [[1]], 'd#e': 2, 'f[0]': 3, 1: 4}}
+        self.assertDictEqual({
+            'a': data['a'],
+            'a.b#c': [[1]],
+            'a.b#c[0]': [1], 'a.b#c[-1]': [1],
+            'a.b#c[0][0]': 1, 'a.b#c[0][-1]': 1
+        }, flatten(data))
+        for key, value in flatten(data).items():
+            self.assertIs(value, get(data, key, check=True, replacement_for_dot_in_key='#'))
+
+    def test_frozen_config(self):
+        app = AppTool(self.APP_NAME, os.getcwd(), frozen=True)
+        self.assertIsNone(self.APP.snapshot)
+        self.assertIs(app.config['mail']['to'], app.snapshot['mail.to'])
+        for key in ('mail.from', 'demo#key2.from[0]', 'demo#key', 'demo.host', 'log.level'):
+            self.assertEqual(self.APP[key], app[key])
+            self.assertEqual(self.APP.get(key), app.get(key))
+        self.assertRaises(AppToolError, lambda k: app[k], 'mail.from.test')
+        self.assertEqual(1, app.get('mail.from.test', 1))
+        self.assertEqual(CONFIG['demo.key2']['from'][-1], app['demo#key2.from[-1]'])
+        with self.assertRaises(TypeError):
+            app.snapshot['mail.from'] = ''
+
+    def test_env_overlay(self):
+        os.environ['TESTING_DEMO_HOTS'] = self.demo_value
+        try:
+            app = AppTool(self.APP_NAME, os.getcwd())
+        finally:
+            del os.environ['TESTING_DEMO_HOTS']
+        self.assertEqual(self.demo_value, app['demo.host'])
+        self.assertIn('TESTING_DEMO_HOTS', app.unused_env_vars)
+        self.assertIn('TESTING_DEMO_KEY_FROM_0', app.unused_env_vars)
+        self.assertNotIn('TESTING_DEMO_HOST', app.unused_env_vars)
+        self.assertEqual(CONFIG['demo']['host'], app._merged_layers[-1]['demo']['host'])
+        self.assertIs(app._merged_layers[-1]['demo.key2'], app.config['demo.key2'])
+
+    def test_coerce(self):
+        self.assertEqual(465, coerce('465', int))
+        self.assertEqual(1.5, coerce('1.5', float))
+        self.assertIs(True, coerce('On', bool))
+        self.assertIs(False, coerce('0', bool))
+        self.assertEqual(['a', 'b'], coerce('a, b', list))
+        self.assertEqual(('a', 'b'), coerce('["a", "b"]', tuple))
+        self.assertEqual({'a': 1}, coerce('{"a": 1}', dict))
+        self.assertEqual(25, coerce(25, int))
+        self.assertRaises(AppToolError, coerce, 'x', int)
+        self.assertRaises(AppToolError, coerce, 'maybe', bool)
+        self.assertRaises(AppToolError, coerce, 25, str)
+
+    def test_env_schema(self):
+        from os import environ as env
+        env['TESTING_SMTP_PORT'] = '465'
+        env['TESTING_LOG_DEST'] = 'file, mail'
+        try:
+            app = AppTool(self.APP_NAME, os.getcwd(), schema={'demo.host': str.lower, 'demo#key': str}, coerce_env=True)
+            self.assertEqual(465, app['smtp.port'])
+            self.assertEqual(['file', 'mail'], app['log.dest'])
+            self.assertEqual(self.demo_value.lower(), app['demo.host'])
+            self.assertEqual(self.demo_value, app['demo#key'])
+
+            class Schema:
+                class log:
+                    dest: list
+            app = AppTool(self.APP_NAME, os.getcwd(), schema=Schema)
+            self.assertEqual('465', app['smtp.port'])
+            self.assertEqual(['file', 'mail'], app['log.dest'])
+
+            env['TESTING_SMTP_PORT'] = 'x'
+            self.assertRaises(AppToolError, AppTool, self.APP_NAME, os.getcwd(), coerce_env=True)
+        finally:
+            del env['TESTING_SMTP_PORT'], env['TESTING_LOG_DEST']
+
+    def test_validate_smtp(self):
+        self.assertRaisesRegex(AppToolError, '"pwd" is required', send_email, 
+            self.APP['mail.from'], self.APP['mail.to'], 'subject', 'body', {'host': 'localhost', 'port': 25, 'user': 'user'})
+
+    def test_reload_config(self):
+        import tempfile, time
+        with tempfile.TemporaryDirectory() as app_path:
+            mtimes = [time.time()]
+            def write_config(name, config):
+                file_path = os.path.join(app_path, name + '.py')
+                with open(file_path, 'w') as fp:
+                    fp.write(f'CONFIG = {config!r}\n')
+                mtimes.append(mtimes[-1] + 10)
+                os.utime(file_path, (mtimes[-1], mtimes[-1]))
+
+            write_config('reloading', {'log': {'dest': []}, 'a': 1, 'b': {'c': 2, 'd.e': 3}})
+            app = AppTool('reloading', app_path, config_name='reloading')
+            changes = []
+            app.subscribe(changes.append)
+            self.assertEqual(set(), app.reload_config())
+
+            write_config('reloading', {'log': {'dest': []}, 'a': 1, 'b': {'c': 2, 'd.e': 4}, 'f': 5})
+            old_config = app.config
+            self.assertEqual({'b.d#e', 'f'}, app.reload_config())
+            self.assertEqual(4, app['b.d#e'])
+            self.assertEqual(3, old_config['b']['d.e'])
+
+            write_config('reloading_local', {'a': 11})
+            self.assertEqual({'a'}, app.reload_config())
+            self.assertEqual(11, app['a'])
+            self.assertEqual(5, app['f'])
+            self.assertEqual([{'b.d#e', 'f'}, {'a'}], changes)
+
+            # Replaced in place, which is not seen by layers merged again on reload
+            app.config['b'] = {'c': 20}
+            self.assertIsNot(app.config['b'], app._merged_layers[-1]['b'])
+            write_config('reloading_local', {'a': 11, 'g': 6})
+            self.assertEqual({'b.c', 'b.d#e', 'g'}, app.reload_config())
+            self.assertEqual({'c': 2, 'd.e': 4}, app['b'])
+            del changes[-1]
+
+            app.watch_config(0.01)
+            write_config('reloading_local', {'a': 12})
+            for _ in range(200):
+                if len(changes) > 2:
+                    break
+                time.sleep(0.01)
+            app.stop_watching()
+            self.assertEqual(12, app['a'])
+
+    def test_config_isolation(self):
+        import sys
+        import tempfile
+        with tempfile.TemporaryDirectory() as app_path:
+            def write_config(name, text):
+                with open(os.path.join(app_path, name + '.py'), 'w') as fp:
+                    fp.write(text)
+            write_config('isolated', "import os\nCONFIG = {'log': {'dest': []}, 'a': 1, 'b': {'c': 2}}\n")
+            write_config('isolated_local', "from isolated import CONFIG as BASE\nCONFIG = {'a': BASE['a'] + 10}\n")
+            sys_path = list(sys.path)
+            sys_modules = set(sys.modules)
+            app = AppTool('isolated', app_path, config_name='isolated')
+            self.assertEqual(11, app['a'])
+            self.assertEqual(2, app['b.c'])
+            self.assertListEqual(sys_path, sys.path)
+            self.assertSetEqual(set(), set(sys.modules) - sys_modules)
+
+            write_config('isolated_local', "CONFIG = {'a': undefined}\n")
+            with self.assertRaisesRegex(AppToolError, 'isolated_local.py.*NameError'):
+                app.reload_config(force=True)
+            self.assertEqual(11, app['a'])
+            os.remove(os.path.join(app_path, 'isolated_local.py'))
+            self.assertEqual({'a'}, app.reload_config())
+            self.assertEqual(1, app['a'])
+
+    def test_config_other_imports(self):
+        import sys
+        import tempfile
+        with tempfile.TemporaryDirectory() as app_path:
+            def write_config(name, text):
+                with open(os.path.join(app_path, name + '.py'), 'w') as fp:
+                    fp.write(text)
+            write_config('importing', "import importing_helpers\n"
+                                      "def load(name):\n    return __import__(name)\n"
+                                      "CONFIG = {'log': {'dest': []}, 'marker': importing_helpers.MARKER, 'load': load}\n")
+            write_config('importing_helpers', "MARKER = object()\n")
+            sys.path.insert(0, app_path)
+            self.addCleanup(sys.path.remove, app_path)
+            self.addCleanup(sys.modules.pop, 'importing_helpers', None)
+            self.addCleanup(sys.modules.pop, 'importing', None)
+            app = AppTool('importing', app_path, config_name='importing')
+            # Modules other than config ones are imported as usual, once
+            self.assertIs(sys.modules['importing_helpers'].MARKER, app['marker'])
+            self.assertIs(sys.modules['importing_helpers'], app['load']('importing_helpers'))
+            # Config module imported by a function after it's executed is not a sibling any more
+            module = app['load']('importing')
+            self.assertIs(sys.modules['importing'], module)
+
     def test_send_text_email(self):
         """
         docstring
@@ -224,5 +747,958 @@ class CoreTestCase(unittest.TestCase):
         self.assertDictEqual(result, {})
 
 
+class SMTPPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = SMTPStandIn(refused=('nobody@localhost',)).__enter__()
+        self.pool = SMTPPool(idle_timeout=60)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.__exit__(None, None, None)
+
+    def send(self, to_addrs='to@localhost', smtp_config=None, smtp_pool=None):
+        return send_email('from@localhost', to_addrs, 'Pooled', 'Pooled', smtp_config or self.server.smtp_config, 
+                          smtp_pool=smtp_pool or self.pool)
+
+    def test_reuse_session(self):
+        for _ in range(3):
+            self.assertDictEqual({}, self.send())
+        self.assertEqual(1, self.server.connections)
+        self.assertEqual(1, self.server.logins)
+        self.assertEqual(3, len(self.server.messages))
+        self.assertEqual(2, self.server.commands.count('NOOP'))
+        self.assertEqual(1, self.pool.idle_count)
+
+        smtp_config = dict(self.server.smtp_config, user='other@localhost')
+        self.send(smtp_config=smtp_config)
+        self.assertEqual(2, self.server.logins)
+        self.assertEqual(2, self.pool.idle_count)
+
+    def test_reconnect(self):
+        self.send()
+        self.server.drop_connections()
+        self.assertDictEqual({}, self.send())
+        self.assertEqual(2, self.server.connections)
+        self.assertEqual(2, len(self.server.messages))
+
+        # Dropped between NOOP and sending
+        server = self.pool.acquire(self.server.smtp_config)
+        self.pool.release(self.server.smtp_config, server)
+        self.pool.acquire = lambda smtp_config, debug=False: server
+        self.server.drop_connections()
+        self.assertDictEqual({}, self.send())
+        self.assertEqual(3, self.server.connections)
+
+    def test_refused_keeps_session(self):
+        result = self.send(to_addrs='to@localhost,nobody@localhost')
+        self.assertListEqual(['nobody@localhost'], list(result))
+        self.send()
+        self.assertEqual(1, self.server.connections)
+
+    def test_idle_timeout(self):
+        import time
+        pool = SMTPPool(idle_timeout=0.05)
+        self.send(smtp_pool=pool)
+        for _ in range(100):
+            if 'QUIT' in self.server.commands:
+                break
+            time.sleep(0.01)
+        self.assertEqual(0, pool.idle_count)
+        self.assertIn('QUIT', self.server.commands)
+        self.send(smtp_pool=pool)
+        self.assertEqual(2, self.server.connections)
+        pool.close()
+
+    def test_app_tool_pool(self):
+        app = AppTool('testing', os.getcwd())
+        app._config = dict(app.config, smtp=self.server.smtp_config, mail={'from': 'from@localhost', 'to': 'to@localhost'})
+        for _ in range(2):
+            self.assertDictEqual({}, app.send_email('AppTool pooled', 'AppTool pooled'))
+        self.assertEqual(1, self.server.logins)
+        app.smtp_pool.close()
+
+
+    def test_send_emails(self):
+        import re
+        messages = ['to%d@localhost' % i for i in range(4)]
+        messages.append({'to_addrs': ('to4@localhost', 'nobody@localhost'), 'subject': 'Subject 4'})
+        pwd = os.path.dirname(__file__)
+        results = send_emails('from@localhost', iter(messages), 'Digest', 'Digest', self.server.smtp_config, 
+                              html_body='<img src="cid:{}">', image_paths=(os.path.join(pwd, 'train.png'),), 
+                              sessions=2, messages_per_session=2)
+        self.assertListEqual([{}] * 4 + [{'nobody@localhost': (550, b'No such user')}], results)
+        self.assertEqual(3, self.server.connections)
+        self.assertEqual(5, len(self.server.messages))
+        self.assertIn(b'Subject: Subject 4', b''.join(data for _, data in self.server.messages))
+        cids = {re.search(rb'Content-ID:\s+(<.+?>)', data).group(1) for _, data in self.server.messages}
+        self.assertEqual(1, len(cids))
+
+        app = AppTool('testing', os.getcwd())
+        app._config = dict(app.config, smtp=self.server.smtp_config, mail={'from': 'from@localhost', 'to': 'to@localhost'})
+        self.assertListEqual([{}] * 3, app.send_emails(messages[:3], 'AppTool digest', 'AppTool digest', sessions=1))
+        self.assertEqual(4, self.server.connections)
+        app.smtp_pool.close()
+
+    def test_send_emails_to_file(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as email_file_dir:
+            results = send_emails('from@localhost', ('to%d@localhost' % i for i in range(3)), 'Digest', 'Digest', 
+                                  send_to_file=True, email_file_dir=email_file_dir)
+            self.assertListEqual([{}] * 3, results)
+            self.assertEqual(3, len(os.listdir(email_file_dir)))
+        self.assertEqual(0, self.server.connections)
+
+class AsyncSendTestCase(unittest.TestCase):
+    def run_async(self, server, coro):
+        import asyncio
+        loop = asyncio.new_event_loop()
+        try:
+            with server:
+                return loop.run_until_complete(coro)
+        finally:
+            loop.close()
+
+    def wait_closed(self, server):
+        import time
+        for _ in range(100):
+            if not server.sockets:
+                break
+            time.sleep(0.01)
+        self.assertEqual(set(), server.sockets)
+
+    def test_send_email_async(self):
+        import asyncio
+        server = SMTPStandIn(refused=('nobody@localhost',))
+
+        async def send_all():
+            semaphore = asyncio.Semaphore(2)
+            sends = [send_email_async('from@localhost', 'to%d@localhost' % i, 'Async', 'Async', server.smtp_config,
+                                      semaphore=semaphore) for i in range(5)]
+            sends.append(send_email_async('from@localhost', 'to@localhost,nobody@localhost', 'Async', 'Async', 
+                                          server.smtp_config, semaphore=semaphore))
+            return await asyncio.gather(*sends)
+
+        results = self.run_async(server, send_all())
+        self.assertListEqual([{}] * 5 + [{'nobody@localhost': (550, b'No such user')}], results)
+        self.assertEqual(6, server.logins)
+        self.assertEqual(6, len(server.messages))
+        self.assertEqual(2, server.max_active)
+        self.assertIn(b'Subject: Async', server.messages[0][1])
+
+    def test_send_email_async_timeout(self):
+        import asyncio
+        server = SMTPStandIn(stall=True)
+        with self.assertRaises(asyncio.TimeoutError):
+            self.run_async(server, send_email_async('from@localhost', 'to@localhost', 'Async', 'Async', server.smtp_config, 
+                                                    timeout=0.1))
+        self.wait_closed(server)
+
+    def test_send_email_async_cancel(self):
+        import asyncio
+        server = SMTPStandIn(stall=True)
+
+        async def cancel():
+            task = asyncio.ensure_future(send_email_async('from@localhost', 'to@localhost', 'Async', 'Async', 
+                                                          server.smtp_config))
+            await asyncio.sleep(0.1)
+            task.cancel()
+            await task
+
+        with self.assertRaises(asyncio.CancelledError):
+            self.run_async(server, cancel())
+        self.wait_closed(server)
+
+    def test_send_email_async_to_file(self):
+        import tempfile
+        server = SMTPStandIn()
+        with tempfile.TemporaryDirectory() as email_file_dir:
+            result = self.run_async(server, send_email_async('from@localhost', 'to@localhost', 'Async', 'Async', 
+                                                             send_to_file=True, email_file_dir=email_file_dir))
+            self.assertDictEqual({}, result)
+            self.assertEqual(1, len(os.listdir(email_file_dir)))
+        self.assertEqual(0, server.connections)
+
+    def test_async_smtp(self):
+        import asyncio
+        from unittest import mock
+        from chariothy_common.async_smtp import AsyncSMTP
+        server = SMTPStandIn()
+        async def send():
+            smtp = AsyncSMTP(debug=True)
+            await smtp.connect(server.smtp_config)
+            await smtp.sendmail('from@localhost', ['to@localhost'], b'Subject: Debug\r\n\r\nDebug\r\n')
+            await smtp.quit()
+        with self.assertLogs('chariothy_common.async_smtp', logging.DEBUG) as logs:
+            self.run_async(server, send())
+        self.assertIn("send: b'MAIL FROM:<from@localhost>\\r\\n'", '\n'.join(logs.output))
+
+        # STARTTLS checks certificate against host
+        writer = mock.Mock(start_tls=mock.AsyncMock())
+        smtp = AsyncSMTP()
+        with mock.patch('asyncio.open_connection', mock.AsyncMock(return_value=(mock.Mock(), writer))), \
+             mock.patch.object(smtp, 'command', mock.AsyncMock(return_value=(220, b''))), \
+             mock.patch.object(smtp, '_expect', mock.AsyncMock()), \
+             mock.patch.object(smtp, 'ehlo', mock.AsyncMock()), mock.patch.object(smtp, 'login', mock.AsyncMock()):
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(smtp.connect({'host': 'smtp.example.com', 'port': 587, 'type': 'tls', 'user': 'u', 'pwd': 'p'}))
+            finally:
+                loop.close()
+        self.assertEqual('smtp.example.com', writer.start_tls.call_args.kwargs['server_hostname'])
+
+    def test_app_tool_send_email_async(self):
+        server = SMTPStandIn()
+        app = AppTool('testing', os.getcwd())
+        app._config = dict(app.config, smtp=server.smtp_config, mail={'from': 'from@localhost', 'to': 'to@localhost'})
+        self.assertDictEqual({}, self.run_async(server, app.send_email_async('AppTool async', 'AppTool async')))
+        self.assertEqual(1, len(server.messages))
+
+class EmailAssetsTestCase(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write_file(self, name, content, mtime=None):
+        file_path = os.path.join(self.temp_dir.name, name)
+        with open(file_path, 'wb') as fp:
+            fp.write(content)
+        if mtime is not None:
+            os.utime(file_path, (mtime, mtime))
+        return file_path
+
+    def test_asset_cache(self):
+        from chariothy_common.email_assets import AssetCache, image_part, attachment_part
+        cache = AssetCache(max_bytes=3000, max_item_bytes=2000)
+        logo = self.write_file('logo.png', b'p' * 500)
+        self.assertIs(image_part(logo, cache), image_part(logo, cache))
+        self.assertIsNot(image_part(logo, cache), attachment_part(logo, cache))
+
+        file_path = self.write_file('a.bin', b'a' * 1000, mtime=1000)
+        part = attachment_part(file_path, cache)
+        self.assertIs(part, attachment_part(file_path, cache))
+        self.write_file('a.bin', b'b' * 1000, mtime=2000)
+        self.assertIsNot(part, attachment_part(file_path, cache))
+        self.assertEqual(b'b' * 1000, attachment_part(file_path, cache).get_content())
+
+        for name in 'bcd':
+            attachment_part(self.write_file(name + '.bin', name.encode() * 1000), cache)
+        self.assertLessEqual(cache.bytes, 3000)
+        self.assertEqual(2, len(cache))
+
+    def test_stream_large_attachment(self):
+        import email, email.policy
+        from chariothy_common.email_assets import asset_cache, StreamedPart
+        content = os.urandom(asset_cache.max_item_bytes + 1000) + b'\n.\n'
+        file_path = self.write_file('large.bin', content)
+        email_file_dir = os.path.join(self.temp_dir.name, 'emails')
+
+        def check(data):
+            msg = email.message_from_bytes(data, policy=email.policy.default)
+            attachment = next(msg.iter_attachments())
+            self.assertEqual('large.bin', attachment.get_filename())
+            self.assertEqual(content, attachment.get_content())
+
+        send_email('from@localhost', 'to@localhost', 'Large', 'Large', file_paths=(file_path,), 
+                   send_to_file=True, email_file_dir=email_file_dir)
+        with open(os.path.join(email_file_dir, os.listdir(email_file_dir)[0]), 'rb') as fp:
+            check(fp.read())
+
+        with SMTPStandIn() as server:
+            send_email('from@localhost', 'to@localhost', 'Large', 'Large', server.smtp_config, file_paths=(file_path,))
+            send_emails('from@localhost', ['to@localhost'], 'Large', 'Large', server.smtp_config, file_paths=(file_path,))
+            import asyncio
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(send_email_async('from@localhost', 'to@localhost', 'Large', 'Large', 
+                                                         server.smtp_config, file_paths=(file_path,)))
+            finally:
+                loop.close()
+        self.assertEqual(3, len(server.messages))
+        for _, data in server.messages:
+            # Undo dot-stuffing of the stand-in server
+            check(data.replace(b'\r\n..', b'\r\n.'))
+
+class MailSpoolTestCase(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.spool_dir = os.path.join(self.temp_dir.name, 'spool')
+        self.server = SMTPStandIn(refused=('nobody@localhost',)).__enter__()
+
+    def tearDown(self):
+        self.server.__exit__(None, None, None)
+        self.temp_dir.cleanup()
+
+    def spool(self, smtp_config=None, **kwargs):
+        spool = MailSpool(self.spool_dir, smtp_config or self.server.smtp_config, **kwargs)
+        self.addCleanup(spool.stop)
+        return spool
+
+    def send(self, spool, to_addrs='to@localhost'):
+        return send_email('from@localhost', to_addrs, 'Spooled', 'Spooled', spool=spool)
+
+    def test_deliver(self):
+        spool = self.spool()
+        self.assertDictEqual({}, self.send(spool))
+        self.assertEqual(1, len(spool.queued))
+        self.assertEqual(0, self.server.connections)
+        self.assertEqual(1, spool.deliver_due())
+        self.assertEqual([], spool.queued)
+        self.assertEqual(1, len(self.server.messages))
+        self.assertIn(b'Subject: Spooled', self.server.messages[0][1])
+
+    def test_retry_and_dead(self):
+        import time
+        down = SMTPStandIn()
+        spool = self.spool(down.smtp_config, retry_delay=0.05, max_attempts=3)
+        down._server.server_close()
+        self.send(spool)
+        self.assertEqual(0, spool.deliver_due())
+        self.assertEqual(1, len(spool.queued))
+        self.assertEqual(0, spool.deliver_due())     # Not due yet
+        time.sleep(0.06)
+        spool.deliver_due()
+        time.sleep(0.11)
+        spool.deliver_due()
+        self.assertEqual([], spool.queued)
+        self.assertEqual(1, len(spool.dead))
+
+        spool = self.spool()
+        self.send(spool, 'nobody@localhost')
+        spool.deliver_due()
+        self.assertEqual(2, len(spool.dead))
+
+    def test_bcc_and_refused(self):
+        from email.message import EmailMessage
+        msg = EmailMessage()
+        msg['From'] = 'from@localhost'
+        msg['To'] = 'to@localhost, nobody@localhost'
+        msg['Bcc'] = 'hidden@localhost'
+        msg['Subject'] = 'Bcc'
+        msg.set_content('Bcc\n')
+        spool = self.spool()
+        spool.put(msg)
+        with self.assertLogs('spool', logging.ERROR) as logs:
+            spool.logger = logging.getLogger('spool')
+            self.assertEqual(1, spool.deliver_due())
+        self.assertIn('nobody@localhost', logs.output[0])
+        recipients, data = self.server.messages[0]
+        self.assertEqual(['<to@localhost>', '<hidden@localhost>'], recipients)
+        self.assertNotIn(b'hidden@localhost', data)
+        self.assertIn(b'Subject: Bcc\r\n', data)
+
+    def test_malformed(self):
+        import time
+        spool = self.spool(poll_interval=0.01)
+        queue_dir = os.path.join(self.spool_dir, 'queue')
+        with open(os.path.join(queue_dir, '0000000000000000-0-nofrom.eml'), 'wb') as fp:
+            fp.write(b'To: to@localhost\r\nSubject: No from\r\n\r\nBody\r\n')
+        with open(os.path.join(queue_dir, 'bad-name.eml'), 'wb') as fp:
+            fp.write(b'From: from@localhost\r\nTo: to@localhost\r\n\r\nBody\r\n')
+        spool.start()
+        self.send(spool)
+        for _ in range(200):
+            if len(self.server.messages) == 1 and len(spool.dead) == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(2, len(spool.dead))
+        self.assertEqual([], os.listdir(os.path.join(self.spool_dir, 'sending')))
+        self.assertEqual(1, len(self.server.messages))
+        self.assertTrue(spool._worker.is_alive())
+
+    def test_restart(self):
+        import time
+        spool = self.spool()
+        self.send(spool)
+        self.send(spool)
+        # Claimed by a worker which crashed
+        name = spool.queued[0]
+        os.replace(os.path.join(self.spool_dir, 'queue', name), os.path.join(self.spool_dir, 'sending', name))
+        os.utime(os.path.join(self.spool_dir, 'sending', name), (time.time() - 1000, time.time() - 1000))
+
+        self.assertEqual(2, self.spool().deliver_due())
+        self.assertEqual(2, len(self.server.messages))
+
+    def test_worker(self):
+        import time
+        spool = self.spool().start()
+        for i in range(3):
+            self.send(spool, 'to%d@localhost' % i)
+        for _ in range(200):
+            if len(self.server.messages) == 3:
+                break
+            time.sleep(0.01)
+        self.assertEqual(3, len(self.server.messages))
+        self.assertEqual(1, self.server.logins)
+
+    def test_app_tool_spool(self):
+        app = AppTool('testing', os.getcwd())
+        app._config = dict(app.config, smtp=self.server.smtp_config, 
+                           mail={'from': 'from@localhost', 'to': 'to@localhost', 'spool_dir': self.spool_dir})
+        self.addCleanup(lambda: app.mail_spool.stop())
+        self.assertDictEqual({}, app.send_email('AppTool spooled', 'AppTool spooled'))
+        app.mail_spool.stop()
+        self.assertEqual(1, len(self.server.messages) + len(app.mail_spool.queued))
+
+class _ListHandler(logging.Handler):
+    def __init__(self, delay: float=0, level=logging.NOTSET):
+        super().__init__(level)
+        self.delay = delay
+        self.records = []
+        self.setFormatter(logging.Formatter('%(levelname)s - %(message)s'))
+
+    def emit(self, record):
+        import time
+        time.sleep(self.delay)
+        self.records.append(self.format(record))
+
+
+class QueueLoggingTestCase(unittest.TestCase):
+    def logger(self, name):
+        logger = logging.getLogger(f'queue-logging-{name}')
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False
+        return logger
+
+    def test_overflow(self):
+        with self.assertRaises(AppToolError):
+            BoundedQueueHandler(overflow='never')
+
+        logger = self.logger('drop-oldest')
+        handler = BoundedQueueHandler(2, 'drop_oldest')
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        for i in range(3):
+            logger.info('info %d', i)
+        self.assertEqual(1, handler.dropped)
+        self.assertEqual(['info 1', 'info 2'], [handler.queue.get_nowait().msg for _ in range(2)])
+
+        logger = self.logger('drop-debug')
+        handler = BoundedQueueHandler(2, 'drop_debug')
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        logger.info('info')
+        logger.debug('debug')
+        logger.debug('dropped')
+        self.assertEqual(1, handler.dropped)
+        self.assertEqual(['info', 'debug'], [handler.queue.get_nowait().msg for _ in range(2)])
+
+    def test_queue_logging(self):
+        import time
+        logger = self.logger('slow')
+        slow = _ListHandler(0.05)
+        errors = _ListHandler(level=logging.ERROR)
+        queue_logging = QueueLogging(logger, [slow, errors]).start()
+        self.addCleanup(queue_logging.stop)
+
+        start = time.perf_counter()
+        logger.info('info %s', 'arg')
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            logger.exception('failed')
+        self.assertLess(time.perf_counter() - start, 0.05)
+
+        queue_logging.flush()
+        self.assertEqual('INFO - info arg', slow.records[0])
+        self.assertTrue(slow.records[1].startswith('ERROR - failed\nTraceback'))
+        self.assertIn('ZeroDivisionError', slow.records[1])
+        self.assertEqual(1, len(errors.records))
+
+        logger.info('left in queue')
+        queue_logging.stop()
+        self.assertEqual('INFO - left in queue', slow.records[-1])
+        self.assertNotIn(queue_logging.handler, logger.handlers)
+
+    def test_app_tool(self):
+        app = AppTool('testing-queue-logging', os.getcwd())
+        app.config['log'] = {'level': 'DEBUG', 'dest': ['file'], 'async': 'on', 'overflow': 'drop_debug'}
+        logger = app.init_logger()
+        self.addCleanup(app.queue_logging.stop)
+        self.assertEqual([app.queue_logging.handler], logger.handlers)
+        self.assertEqual('drop_debug', app.queue_logging.handler.overflow)
+        app.info('Logged by listener thread')
+        app.queue_logging.flush()
+
+        app.config['log']['async'] = False
+        app.init_logger()
+        self.assertIsNone(app.queue_logging)
+        self.assertNotIn(BoundedQueueHandler, [type(handler) for handler in logger.handlers])
+
+class DigestSMTPHandlerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = SMTPStandIn().__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+        self.logger = logging.getLogger('digest-mail')
+        self.logger.propagate = False
+
+    def handler(self, **kwargs):
+        handler = DigestSMTPHandler(self.server.smtp_config, 'from@localhost', 'to@localhost', 
+                                    '%(name)s - %(levelname)s - %(message)s', **kwargs)
+        self.logger.addHandler(handler)
+        self.addCleanup(self.logger.removeHandler, handler)
+        return handler
+
+    def wait_messages(self, count):
+        import time
+        for _ in range(200):
+            if len(self.server.messages) >= count:
+                break
+            time.sleep(0.01)
+
+    def test_digest(self):
+        handler = self.handler()
+        for i in range(50):
+            self.logger.error('Failed to sync %d', i)
+        for ex in (ValueError('a'), KeyError('b'), ValueError('c')):
+            try:
+                raise ex
+            except Exception:
+                self.logger.exception('Crashed')
+        self.assertEqual(0, self.server.connections)
+
+        handler.close()
+        self.assertEqual(1, len(self.server.messages))
+        import email
+        msg = email.message_from_bytes(self.server.messages[0][1])
+        self.assertEqual('[53 records] digest-mail - ERROR - Failed to sync 0', msg['Subject'])
+        # Body may be quoted-printable if a traceback line is long
+        body = msg.get_payload(decode=True).decode()
+        self.assertIn('=== 50 times from ', body)
+        self.assertIn('=== 2 times from ', body)
+        self.assertIn('KeyError', body)
+        self.assertEqual(1, body.count('Failed to sync'))
+
+    def test_window_and_cap(self):
+        import time
+        handler = self.handler(window=0.05, max_per_minute=2)
+        for i in range(3):
+            self.logger.error('Window %d', i)
+            time.sleep(0.1)
+        self.wait_messages(2)
+        self.assertEqual(2, len(self.server.messages))
+        self.assertFalse(handler.send_digest())     # Over cap
+        self.assertEqual(2, len(self.server.messages))
+        self.assertIn(b'Subject: digest-mail - ERROR - Window 1', self.server.messages[1][1])
+
+        handler.close()
+        self.assertEqual(3, len(self.server.messages))
+        self.assertEqual(1, self.server.logins)
+
+    def test_shared_pool_and_failure(self):
+        from unittest import mock
+        pool = SMTPPool()
+        self.addCleanup(pool.close)
+        handler = self.handler(smtp_pool=pool)
+        self.logger.error('Kept %d', 1)
+        with mock.patch.object(pool, 'send_message', side_effect=OSError('down')), \
+             mock.patch.object(logging, 'raiseExceptions', False):
+            self.assertFalse(handler.send_digest())
+        self.assertIsNotNone(handler._timer)     # Retried after window
+        self.logger.error('Kept %d', 2)
+        self.logger.error('Later')
+        handler.close()
+        self.assertEqual(1, len(self.server.messages))
+        data = self.server.messages[0][1].decode()
+        self.assertIn('Subject: [3 records] digest-mail - ERROR - Kept 1', data)
+        self.assertIn('=== 2 times from ', data)
+        self.assertIn('Later', data)
+        self.assertEqual(1, pool.idle_count)    # Pool of AppTool is not closed by handler
+
+    def test_queued(self):
+        handler = DigestSMTPHandler(self.server.smtp_config, 'from@localhost', 'to@localhost', '%(message)s')
+        queue_logging = QueueLogging(self.logger, [handler]).start()
+        for host in ('a', 'b', 'c'):
+            self.logger.error('Timeout on %s', host)
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            self.logger.exception('Crashed')
+        queue_logging.stop()
+        self.assertEqual(0, len(self.server.messages))     # Not sent by flush() before window
+        handler.close()
+        self.assertEqual(1, len(self.server.messages))
+        import email
+        msg = email.message_from_bytes(self.server.messages[0][1])
+        self.assertEqual('[4 records] Timeout on a', msg['Subject'])
+        body = msg.get_payload(decode=True).decode()
+        self.assertIn('=== 3 times from ', body)
+        self.assertIn('ZeroDivisionError', body)
+
+    def test_max_entries(self):
+        handler = self.handler(max_entries=2)
+        for i in range(5):
+            self.logger.error(f'Distinct {i}')
+        handler.close()
+        data = self.server.messages[0][1].decode()
+        self.assertIn('Subject: [5 records]', data)
+        self.assertIn('=== 3 more records omitted ===', data)
+
+class RotatingCompressedFileHandlerTestCase(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.temp_dir.cleanup)
+        self.log_path = os.path.join(self.temp_dir.name, 'app.log')
+
+    def handler(self, **kwargs):
+        handler = RotatingCompressedFileHandler(self.log_path, **kwargs)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self.addCleanup(handler.close)
+        return handler
+
+    def write(self, handler, count, start=0):
+        for i in range(start, start + count):
+            handler.handle(logging.makeLogRecord({'msg': f'{i:04d} ' + 'x' * 95}))   # 101 bytes a line
+
+    def test_invalid(self):
+        with self.assertRaises(AppToolError):
+            RotatingCompressedFileHandler(self.log_path, when='W')
+        with self.assertRaises(AppToolError):
+            RotatingCompressedFileHandler(self.log_path, compress='bz2')
+
+    def test_rotate_by_size(self):
+        import gzip
+        handler = self.handler(max_bytes=1000, compress='gzip', backup_count=3)
+        self.write(handler, 100)
+        handler.wait_background()
+        rotated = handler.rotated_files()
+        self.assertEqual(3, len(rotated))
+        self.assertTrue(all(path.endswith('.log.gz') for path in rotated))
+        self.assertEqual(101, os.path.getsize(self.log_path))     # 9 lines a file, 100 = 11 * 9 + 1
+        with gzip.open(rotated[-1], 'rt') as fp:
+            lines = fp.read().splitlines()
+        self.assertEqual(9, len(lines))
+        self.assertTrue(lines[0].startswith('0090 '))
+        with open(self.log_path) as fp:
+            self.assertTrue(fp.readline().startswith('0099 '))
+
+    def test_rotate_by_time(self):
+        import time
+        handler = self.handler(when='S', interval=3600)
+        self.write(handler, 2)
+        self.assertEqual([], handler.rotated_files())
+        handler._rollover_at = time.time()
+        self.write(handler, 1, 2)
+        handler.wait_background()
+        rotated = handler.rotated_files()
+        self.assertEqual(1, len(rotated))
+        self.assertEqual(2 * 101, os.path.getsize(rotated[0]))
+        self.assertEqual(101, os.path.getsize(self.log_path))
+
+    def test_max_total_bytes(self):
+        handler = self.handler(max_bytes=1000, when=None, backup_count=0, max_total_bytes=3500)
+        self.write(handler, 200)
+        handler.wait_background()
+        total = sum(os.path.getsize(path) for path in handler.rotated_files() + [self.log_path])
+        self.assertLessEqual(total, 3500)
+        self.assertEqual(3, len(handler.rotated_files()))     # 3 * 909 + 202
+
+    def test_compress_left_over(self):
+        left_over = self.log_path + '.2000-01-01_00-00-00-000000.log'
+        with open(left_over, 'w') as fp:
+            fp.write('left over\n')
+        handler = self.handler(max_bytes=1000, compress='gzip')
+        self.write(handler, 11)
+        handler.close()
+        self.assertEqual([left_over + '.gz'], handler.rotated_files()[:1])
+        self.assertEqual(2, len(handler.rotated_files()))
+
+    def test_close_timeout(self):
+        import gzip, time
+        left_over = self.log_path + '.2000-01-01_00-00-00-000000.log'
+        with open(left_over, 'wb') as fp:
+            fp.write(os.urandom(128 * 1024 * 1024))
+        handler = self.handler(compress='gzip', close_timeout=0.2)
+        self.write(handler, 1)
+        started = time.time()
+        handler.close()
+        self.assertLess(time.time() - started, 1.5)
+        self.assertEqual([left_over], handler.rotated_files())
+        self.assertFalse(os.path.exists(left_over + '.gz.tmp'))
+
+        with open(left_over, 'wb') as fp:
+            fp.write(b'left over\n')
+        handler = self.handler(compress='gzip')
+        self.write(handler, 1)
+        handler.wait_background()
+        self.assertEqual([left_over + '.gz'], handler.rotated_files())
+        with gzip.open(left_over + '.gz') as fp:
+            self.assertEqual(b'left over\n', fp.read())
+
+class LogFormatterTestCase(unittest.TestCase):
+    def record(self, msg='Synced %d', args=(3,), **kwargs):
+        return logging.makeLogRecord(dict({'name': 'app', 'levelname': 'INFO', 'levelno': logging.INFO, 
+                                           'msg': msg, 'args': args, 'created': 1700000000.25, 'msecs': 250.0}, **kwargs))
+
+    def test_text(self):
+        import time
+        formatter = TextFormatter('%(asctime)s - %(levelname)s - %(message)s')
+        text = formatter.format(self.record(fields={'count': 3, 'user': 'henry'}))
+        expected = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(1700000000)) + ',250 - INFO - Synced 3 count=3 user=henry'
+        self.assertEqual(expected, text)
+        self.assertEqual(logging.Formatter().formatTime(self.record()), formatter.formatTime(self.record()))
+
+    def test_json(self):
+        import json
+        from pathlib import PurePosixPath
+        formatter = JsonFormatter()
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            import sys
+            record = self.record(exc_info=sys.exc_info(), job='sync', fields={'count': 3, 'path': PurePosixPath('/tmp')})
+        line = formatter.format(record)
+        doc = json.loads(line)
+        self.assertEqual(['time', 'level', 'logger', 'message', 'job', 'count', 'path', 'exception'], list(doc))
+        self.assertEqual('Synced 3', doc['message'])
+        self.assertEqual('/tmp', doc['path'])
+        self.assertTrue(doc['time'].startswith(formatter.formatTime(record)[:19]))
+        self.assertRegex(doc['time'], r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.250[+-]\d\d:\d\d$')
+        self.assertIn('ZeroDivisionError', doc['exception'])
+        self.assertEqual(record.exc_text, doc['exception'])
+        self.assertNotIn('\n', line)
+
+        # Serialized once for handlers sharing formatter
+        record.msg = 'Changed'
+        self.assertIs(line, formatter.format(record))
+
+    def test_app_tool_fields(self):
+        import json
+        import tempfile
+        class Lazy(object):
+            rendered = 0
+            def __str__(self):
+                Lazy.rendered += 1
+                return 'lazy'
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            app = AppTool('testing-json-log', os.getcwd())
+            app._app_path = temp_dir
+            app.config['log'] = {'level': 'INFO', 'dest': ['file'], 'format': 'json'}
+            logger = app.init_logger()
+            self.addCleanup(lambda: [handler.close() for handler in logger.handlers])
+            app.debug('Skipped', value=Lazy())
+            app.info('Synced %d', 3, value=Lazy(), extra={'job': 'sync'})
+            app.ex('Failed', exc_info=(ValueError, ValueError('bad'), None))
+            for handler in logger.handlers:
+                handler.flush()
+            with open(os.path.join(temp_dir, 'logs', 'testing-json-log.log'), encoding='utf-8') as fp:
+                docs = [json.loads(line) for line in fp]
+            app.config['log'] = {'dest': []}
+            app.init_logger()
+        self.assertEqual(1, Lazy.rendered)
+        self.assertEqual(2, len(docs))
+        self.assertEqual({'message': 'Synced 3', 'job': 'sync', 'value': 'lazy'}, {key: docs[0][key] for key in ('message', 'job', 'value')})
+        self.assertEqual('ERROR', docs[1]['level'])
+        self.assertIn('ValueError: bad', docs[1]['exception'])
+
+class TimingTestCase(unittest.TestCase):
+    def test_stats(self):
+        import random
+        stats = TimingStats('uniform')
+        values = list(range(1000, 1000001, 1000))
+        random.shuffle(values)
+        for value in values:
+            stats.add(value)
+        self.assertEqual(1000, stats.count)
+        self.assertEqual(1000, stats.min_ns)
+        self.assertEqual(1000000, stats.max_ns)
+        self.assertAlmostEqual(500500, stats.mean_ns)
+        for percent in (50, 95, 99):
+            self.assertAlmostEqual(percent * 10000, stats.percentile(percent), delta=percent * 10000 / 16)
+        self.assertEqual(1000000, stats.percentile(100))
+        self.assertLess(len(stats._buckets), 200)
+        stats = TimingStats('small')
+        for value in (3, 3, 7):
+            stats.add(value)
+        self.assertEqual([3, 3, 7], [stats.percentile(percent) for percent in (33, 66, 100)])
+
+    def test_benchmark(self):
+        import io
+        from contextlib import redirect_stdout
+
+        @benchmark
+        def plain(value):
+            return value * 2
+
+        with redirect_stdout(io.StringIO()) as output:
+            self.assertEqual(4, plain(2))
+        self.assertRegex(output.getvalue(), r'^Elapsed \d+\.\d{3} ms during running .*plain\n$')
+        self.assertIs(plain.stats, timings.stats(plain.__qualname__))
+        self.assertEqual(1, plain.stats.count)
+        self.assertEqual('plain', plain.__name__)
+
+        registry = TimingRegistry()
+        calls = []
+        @benchmark(name='repeated', warmup=1, repeat=2, echo=False, registry=registry)
+        def repeated():
+            calls.append(1)
+        for _ in range(3):
+            repeated()
+        self.assertEqual(6, len(calls))
+        self.assertEqual(5, registry.stats('repeated').count)
+        self.assertNotIn('repeated', timings)
+
+    def test_async_benchmark(self):
+        import asyncio
+        registry = TimingRegistry()
+        @benchmark(echo=False, registry=registry)
+        async def sleep():
+            await asyncio.sleep(0.01)
+            return 'slept'
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual('slept', loop.run_until_complete(sleep()))
+        finally:
+            loop.close()
+        self.assertGreaterEqual(sleep.stats.min_ns, 10000000)
+
+    def test_registry(self):
+        import json
+        import threading
+        registry = TimingRegistry()
+        def record():
+            for i in range(1000):
+                registry.record('threaded', i)
+        threads = [threading.Thread(target=record) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(8000, registry.stats('threaded').count)
+
+        stats = measure(sorted, list(range(1000)), warmup=2, repeat=10, registry=registry)
+        self.assertEqual(10, stats.count)
+        self.assertIs(stats, registry.stats('sorted'))
+
+        self.assertEqual(['count', 'total_ms', 'mean_ms', 'min_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms'], 
+                         list(json.loads(registry.dump_json())['threaded']))
+        app = AppTool('testing', os.getcwd())
+        with self.assertLogs('testing', logging.INFO) as logs:
+            app.report_timings(registry=registry)
+        self.assertEqual(2, len(logs.records))
+        self.assertTrue(logs.records[0].getMessage().startswith('sorted: count=10 mean='))
+
+    def test_find_regressions(self):
+        baseline = {'fast': {'p50_ms': 1.0, 'min_ms': 1.0}, 'slow': {'p50_ms': 1.0, 'min_ms': 1.0}, 'zero': {'p50_ms': 0.0}}
+        current = {'fast': {'p50_ms': 1.1, 'min_ms': 0.9}, 'slow': {'p50_ms': 1.5, 'min_ms': 1.3}, 
+                   'zero': {'p50_ms': 1.0}, 'new': {'p50_ms': 9.0}}
+        self.assertDictEqual({'slow': (1.0, 1.5)}, find_regressions(baseline, current))
+        self.assertDictEqual({'fast': (1.0, 1.1), 'slow': (1.0, 1.5)}, find_regressions(baseline, current, threshold=0.05))
+        self.assertDictEqual({}, find_regressions(baseline, current, threshold=0.5, key='min_ms'))
+
+
+class InstrumentationTestCase(unittest.TestCase):
+    def test_counts(self):
+        metrics = Instrumentation('testing', sample_every=3)
+        @metrics.instrument
+        def divide(value):
+            return 1 / value
+        for value in (1, 2, 0, 4, 5, 6, 7):
+            try:
+                divide(value)
+            except ZeroDivisionError:
+                pass
+        self.assertEqual(7, divide.metrics.calls)
+        self.assertEqual(1, divide.metrics.errors)
+        self.assertEqual(3, divide.metrics.wall.count)     # Calls 0, 3 and 6
+        self.assertEqual(3, divide.metrics.cpu.count)
+        self.assertIs(divide.metrics, metrics.functions[divide.metrics.name])
+        self.assertTrue(divide.metrics.name.endswith('.divide'))
+
+    def test_capture(self):
+        metrics = Instrumentation()
+        def inner():
+            return sorted(range(1000), reverse=True)
+        @metrics.instrument
+        def outer():
+            return [bytearray(1000) for _ in range(10)] + inner()
+
+        metrics.capture(outer, calls=2)
+        outer()
+        self.assertIsNone(outer.metrics.captured)
+        outer()
+        self.assertIsNone(outer.metrics.capture)
+        self.assertIn('inner', outer.metrics.captured)
+        self.assertIn('cumulative', outer.metrics.captured)
+        self.assertEqual(2, outer.metrics.calls)
+
+        metrics.capture(outer.metrics.name, kind='tracemalloc', top=5)
+        outer()
+        self.assertTrue(outer.metrics.captured.startswith('Top allocations'))
+        with self.assertRaises(AppToolError):
+            metrics.capture(outer, kind='perf')
+        with self.assertRaises(AppToolError):
+            metrics.capture(inner)
+
+    def test_prometheus(self):
+        import tempfile
+        import urllib.request
+        metrics = Instrumentation('my "app"')
+        func = metrics.instrument(lambda: None, name='noop')
+        for _ in range(5):
+            func()
+        text = metrics.to_prometheus()
+        self.assertIn('app_function_calls_total{app="my \\"app\\"",function="noop"} 5', text)
+        self.assertIn('app_function_wall_seconds_bucket{app="my \\"app\\"",function="noop",le="+Inf"} 5', text)
+        self.assertIn('app_function_cpu_seconds_count{app="my \\"app\\"",function="noop"} 5', text)
+        self.assertIn('# TYPE app_function_errors_total counter', text)
+
+        with tempfile.TemporaryDirectory() as dir_path:
+            file_path = os.path.join(dir_path, 'app.prom')
+            metrics.export_to_file(file_path, interval=60)
+            metrics.stop_exporting()
+            with open(file_path, encoding='utf8') as fp:
+                self.assertEqual(text, fp.read())
+
+        server = metrics.serve(0)
+        try:
+            url = 'http://127.0.0.1:%d/metrics' % server.server_address[1]
+            with urllib.request.urlopen(url, timeout=5) as response:
+                self.assertEqual(text, response.read().decode('utf8'))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_app_tool(self):
+        app = AppTool('testing', os.getcwd())
+        self.assertIsNone(app.metrics)
+        app._config = dict(app.config, log=dict(app.config.get('log') or {}, instrument='true', instrument_sample=2))
+        @app.log()
+        def fail():
+            raise ValueError('instrumented')
+        with self.assertLogs('testing', logging.ERROR):
+            fail()
+            fail()
+        self.assertIs(fail.metrics, app.metrics.functions[fail.metrics.name])
+        self.assertEqual(2, fail.metrics.calls)
+        self.assertEqual(2, fail.metrics.errors)
+        self.assertEqual(1, fail.metrics.wall.count)
+
+    def test_app_tool_port(self):
+        import socket
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        log_config = {'instrument': True, 'metrics_port': port}
+        apps = [AppTool(name, os.getcwd()) for name in ('metrics-port', 'metrics-port', 'metrics-port-other')]
+        for app in apps:
+            app._config = dict(app.config, log=log_config)
+        self.assertIs(apps[0].metrics, apps[1].metrics)
+        self.addCleanup(apps[0].metrics._server.server_close)
+        self.addCleanup(apps[0].metrics._server.shutdown)
+        with self.assertLogs('metrics-port-other', logging.ERROR) as logs:
+            @apps[2].log()
+            def func():
+                return 'instrumented'
+        self.assertIn(f':{port}', logs.output[0])
+        self.assertEqual('instrumented', func())
+        self.assertEqual(1, func.metrics.calls)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file